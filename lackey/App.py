@@ -1,24 +1,14 @@
 """ Abstracts the capturing and interfacing of applications """
 import os
 import re
-import time
 import pyperclip
-import platform
 import subprocess
 
-from .RegionMatching import Region
+from .RegionMatching import Region, PlatformManager
 from .SettingsDebug import Debug
 
-if platform.system() == "Windows":
-    from .PlatformManagerWindows import PlatformManagerWindows
-    PlatformManager = PlatformManagerWindows() # No other input managers built yet
-elif platform.system() == "Darwin":
-    from .PlatformManagerDarwin import PlatformManagerDarwin
-    PlatformManager = PlatformManagerDarwin()
-else:
-    # Avoid throwing an error if it's just being imported for documentation purposes
-    if not os.environ.get('READTHEDOCS') == 'True':
-        raise NotImplementedError("Lackey is currently only compatible with Windows and OSX.")
+# Waits and timeouts are measured by the platform's clock
+_clock = PlatformManager.getClock()
 
 # Python 3 compatibility
 try:
@@ -116,7 +106,7 @@ class App(object):
 
     @classmethod
     def pause(cls, waitTime):
-        time.sleep(waitTime)
+        _clock.sleep(waitTime)
 
     @classmethod
     def focus(cls, appName):
@@ -175,7 +165,7 @@ class App(object):
             self._pid = PlatformManager.getWindowPID(
                 PlatformManager.getWindowByTitle(
                     re.escape(self._title)))
-        time.sleep(waitTime)
+        _clock.sleep(waitTime)
         return self
 
     @classmethod
@@ -210,12 +200,12 @@ class App(object):
         """ Returns True if the process has a window associated, False otherwise """
         return PlatformManager.getWindowByPID(self.getPID()) is not None
     def waitForWindow(self, seconds=5):
-        timeout = time.time() + seconds
+        timeout = _clock.time() + seconds
         while True:
             window_region = self.window()
-            if window_region is not None or time.time() < timeout:
+            if window_region is not None or _clock.time() < timeout:
                 break
-            time.sleep(0.5)
+            _clock.sleep(0.5)
         return window_region
     def window(self, windowNum=0):
         """ Returns the region corresponding to the specified window of the app.
@@ -236,7 +226,7 @@ class App(object):
 
     def isRunning(self, waitTime=0):
         """ If PID isn't set yet, checks if there is a window with the specified title. """
-        waitUntil = time.time() + waitTime
+        waitUntil = _clock.time() + waitTime
         while True:
             if self.getPID() > 0:
                 return True
@@ -244,10 +234,10 @@ class App(object):
                 self._pid = PlatformManager.getWindowPID(PlatformManager.getWindowByTitle(re.escape(self._title)))
 
             # Check if we've waited long enough
-            if time.time() > waitUntil:
+            if _clock.time() > waitUntil:
                 break
             else:
-                time.sleep(self._defaultScanRate)
+                _clock.sleep(self._defaultScanRate)
         return self.getPID() > 0
     def isValid(self):
         return (os.path.isfile(self._exec) or self.getPID() > 0)
@@ -0,0 +1,350 @@
+""" Recording of captured regions to disk, and offline replay of the recordings.
+
+When ``Settings.FrameRecordPath`` is set, every region captured for a search is appended to
+an archive there, so the exact screens a script saw can be searched again later, without
+the script or its display (see ``FrameArchive``, ``ReplayCaptureBackend``, and
+``replayMatches()``).
+
+An archive starts with ``_MAGIC`` and a header, and is followed by one record per capture.
+Each record is a 4-byte little-endian length, a JSON object of that length describing the
+capture, and the capture's payload. Records refer only to earlier ones, so an archive cut
+short (by a crash, say) is readable up to its last complete record, and recording can
+resume after it.
+"""
+import collections
+import threading
+import hashlib
+import bisect
+import struct
+import json
+import time
+import os
+import numpy
+import cv2
+
+from .SettingsDebug import Debug, Settings
+from .ScreenCapture import CaptureBackend, clipToRect, _cropFrame
+
+# Python 3 compatibility
+try:
+    basestring
+except NameError:
+    basestring = str
+
+_MAGIC = b"LACKEY-FRAMES\n"
+_LENGTH = struct.Struct("<I")
+# Changed area (as a fraction of the frame) below which a capture is stored as a patch
+_MAX_DELTA_AREA = 0.5
+
+class FrameRecorder(object):
+    """ Appends captures to the archive at ``path``
+
+    Captures are stored compactly:
+
+    * A capture identical to one of the last ``max_refs`` distinct captures is stored as a
+      reference to it (``"same"``).
+    * A capture of the same size as the previous one is stored as the PNG of the bounding
+      box of its changed pixels (``"delta"``), if that's less than half of the frame.
+    * Any other capture is stored as a PNG of the whole frame (``"key"``).
+
+    The rect recorded with a capture has its top left corner where the capture's top left
+    pixel was on the screen. Each record is flushed as it is written. Recording can be used
+    from several threads.
+
+    If ``path`` is already an archive, captures are appended after its last complete record
+    (an incomplete one, left by a crash, is discarded). Any other file raises ``ValueError``
+    rather than being overwritten.
+    """
+    def __init__(self, path, max_refs=16):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._max_refs = max_refs
+        self._refs = collections.OrderedDict() # Hash of a distinct capture -> record index
+        self._previous = None
+        self._count = 0
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            archive = FrameArchive(self.path)
+            if archive._end > len(_MAGIC):
+                self._count = len(archive)
+                self._file = open(self.path, "r+b")
+                self._file.seek(archive._end)
+                self._file.truncate()
+                return
+        self._file = open(self.path, "wb")
+        self._file.write(_MAGIC)
+        self._writeRecord({"version": 1, "refs": max_refs})
+
+    def record(self, rect, bitmap, timestamp=None):
+        """ Appends ``bitmap``, captured from ``rect`` (x, y, w, h) at ``timestamp`` (by
+        default, now) """
+        if timestamp is None:
+            timestamp = time.time()
+        digest = hashlib.sha1(str(bitmap.shape).encode("ascii"))
+        digest.update(numpy.ascontiguousarray(bitmap).tobytes())
+        key = digest.hexdigest()
+        header = {"time": timestamp, "rect": [int(v) for v in rect], "shape": list(bitmap.shape[:2])}
+        with self._lock:
+            if self._file is None:
+                return
+            payload = b""
+            if key in self._refs:
+                header["kind"] = "same"
+                header["ref"] = self._refs[key]
+            else:
+                patch = _getChangedRect(self._previous, bitmap)
+                if patch is not None and patch[2]*patch[3] < _MAX_DELTA_AREA*bitmap.shape[0]*bitmap.shape[1]:
+                    p_x, p_y, p_w, p_h = patch
+                    header["kind"] = "delta"
+                    header["patch"] = list(patch)
+                    if p_w and p_h:
+                        payload = _encode(bitmap[p_y:p_y+p_h, p_x:p_x+p_w])
+                else:
+                    header["kind"] = "key"
+                    payload = _encode(bitmap)
+                self._refs[key] = self._count
+                if len(self._refs) > self._max_refs:
+                    self._refs.popitem(last=False)
+            header["size"] = len(payload)
+            self._writeRecord(header, payload)
+            self._previous = bitmap
+            self._count += 1
+    def getCount(self):
+        """ Returns the number of captures in the archive (including those it already had) """
+        return self._count
+    def close(self):
+        """ Stops recording and closes the archive """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _writeRecord(self, header, payload=b""):
+        data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        self._file.write(_LENGTH.pack(len(data)) + data + payload)
+        self._file.flush()
+
+def _getChangedRect(previous, bitmap):
+    """ Returns the bounding rect (x, y, w, h) of the pixels that differ between two captures
+    of the same size, or None if their sizes differ """
+    if previous is None or previous.shape != bitmap.shape:
+        return None
+    changed = numpy.any(previous != bitmap, axis=2).astype(numpy.uint8)
+    return cv2.boundingRect(changed)
+
+def _encode(image):
+    """ Returns ``image`` as PNG bytes (favoring speed over size, as this runs on every capture) """
+    success, data = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not success:
+        raise ValueError("Unable to encode frame")
+    return data.tobytes()
+
+def _decode(data):
+    image = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Corrupt frame in archive")
+    return image
+
+_Record = collections.namedtuple("_Record", "time rect shape kind ref patch offset size")
+
+class FrameArchive(object):
+    """ Captures read from an archive written by ``FrameRecorder``
+
+    Iterating over the archive yields ``(timestamp, rect, bitmap)`` tuples, in the order
+    they were captured. Opening the archive only indexes its records; each capture is
+    decoded when it's requested, as a read-only array. The most recently decoded captures
+    are cached, so iterating in order decodes each PNG once.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._records = []
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict() # Record index -> bitmap, least recent first
+        self._max_cached = 1
+        with open(self.path, "rb") as archive:
+            if archive.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("Not a frame archive: {}".format(self.path))
+            # Offset after the last complete record (where recording resumes)
+            self._end = len(_MAGIC)
+            size = os.fstat(archive.fileno()).st_size
+            settings = self._readHeader(archive, size)
+            if settings is None:
+                return
+            # Enough for every capture a later record can still refer to
+            self._max_cached = settings["refs"] + 1
+            self._end = archive.tell()
+            while True:
+                header = self._readHeader(archive, size)
+                if header is None:
+                    break
+                self._records.append(_Record(
+                    header["time"],
+                    tuple(header["rect"]),
+                    tuple(header["shape"]),
+                    header["kind"],
+                    header.get("ref"), # Always a key or delta record
+                    header.get("patch"),
+                    archive.tell(),
+                    header["size"]))
+                archive.seek(header["size"], os.SEEK_CUR)
+                self._end = archive.tell()
+        Debug.log(3, "Indexed {} frames in {}".format(len(self._records), self.path))
+
+    def __iter__(self):
+        return (self.getFrame(index) for index in range(len(self._records)))
+    def __len__(self):
+        return len(self._records)
+    def getFrame(self, index):
+        """ Returns the ``(timestamp, rect, bitmap)`` of the ``index``th capture """
+        record = self._records[index]
+        return (record.time, record.rect, self._getBitmap(index))
+    def getCaptures(self):
+        """ Returns the ``(timestamp, rect, shape)`` of every capture, without decoding them """
+        return [(record.time, record.rect, record.shape) for record in self._records]
+    def getDuration(self):
+        """ Returns the seconds between the first and last captures """
+        if not self._records:
+            return 0
+        return self._records[-1].time - self._records[0].time
+
+    def _resolve(self, index):
+        """ Returns the index of the key or delta record holding the ``index``th capture """
+        record = self._records[index]
+        return record.ref if record.kind == "same" else index
+    def _getBitmap(self, index):
+        with self._lock:
+            # Walk back to a cached capture or a key frame, then apply the patches after it
+            index = self._resolve(index)
+            chain = []
+            bitmap = None
+            while True:
+                bitmap = self._cache.get(index)
+                if bitmap is not None:
+                    self._cache.pop(index)
+                    self._cache[index] = bitmap
+                    break
+                chain.append(index)
+                if self._records[index].kind == "key":
+                    break
+                index = self._resolve(index - 1)
+            if not chain:
+                return bitmap
+            with open(self.path, "rb") as archive:
+                for index in reversed(chain):
+                    record = self._records[index]
+                    archive.seek(record.offset)
+                    payload = archive.read(record.size)
+                    if record.kind == "key":
+                        bitmap = _decode(payload)
+                    else:
+                        bitmap = bitmap.copy()
+                        p_x, p_y, p_w, p_h = record.patch
+                        if payload:
+                            bitmap[p_y:p_y+p_h, p_x:p_x+p_w] = _decode(payload)
+                    bitmap.setflags(write=False)
+                    self._cache[index] = bitmap
+                    if len(self._cache) > self._max_cached:
+                        self._cache.popitem(last=False)
+            return bitmap
+    def _readHeader(self, archive, size):
+        """ Returns the next record's header (leaving the file at its payload), or None at the
+        end of the archive (or at an incomplete record) """
+        length = archive.read(_LENGTH.size)
+        if len(length) < _LENGTH.size:
+            return None
+        data = archive.read(_LENGTH.unpack(length)[0])
+        try:
+            header = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+        if archive.tell() + header.get("size", 0) > size:
+            return None
+        return header
+
+class ReplayCaptureBackend(CaptureBackend):
+    """ Serves the captures of a ``FrameArchive`` at the times they were recorded
+
+    The archive's first capture is shown at time ``start`` by ``clock`` (by default, now by
+    the ``time`` module). Each capture then serves the latest recorded capture containing
+    the requested rect (or, failing that, overlapping it), as the screen looked when it was
+    recorded. With the virtual platform's clock, ``Region.exists()`` and ``wait()`` replay a
+    session as fast as the matching allows.
+    """
+    def __init__(self, archive, clock=time, start=None):
+        if not isinstance(archive, FrameArchive):
+            archive = FrameArchive(archive)
+        self._archive = archive
+        self._captures = archive.getCaptures()
+        self._clock = clock
+        first = self._captures[0][0] if self._captures else 0
+        self._offset = (start if start is not None else clock.time()) - first
+        self._times = [capture[0] for capture in self._captures]
+
+    def capture(self, x, y, w, h):
+        """ Returns the requested rect, as last recorded """
+        index = bisect.bisect_right(self._times, self._clock.time() - self._offset) - 1
+        candidates = range(index, -1, -1) if index >= 0 else range(len(self._captures))
+        overlapping = None
+        for i in candidates:
+            rect, shape = self._captures[i][1:]
+            f_x, f_y = rect[:2]
+            f_h, f_w = shape
+            if f_x <= x and f_y <= y and x+w <= f_x+f_w and y+h <= f_y+f_h:
+                return _cropFrame(self._archive.getFrame(i)[2], (f_x, f_y), (x, y, w, h))
+            if overlapping is None:
+                o_w, o_h = clipToRect((x, y, w, h), (f_x, f_y, f_w, f_h))[2:]
+                if o_w > 0 and o_h > 0:
+                    overlapping = i
+        if overlapping is not None:
+            rect = self._captures[overlapping][1]
+            return _cropFrame(self._archive.getFrame(overlapping)[2], rect[:2], (x, y, w, h))
+        return numpy.zeros((h, w, 3), dtype=numpy.uint8)
+
+def replayMatches(archive, pattern, similarity=None):
+    """ Searches every capture in ``archive`` (a ``FrameArchive`` or its path) for ``pattern``
+    (an image path, numpy array, or compiled pattern), as fast as possible
+
+    Returns a list with a tuple of ``(timestamp, rect, match, seconds)`` per capture, where
+    ``match`` is the ``((x, y), score)`` of the best match in screen coordinates (or None if
+    nothing scored ``similarity`` or better; by default ``Settings.MinSimilarity``), and
+    ``seconds`` the time matching took.
+    """
+    from .ImageCache import NeedleCache
+    from .TemplateMatchers import PyramidTemplateMatcher, compilePattern
+    if not isinstance(archive, FrameArchive):
+        archive = FrameArchive(archive)
+    if isinstance(pattern, basestring):
+        cached = NeedleCache.get(pattern)
+        if cached is None:
+            raise ValueError("Unable to read image file: {}".format(pattern))
+        pattern = cached
+    needle = compilePattern(pattern)
+    if similarity is None:
+        similarity = Settings.MinSimilarity
+    results = []
+    for timestamp, rect, bitmap in archive:
+        start = time.time()
+        match = None
+        if needle.shape[0] <= bitmap.shape[0] and needle.shape[1] <= bitmap.shape[1]:
+            match = PyramidTemplateMatcher(bitmap).findBestMatch(needle, similarity)
+        if match is not None:
+            (m_x, m_y), score = match
+            match = ((m_x + rect[0], m_y + rect[1]), score)
+        results.append((timestamp, rect, match, time.time() - start))
+    return results
+
+_recorder = None
+_recorder_lock = threading.Lock()
+def getFrameRecorder():
+    """ Returns the ``FrameRecorder`` for ``Settings.FrameRecordPath``, or None if it isn't set
+
+    Changing the setting closes the previous archive and starts a new one.
+    """
+    global _recorder
+    path = Settings.FrameRecordPath
+    with _recorder_lock:
+        if _recorder is not None and (not path or _recorder.path != os.path.abspath(path)):
+            _recorder.close()
+            _recorder = None
+        if path and _recorder is None:
+            _recorder = FrameRecorder(path)
+        return _recorder
@@ -2,8 +2,10 @@ import time
 
 class Location(object):
     """ Basic 2D point object """
+    __slots__ = ("x", "y")
     def __init__(self, x, y):
-        self.setLocation(x, y)
+        self.x = int(x)
+        self.y = int(y)
 
     def getX(self):
         """ Returns the X-component of the location """
@@ -46,14 +48,11 @@ class Location(object):
 
         Returns None if the Location isn't positioned in any screen.
         """
-        from .RegionMatching import PlatformManager, Screen
-        screens = PlatformManager.getScreenDetails()
-        for screen in screens:
-            s_x, s_y, s_w, s_h = screen["rect"]
-            if (self.x >= s_x) and (self.x < s_x + s_w) and (self.y >= s_y) and (self.y < s_y + s_h):
-                # Top left corner is inside screen region
-                return Screen(screens.index(screen))
-        return None # Could not find matching screen
+        from .RegionMatching import Screen
+        screen_id = Screen.getTopology().getScreenAt(self.x, self.y)
+        if screen_id is None:
+            return None # Could not find matching screen
+        return Screen(screen_id)
     def getMonitor(self):
         """ Returns an instance of the ``Screen`` object this Location is inside.
 
@@ -67,7 +66,7 @@ class Location(object):
         if scr is None:
             return None
         offset = scr.getTopLeft().getOffset(self)
-        return self.getScreen().getBitmap()[offset.x, offset.y]
+        return self.getScreen()._getSharedBitmap()[offset.x, offset.y]
     def getOffset(self, loc):
         """ Returns the offset between the given point and this point """
         return Location(loc.x - self.x, loc.y - self.y)
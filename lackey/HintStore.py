@@ -0,0 +1,95 @@
+""" On-disk store of where patterns were last found, shared between script runs """
+import contextlib
+import threading
+import sqlite3
+import time
+import os
+
+from .SettingsDebug import Debug, Settings
+
+class HintStore(object):
+    """ SQLite database of the last position (and score) at which each pattern was found
+
+    Hints are keyed by a hash of the pattern's image and by the screen geometry, so they
+    are only used with the monitor layout they were recorded on. The number of hints is
+    kept below ``Settings.HintStoreSize`` (unless ``max_entries`` is given) by discarding
+    the least recently updated ones.
+
+    Each operation uses its own short-lived connection, so the store can be used from
+    several threads, and several processes can write to the same file. Hints only speed up
+    searches, so database errors are logged rather than raised.
+    """
+    def __init__(self, path, max_entries=None):
+        self.path = os.path.abspath(path)
+        self._max_entries = max_entries
+        def create(connection):
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS hints ("
+                "pattern TEXT, geometry TEXT, x INTEGER, y INTEGER, score REAL, updated REAL, "
+                "PRIMARY KEY (pattern, geometry))")
+            # Lets the oldest hints be found without sorting the table
+            connection.execute("CREATE INDEX IF NOT EXISTS hints_updated ON hints (updated)")
+        self._transact(create)
+
+    def getMaxEntries(self):
+        """ Returns the maximum number of hints kept in the store """
+        return self._max_entries if self._max_entries is not None else Settings.HintStoreSize
+    def get(self, pattern_hash, geometry):
+        """ Returns the last ``((x, y), score)`` recorded for the pattern, or None """
+        rows = self._execute(
+            "SELECT x, y, score FROM hints WHERE pattern = ? AND geometry = ?",
+            (pattern_hash, geometry))
+        if not rows:
+            return None
+        x, y, score = rows[0]
+        return ((x, y), score)
+    def put(self, pattern_hash, geometry, position, score):
+        """ Records that the pattern was found at ``position`` (x, y) with ``score`` """
+        max_entries = int(self.getMaxEntries())
+        def put(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO hints (pattern, geometry, x, y, score, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (pattern_hash, geometry, int(position[0]), int(position[1]), float(score), time.time()))
+            excess = connection.execute("SELECT COUNT(*) FROM hints").fetchone()[0] - max_entries
+            if excess > 0:
+                connection.execute(
+                    "DELETE FROM hints WHERE rowid IN "
+                    "(SELECT rowid FROM hints ORDER BY updated LIMIT ?)",
+                    (excess,))
+        self._transact(put)
+    def clear(self):
+        """ Discards all hints """
+        self._execute("DELETE FROM hints")
+    def getSize(self):
+        """ Returns the number of hints in the store """
+        rows = self._execute("SELECT COUNT(*) FROM hints")
+        return rows[0][0] if rows else 0
+
+    def _execute(self, query, parameters=()):
+        """ Runs ``query`` in its own transaction and returns the resulting rows """
+        rows = self._transact(lambda connection: connection.execute(query, parameters).fetchall())
+        return rows if rows is not None else []
+    def _transact(self, operation):
+        """ Calls ``operation(connection)`` in a single transaction and returns its result (or
+        None if the store is unavailable) """
+        try:
+            with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as connection:
+                with connection:
+                    return operation(connection)
+        except sqlite3.Error as e:
+            Debug.log(3, "Hint store {} unavailable: {}".format(self.path, e))
+            return None
+
+_store = None
+_store_lock = threading.Lock()
+def getHintStore():
+    """ Returns the ``HintStore`` at ``Settings.HintStorePath``, or None if it isn't set """
+    global _store
+    path = Settings.HintStorePath
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None or _store.path != os.path.abspath(path):
+            _store = HintStore(path)
+        return _store
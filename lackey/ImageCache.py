@@ -0,0 +1,129 @@
+""" Cache of decoded pattern images, shared by all Patterns """
+import collections
+import threading
+import os
+import cv2
+
+from .SettingsDebug import Settings
+
+class CachedImage(object):
+    """ A decoded image file, along with any variants derived from it (grayscale,
+    pyramid levels, etc.)
+
+    Variants are built on first request and kept for as long as the image stays cached.
+    """
+    def __init__(self, image, path=None, mtime=None):
+        self.image = image
+        self.path = path
+        self.mtime = mtime
+        self._variants = {}
+        self._lock = threading.Lock()
+        self._cache = None # Set by the owning ImageCache to track variant sizes
+
+    @property
+    def shape(self):
+        """ Shape of the decoded image """
+        return self.image.shape
+
+    def getVariant(self, key, builder):
+        """ Returns the variant stored under ``key``, calling ``builder()`` to create it the
+        first time """
+        with self._lock:
+            if key in self._variants:
+                return self._variants[key]
+        variant = builder()
+        with self._lock:
+            variant = self._variants.setdefault(key, variant)
+        if self._cache is not None:
+            self._cache._trim()
+        return variant
+    def getSize(self):
+        """ Returns the number of bytes held by the image and its variants """
+        with self._lock:
+            variants = list(self._variants.values())
+        return self.image.nbytes + sum(_sizeof(variant) for variant in variants)
+
+def _sizeof(value):
+    """ Estimates the number of bytes held by a variant (array, or list/tuple of them) """
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(item) for item in value)
+    if hasattr(value, "getSize"):
+        return value.getSize()
+    return 0
+
+class ImageCache(object):
+    """ Least-recently-used cache of decoded image files
+
+    Entries are keyed by absolute path and reloaded when the file's modification time
+    changes. The total size of the cached images and their variants is kept below
+    ``Settings.NeedleCacheSize`` bytes (unless ``max_bytes`` is given).
+    """
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def getMaxBytes(self):
+        """ Returns the maximum number of bytes held by the cache """
+        return self._max_bytes if self._max_bytes is not None else Settings.NeedleCacheSize
+    def get(self, path):
+        """ Returns the ``CachedImage`` for the file at ``path``, decoding it if it isn't
+        cached (or has changed on disk since it was cached).
+
+        Returns None if the file can't be read as an image.
+        """
+        path = os.path.abspath(path)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry.mtime == mtime:
+                # Re-insert to mark as most recently used
+                self._entries[path] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+        image = cv2.imread(path)
+        if image is None:
+            return None
+        # Shared between Patterns, so protect it from accidental modification
+        image.setflags(write=False)
+        entry = CachedImage(image, path, mtime)
+        entry._cache = self
+        with self._lock:
+            self._entries[path] = entry
+        self._trim()
+        return entry
+    def clear(self):
+        """ Discards all cached images """
+        with self._lock:
+            self._entries.clear()
+    def getSize(self):
+        """ Returns the number of bytes currently held by the cache """
+        with self._lock:
+            entries = list(self._entries.values())
+        return sum(entry.getSize() for entry in entries)
+    def getStats(self):
+        """ Returns a dict with the cache's ``hits``, ``misses``, ``entries``, and ``bytes`` """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.getSize()}
+    def _trim(self):
+        """ Evicts least recently used entries until the cache fits in its size limit.
+
+        The most recently used entry is always kept. """
+        max_bytes = self.getMaxBytes()
+        with self._lock:
+            sizes = [(path, entry.getSize()) for path, entry in self._entries.items()]
+            total = sum(size for path, size in sizes)
+            for path, size in sizes[:-1]:
+                if total <= max_bytes:
+                    break
+                del self._entries[path]
+                total -= size
+
+NeedleCache = ImageCache()
@@ -7,12 +7,35 @@ import time
 import keyboard
 from keyboard import mouse
 
+from .ScreenCapture import invalidateFrameCaches
+
 # Python 3 compatibility
 try:
     basestring
 except NameError:
     basestring = str
 
+# Devices that input is sent to, and the clock that typing delays are measured by: the
+# ``mouse``, ``keyboard``, and ``time`` modules, unless replaced (see ``setInputDevices()``).
+# Sending input discards cached captures, as the screen may change in response.
+_mouse = mouse
+_keyboard = keyboard
+_clock = time
+def setInputDevices(mouse_device=None, keyboard_device=None, clock=None):
+    """ Sends mouse and keyboard input to the given devices instead of the OS
+
+    Devices implement the parts of the ``mouse`` and ``keyboard`` modules' interfaces used
+    here (see ``InputRecorder``), and ``clock`` the ``time()`` and ``sleep()`` functions of
+    the ``time`` module. Called with no arguments, restores the OS devices.
+    """
+    global _mouse, _keyboard, _clock
+    _mouse = mouse_device if mouse_device is not None else mouse
+    _keyboard = keyboard_device if keyboard_device is not None else keyboard
+    _clock = clock if clock is not None else time
+def getInputDevices():
+    """ Returns the ``(mouse, keyboard, clock)`` that input is currently sent to """
+    return (_mouse, _keyboard, _clock)
+
 class Mouse(object):
     """ Mid-level mouse routines. """
     def __init__(self):
@@ -37,19 +60,20 @@ class Mouse(object):
         from .Geometry import Location
         self._lock.acquire()
         if isinstance(loc, Location):
-            mouse.move(loc.x, loc.y)
+            _mouse.move(loc.x, loc.y)
         elif yoff is not None:
             xoff = loc
-            mouse.move(xoff, yoff)
+            _mouse.move(xoff, yoff)
         else:
             raise ValueError("Invalid argument. Expected either move(loc) or move(xoff, yoff).")
+        invalidateFrameCaches()
         self._last_position = loc
         self._lock.release()
 
     def getPos(self):
         """ Gets ``Location`` of cursor """
         from .Geometry import Location
-        return Location(*mouse.get_position())
+        return Location(*_mouse.get_position())
     at = getPos
 
     def hasMoved(self):
@@ -63,9 +87,10 @@ class Mouse(object):
         somewhat-human-like motion.
         """
         self._lock.acquire()
-        original_location = mouse.get_position()
-        mouse.move(location.x, location.y, duration=seconds)
-        if mouse.get_position() == original_location and original_location != location.getTuple():
+        original_location = _mouse.get_position()
+        _mouse.move(location.x, location.y, duration=seconds)
+        invalidateFrameCaches()
+        if _mouse.get_position() == original_location and original_location != location.getTuple():
             raise IOError("""
                 Unable to move mouse cursor. This may happen if you're trying to automate a 
                 program running as Administrator with a script running as a non-elevated user.
@@ -82,7 +107,8 @@ class Mouse(object):
         self._lock.acquire()
         if loc is not None:
             self.moveSpeed(loc)
-        mouse.click(button)
+        _mouse.click(button)
+        invalidateFrameCaches()
         self._lock.release()
     def buttonDown(self, button=mouse.LEFT):
         """ Holds down the specified mouse button.
@@ -90,7 +116,8 @@ class Mouse(object):
         Use Mouse.LEFT, Mouse.MIDDLE, Mouse.RIGHT
         """
         self._lock.acquire()
-        mouse.press(button)
+        _mouse.press(button)
+        invalidateFrameCaches()
         self._lock.release()
     down = buttonDown
     def buttonUp(self, button=mouse.LEFT):
@@ -99,7 +126,8 @@ class Mouse(object):
         Use Mouse.LEFT, Mouse.MIDDLE, Mouse.RIGHT
         """
         self._lock.acquire()
-        mouse.release(button)
+        _mouse.release(button)
+        invalidateFrameCaches()
         self._lock.release()
     up = buttonUp
     def wheel(self, direction, steps):
@@ -115,7 +143,9 @@ class Mouse(object):
         else:
             raise ValueError("Expected direction to be 1 or 0")
         self._lock.release()
-        return mouse.wheel(wheel_moved)
+        result = _mouse.wheel(wheel_moved)
+        invalidateFrameCaches()
+        return result
 
 class Keyboard(object):
     """ Mid-level keyboard routines. Interfaces with ``PlatformManager`` """
@@ -299,7 +329,7 @@ class Keyboard(object):
                 in_special_code = False
                 if special_code in self._SPECIAL_KEYCODES.keys():
                     # Found a special code
-                    keyboard.press(self._SPECIAL_KEYCODES[special_code])
+                    _keyboard.press(self._SPECIAL_KEYCODES[special_code])
                 else:
                     # Wasn't a special code, just treat it as keystrokes
                     self.keyDown("{")
@@ -310,10 +340,11 @@ class Keyboard(object):
             elif in_special_code:
                 special_code += keys[i]
             elif keys[i] in self._REGULAR_KEYCODES.keys():
-                keyboard.press(keys[i])
+                _keyboard.press(keys[i])
             elif keys[i] in self._UPPERCASE_KEYCODES.keys():
-                keyboard.press(self._SPECIAL_KEYCODES["SHIFT"])
-                keyboard.press(self._UPPERCASE_KEYCODES[keys[i]])
+                _keyboard.press(self._SPECIAL_KEYCODES["SHIFT"])
+                _keyboard.press(self._UPPERCASE_KEYCODES[keys[i]])
+        invalidateFrameCaches()
     def keyUp(self, keys):
         """ Accepts a string of keys (including special keys wrapped in brackets or provided
         by the Key or KeyModifier classes). Releases any that are held down. """
@@ -329,7 +360,7 @@ class Keyboard(object):
                 in_special_code = False
                 if special_code in self._SPECIAL_KEYCODES.keys():
                     # Found a special code
-                    keyboard.release(self._SPECIAL_KEYCODES[special_code])
+                    _keyboard.release(self._SPECIAL_KEYCODES[special_code])
                 else:
                     # Wasn't a special code, just treat it as keystrokes
                     self.keyUp("{")
@@ -340,10 +371,11 @@ class Keyboard(object):
             elif in_special_code:
                 special_code += keys[i]
             elif keys[i] in self._REGULAR_KEYCODES.keys():
-                keyboard.release(self._REGULAR_KEYCODES[keys[i]])
+                _keyboard.release(self._REGULAR_KEYCODES[keys[i]])
             elif keys[i] in self._UPPERCASE_KEYCODES.keys():
-                keyboard.release(self._SPECIAL_KEYCODES["SHIFT"])
-                keyboard.release(self._UPPERCASE_KEYCODES[keys[i]])
+                _keyboard.release(self._SPECIAL_KEYCODES["SHIFT"])
+                _keyboard.release(self._UPPERCASE_KEYCODES[keys[i]])
+        invalidateFrameCaches()
     def type(self, text, delay=0.1):
         """ Translates a string into a series of keystrokes.
 
@@ -362,12 +394,12 @@ class Keyboard(object):
                 in_special_code = False
                 if special_code in self._SPECIAL_KEYCODES.keys():
                     # Found a special code
-                    keyboard.press_and_release(self._SPECIAL_KEYCODES[special_code])
+                    _keyboard.press_and_release(self._SPECIAL_KEYCODES[special_code])
                 else:
                     # Wasn't a special code, just treat it as keystrokes
-                    keyboard.press(self._SPECIAL_KEYCODES["SHIFT"])
-                    keyboard.press_and_release(self._UPPERCASE_KEYCODES["{"])
-                    keyboard.release(self._SPECIAL_KEYCODES["SHIFT"])
+                    _keyboard.press(self._SPECIAL_KEYCODES["SHIFT"])
+                    _keyboard.press_and_release(self._UPPERCASE_KEYCODES["{"])
+                    _keyboard.release(self._SPECIAL_KEYCODES["SHIFT"])
                     # Release the rest of the keys normally
                     self.type(special_code)
                     self.type(text[i])
@@ -375,12 +407,79 @@ class Keyboard(object):
             elif in_special_code:
                 special_code += text[i]
             elif text[i] in self._REGULAR_KEYCODES.keys():
-                keyboard.press(self._REGULAR_KEYCODES[text[i]])
-                keyboard.release(self._REGULAR_KEYCODES[text[i]])
+                _keyboard.press(self._REGULAR_KEYCODES[text[i]])
+                _keyboard.release(self._REGULAR_KEYCODES[text[i]])
             elif text[i] in self._UPPERCASE_KEYCODES.keys():
-                keyboard.press(self._SPECIAL_KEYCODES["SHIFT"])
-                keyboard.press_and_release(self._UPPERCASE_KEYCODES[text[i]])
-                keyboard.release(self._SPECIAL_KEYCODES["SHIFT"])
+                _keyboard.press(self._SPECIAL_KEYCODES["SHIFT"])
+                _keyboard.press_and_release(self._UPPERCASE_KEYCODES[text[i]])
+                _keyboard.release(self._SPECIAL_KEYCODES["SHIFT"])
             if delay and not in_special_code:
-                time.sleep(delay)
+                _clock.sleep(delay)
+        invalidateFrameCaches()
+
+
+class InputRecorder(object):
+    """ Records input events instead of sending them to the OS
+
+    ``mouse`` and ``keyboard`` stand in for the ``mouse`` and ``keyboard`` modules (see
+    ``setInputDevices()``). Each event is recorded as a tuple of ``(time, device, action,
+    value)``, e.g. ``(12.5, "mouse", "click", "left")`` or ``(12.6, "keyboard", "press",
+    "a")``, timed by ``clock`` (any object with ``time()`` and ``sleep()`` methods, like the
+    ``time`` module). Timed mouse moves sleep on the clock for their duration.
+    """
+    def __init__(self, clock=time):
+        self._clock = clock
+        self._lock = multiprocessing.Lock()
+        self._events = []
+        self.mouse = _RecordedMouse(self)
+        self.keyboard = _RecordedKeyboard(self)
+
+    def record(self, device, action, value=None):
+        """ Appends an event to the record """
+        with self._lock:
+            self._events.append((self._clock.time(), device, action, value))
+    def getEvents(self):
+        """ Returns the recorded events, oldest first """
+        with self._lock:
+            return list(self._events)
+    def clear(self):
+        """ Discards the recorded events """
+        with self._lock:
+            self._events = []
+
+class _RecordedMouse(object):
+    """ Mouse device for ``InputRecorder`` """
+    def __init__(self, recorder):
+        self._recorder = recorder
+        self._position = (0, 0)
+
+    def move(self, x, y, absolute=True, duration=0):
+        if not absolute:
+            x, y = self._position[0] + x, self._position[1] + y
+        if duration:
+            self._recorder._clock.sleep(duration)
+        self._position = (x, y)
+        self._recorder.record("mouse", "move", (x, y))
+    def get_position(self):
+        return self._position
+    def click(self, button=mouse.LEFT):
+        self._recorder.record("mouse", "click", button)
+    def press(self, button=mouse.LEFT):
+        self._recorder.record("mouse", "press", button)
+    def release(self, button=mouse.LEFT):
+        self._recorder.record("mouse", "release", button)
+    def wheel(self, delta=1):
+        self._recorder.record("mouse", "wheel", delta)
+
+class _RecordedKeyboard(object):
+    """ Keyboard device for ``InputRecorder`` """
+    def __init__(self, recorder):
+        self._recorder = recorder
 
+    def press(self, key):
+        self._recorder.record("keyboard", "press", key)
+    def release(self, key):
+        self._recorder.record("keyboard", "release", key)
+    def press_and_release(self, key):
+        self.press(key)
+        self.release(key)
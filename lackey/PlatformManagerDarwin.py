@@ -4,6 +4,7 @@ import os
 import re
 import tempfile
 import threading
+import time
 import subprocess
 try:
     import Tkinter as tk
@@ -19,6 +20,7 @@ from PIL import Image, ImageTk
 
 from .SettingsDebug import Debug
 from .InputEmulation import Keyboard
+from .ScreenCapture import CaptureBackend, FrameCache, clipToRect, toWritable
 
 # Python 3 compatibility
 try:
@@ -26,9 +28,14 @@ try:
 except NameError:
     basestring = str
 
+# Pillow 10 removed Image.ANTIALIAS; Image.LANCZOS is the same filter (Pillow 2.7 and up)
+_RESAMPLE_FILTER = getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+
 class PlatformManagerDarwin(object):
     """ Abstracts Darwin-specific OS-level features """
     def __init__(self):
+        self._capture_backend = ScreencaptureBackend()
+        self._frame_cache = FrameCache()
 
         # Mapping to `keyboard` names
         self._SPECIAL_KEYCODES = {
@@ -194,20 +201,42 @@ class PlatformManagerDarwin(object):
             "}":            "]",
         }
 
+    def getClock(self):
+        """ Returns the clock that waits and timeouts are measured by (the ``time`` module) """
+        return time
+
     ## Screen functions
 
     def getBitmapFromRect(self, x, y, w, h):
-        """ Capture the specified area of the (virtual) screen. """
-        min_x, min_y, screen_width, screen_height = self._getVirtualScreenRect()
-        img = self._getVirtualScreenBitmap() # TODO
-        # Limit the coordinates to the virtual screen
-        # Then offset so 0,0 is the top left corner of the image
-        # (Top left of virtual screen could be negative)
-        x1 = min(max(min_x, x), min_x+screen_width) - min_x
-        y1 = min(max(min_y, y), min_y+screen_height) - min_y
-        x2 = min(max(min_x, x+w), min_x+screen_width) - min_x
-        y2 = min(max(min_y, y+h), min_y+screen_height) - min_y
-        return numpy.array(img.crop((x1, y1, x2, y2)))
+        """ Capture the specified area of the (virtual) screen.
+
+        Only the requested area (limited to the virtual screen) is captured.
+        Returns a writable array (see ``getSharedBitmapFromRect()``).
+        """
+        return toWritable(self.getSharedBitmapFromRect(x, y, w, h))
+    def getSharedBitmapFromRect(self, x, y, w, h):
+        """ Like ``getBitmapFromRect()``, but captures are shared for ``Settings.FrameCacheTTL``
+        seconds, so the returned array may be a read-only view of a recent frame """
+        x, y, w, h = clipToRect((x, y, w, h), self._getVirtualScreenRect())
+        if w <= 0 or h <= 0:
+            return numpy.zeros((max(h, 0), max(w, 0), 3), dtype=numpy.uint8)
+        return self._frame_cache.getBitmap((x, y, w, h), self._capture_backend.capture)
+    def setCaptureBackend(self, backend):
+        """ Replaces the backend used to read pixels from the screen """
+        if not isinstance(backend, CaptureBackend):
+            raise TypeError("Expected a CaptureBackend object")
+        self._capture_backend = backend
+        self._frame_cache.invalidate()
+    def getCaptureBackend(self):
+        """ Returns the backend used to read pixels from the screen """
+        return self._capture_backend
+    def getFrameCacheStats(self):
+        """ Returns the frame cache's hit and miss counters as a dict """
+        return self._frame_cache.getStats()
+    def resetFrameCache(self):
+        """ Discards cached frames and resets the frame cache's counters """
+        self._frame_cache.invalidate()
+        self._frame_cache.resetStats()
     def getScreenBounds(self, screenId):
         """ Returns the screen size of the specified monitor (0 being the main monitor). """
         screen_details = self.getScreenDetails()
@@ -225,32 +254,6 @@ class PlatformManagerDarwin(object):
         x2 = max([s["rect"][0]+s["rect"][2] for s in monitors])
         y2 = max([s["rect"][1]+s["rect"][3] for s in monitors])
         return (x1, y1, x2-x1, y2-y1)
-    def _getVirtualScreenBitmap(self):
-        """ Returns a bitmap of all attached screens """
-        filenames = []
-        screen_details = self.getScreenDetails()
-        for screen in screen_details:
-            fh, filepath = tempfile.mkstemp('.png')
-            filenames.append(filepath)
-            os.close(fh)
-        subprocess.call(['screencapture', '-x'] + filenames)
-
-        min_x, min_y, screen_w, screen_h = self._getVirtualScreenRect()
-        virtual_screen = Image.new("RGB", (screen_w, screen_h))
-        for filename, screen in zip(filenames, screen_details):
-            im = Image.open(filename)
-            im.load()
-            im = im.resize((int(im.size[0]/2), int(im.size[1]/2)), Image.ANTIALIAS)
-            # Capture virtscreen coordinates of monitor
-            x, y, w, h = screen["rect"]
-            # Convert to image-local coordinates
-            x = x - min_x
-            y = y - min_y
-            # Paste on the virtual screen
-            virtual_screen.paste(im, (x, y))
-            os.unlink(filename)
-        return virtual_screen
-
     def getScreenDetails(self):
         """ Return list of attached monitors
 
@@ -386,7 +389,7 @@ class PlatformManagerDarwin(object):
             Debug.log(3, "Borrowing existing Tkinter root")
             temporary_root = False
             root = tk._default_root
-        image_to_show = self.getBitmapFromRect(*rect)
+        image_to_show = self.getSharedBitmapFromRect(*rect)
         app = highlightWindow(root, rect, color, image_to_show, queue)
         app.do_until_timeout(seconds)
 
@@ -413,6 +416,28 @@ class PlatformManagerDarwin(object):
                 if proc[1].strip() == str(pid):
                     return proc[-1]
 
+## Screen capture backend
+
+class ScreencaptureBackend(CaptureBackend):
+    """ Captures a rect of the screen with the ``screencapture`` utility """
+    def capture(self, x, y, w, h):
+        """ Captures the rect (x, y, w, h) of the virtual screen
+
+        Returns a numpy array (BGR channel order, for compatibility with OpenCV)
+        """
+        fh, filepath = tempfile.mkstemp('.png')
+        os.close(fh)
+        try:
+            subprocess.call(['screencapture', '-x', '-R{},{},{},{}'.format(x, y, w, h), filepath])
+            im = Image.open(filepath)
+            im.load()
+        finally:
+            os.unlink(filepath)
+        if im.size != (w, h):
+            # Retina displays capture at a higher resolution than the screen coordinates
+            im = im.resize((w, h), _RESAMPLE_FILTER)
+        return numpy.array(im.convert("RGB"))[..., ::-1].copy()
+
 ## Helper class for highlighting
 
 class highlightWindow(tk.Toplevel):
@@ -438,7 +463,7 @@ class highlightWindow(tk.Toplevel):
             bd=0,
             bg="blue",
             highlightthickness=0)
-        self.tk_image = ImageTk.PhotoImage(Image.fromarray(screen_cap))
+        self.tk_image = ImageTk.PhotoImage(Image.fromarray(screen_cap[..., [2, 1, 0]]))
         self.canvas.create_image(0, 0, image=self.tk_image, anchor=tk.NW)
         self.canvas.create_rectangle(
             2,
@@ -0,0 +1,723 @@
+""" Platform-specific code for Linux (X11) is encapsulated in this module. """
+
+import os
+import re
+import errno
+import signal
+import ctypes
+import ctypes.util
+import threading
+import time
+try:
+    import Tkinter as tk
+except ImportError:
+    import tkinter as tk
+
+import numpy
+import cv2
+from PIL import Image, ImageTk
+
+from .SettingsDebug import Debug
+from .ScreenCapture import CaptureBackend, FrameCache, clipToRect, toWritable
+
+# Python 3 compatibility
+try:
+    basestring
+except NameError:
+    basestring = str
+
+## Xlib types and constants
+
+class XImage(ctypes.Structure):
+    _fields_ = [("width", ctypes.c_int),
+                ("height", ctypes.c_int),
+                ("xoffset", ctypes.c_int),
+                ("format", ctypes.c_int),
+                ("data", ctypes.c_void_p),
+                ("byte_order", ctypes.c_int),
+                ("bitmap_unit", ctypes.c_int),
+                ("bitmap_bit_order", ctypes.c_int),
+                ("bitmap_pad", ctypes.c_int),
+                ("depth", ctypes.c_int),
+                ("bytes_per_line", ctypes.c_int),
+                ("bits_per_pixel", ctypes.c_int),
+                ("red_mask", ctypes.c_ulong),
+                ("green_mask", ctypes.c_ulong),
+                ("blue_mask", ctypes.c_ulong),
+                ("obdata", ctypes.c_void_p),
+                ("f", ctypes.c_void_p*6)]
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [("shmseg", ctypes.c_ulong),
+                ("shmid", ctypes.c_int),
+                ("shmaddr", ctypes.c_void_p),
+                ("readOnly", ctypes.c_int)]
+class XWindowAttributes(ctypes.Structure):
+    _fields_ = [("x", ctypes.c_int),
+                ("y", ctypes.c_int),
+                ("width", ctypes.c_int),
+                ("height", ctypes.c_int),
+                ("border_width", ctypes.c_int),
+                ("depth", ctypes.c_int),
+                ("visual", ctypes.c_void_p),
+                ("root", ctypes.c_ulong),
+                ("class", ctypes.c_int),
+                ("bit_gravity", ctypes.c_int),
+                ("win_gravity", ctypes.c_int),
+                ("backing_store", ctypes.c_int),
+                ("backing_planes", ctypes.c_ulong),
+                ("backing_pixel", ctypes.c_ulong),
+                ("save_under", ctypes.c_int),
+                ("colormap", ctypes.c_ulong),
+                ("map_installed", ctypes.c_int),
+                ("map_state", ctypes.c_int),
+                ("all_event_masks", ctypes.c_long),
+                ("your_event_mask", ctypes.c_long),
+                ("do_not_propagate_mask", ctypes.c_long),
+                ("override_redirect", ctypes.c_int),
+                ("screen", ctypes.c_void_p)]
+class XErrorEvent(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_int),
+                ("display", ctypes.c_void_p),
+                ("resourceid", ctypes.c_ulong),
+                ("serial", ctypes.c_ulong),
+                ("error_code", ctypes.c_ubyte),
+                ("request_code", ctypes.c_ubyte),
+                ("minor_code", ctypes.c_ubyte)]
+class XineramaScreenInfo(ctypes.Structure):
+    _fields_ = [("screen_number", ctypes.c_int),
+                ("x_org", ctypes.c_short),
+                ("y_org", ctypes.c_short),
+                ("width", ctypes.c_short),
+                ("height", ctypes.c_short)]
+
+XErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(XErrorEvent))
+
+Z_PIXMAP = 2
+LSB_FIRST = 0
+IS_VIEWABLE = 2
+REVERT_TO_PARENT = 2
+XA_CARDINAL = 6
+XA_WINDOW = 33
+ALL_PLANES = ctypes.c_ulong(-1).value
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+def _loadLibrary(name, functions):
+    """ Loads the shared library ``name`` (e.g. "X11") and declares its ``functions`` (a dict
+    of name: (restype, argtypes))
+
+    Returns None if the library isn't installed.
+    """
+    path = ctypes.util.find_library(name)
+    if path is None:
+        return None
+    try:
+        library = ctypes.CDLL(path, use_errno=True)
+    except OSError:
+        return None
+    for function, (restype, argtypes) in functions.items():
+        getattr(library, function).restype = restype
+        getattr(library, function).argtypes = argtypes
+    return library
+
+_p = ctypes.c_void_p
+_XLIB_FUNCTIONS = {
+    "XOpenDisplay": (_p, [ctypes.c_char_p]),
+    "XDefaultScreen": (ctypes.c_int, [_p]),
+    "XDefaultRootWindow": (ctypes.c_ulong, [_p]),
+    "XDefaultVisual": (_p, [_p, ctypes.c_int]),
+    "XDefaultDepth": (ctypes.c_int, [_p, ctypes.c_int]),
+    "XDisplayWidth": (ctypes.c_int, [_p, ctypes.c_int]),
+    "XDisplayHeight": (ctypes.c_int, [_p, ctypes.c_int]),
+    "XSetErrorHandler": (_p, [XErrorHandler]),
+    "XSync": (ctypes.c_int, [_p, ctypes.c_int]),
+    "XFlush": (ctypes.c_int, [_p]),
+    "XFree": (ctypes.c_int, [_p]),
+    "XGetImage": (ctypes.POINTER(XImage), [
+        _p, ctypes.c_ulong, ctypes.c_int, ctypes.c_int, ctypes.c_uint, ctypes.c_uint, ctypes.c_ulong, ctypes.c_int]),
+    "XDestroyImage": (ctypes.c_int, [ctypes.POINTER(XImage)]),
+    "XInternAtom": (ctypes.c_ulong, [_p, ctypes.c_char_p, ctypes.c_int]),
+    "XGetWindowProperty": (ctypes.c_int, [
+        _p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_long, ctypes.c_long, ctypes.c_int, ctypes.c_ulong,
+        ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong),
+        ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(_p)]),
+    "XFetchName": (ctypes.c_int, [_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_char_p)]),
+    "XQueryTree": (ctypes.c_int, [
+        _p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong),
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_ulong)), ctypes.POINTER(ctypes.c_uint)]),
+    "XGetWindowAttributes": (ctypes.c_int, [_p, ctypes.c_ulong, ctypes.POINTER(XWindowAttributes)]),
+    "XTranslateCoordinates": (ctypes.c_int, [
+        _p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong)]),
+    "XMapRaised": (ctypes.c_int, [_p, ctypes.c_ulong]),
+    "XSetInputFocus": (ctypes.c_int, [_p, ctypes.c_ulong, ctypes.c_int, ctypes.c_ulong]),
+    "XGetInputFocus": (ctypes.c_int, [_p, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_int)]),
+}
+_XEXT_FUNCTIONS = {
+    "XShmQueryExtension": (ctypes.c_int, [_p]),
+    "XShmCreateImage": (ctypes.POINTER(XImage), [
+        _p, _p, ctypes.c_uint, ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(XShmSegmentInfo),
+        ctypes.c_uint, ctypes.c_uint]),
+    "XShmAttach": (ctypes.c_int, [_p, ctypes.POINTER(XShmSegmentInfo)]),
+    "XShmDetach": (ctypes.c_int, [_p, ctypes.POINTER(XShmSegmentInfo)]),
+    "XShmGetImage": (ctypes.c_int, [_p, ctypes.c_ulong, ctypes.POINTER(XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong]),
+}
+_XINERAMA_FUNCTIONS = {
+    "XineramaIsActive": (ctypes.c_int, [_p]),
+    "XineramaQueryScreens": (ctypes.POINTER(XineramaScreenInfo), [_p, ctypes.POINTER(ctypes.c_int)]),
+}
+_LIBC_FUNCTIONS = {
+    "shmget": (ctypes.c_int, [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]),
+    "shmat": (_p, [ctypes.c_int, _p, ctypes.c_int]),
+    "shmdt": (ctypes.c_int, [_p]),
+    "shmctl": (ctypes.c_int, [ctypes.c_int, ctypes.c_int, _p]),
+}
+
+# Xlib's default error handler exits the process, so errors (a window that closed while it
+# was being inspected, for instance) are logged instead, and the failing call's status is
+# checked. The last error code is kept for the calls that only fail asynchronously.
+_x_errors = []
+def _onXError(display, event):
+    _x_errors.append(event.contents.error_code)
+    Debug.log(3, "X error {} (request {}.{})".format(
+        event.contents.error_code,
+        event.contents.request_code,
+        event.contents.minor_code))
+    return 0
+_x_error_handler = XErrorHandler(_onXError)
+
+class PlatformManagerLinux(object):
+    """ Abstracts Linux-specific OS-level features, through Xlib on the display in ``$DISPLAY``
+
+    Runs on any X server, including a headless ``Xvfb`` (with a 24-bit screen, e.g.
+    ``Xvfb :99 -screen 0 1920x1080x24``). Xlib calls from different threads are serialized
+    on a single connection.
+
+    The display is opened on first use rather than on import, so Lackey can be imported
+    (for documentation or tooling, say) on machines without one.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._xlib = None
+        self._display = None
+        self._screen = None
+        self._root = None
+        self._xinerama = None
+        self._atoms = {}
+        self._capture_backend = None
+        self._frame_cache = FrameCache()
+
+    def _connect(self):
+        """ Opens the X display, if it isn't open yet
+
+        Raises ``OSError`` if libX11 is missing or the display can't be opened.
+        """
+        with self._lock:
+            if self._display is not None:
+                return
+            xlib = _loadLibrary("X11", _XLIB_FUNCTIONS)
+            if xlib is None:
+                raise OSError("Lackey requires libX11 on Linux")
+            xlib.XSetErrorHandler(_x_error_handler)
+            display = xlib.XOpenDisplay(None)
+            if not display:
+                raise OSError(
+                    "Could not open X display {} (set LACKEY_PLATFORM=virtual to run without "
+                    "a display)".format(os.environ.get("DISPLAY")))
+            self._xlib = xlib
+            self._display = display
+            self._screen = xlib.XDefaultScreen(display)
+            self._root = xlib.XDefaultRootWindow(display)
+            # Monitor layout (optional: without Xinerama, the root window is a single screen)
+            self._xinerama = _loadLibrary("Xinerama", _XINERAMA_FUNCTIONS)
+
+            if self._capture_backend is None:
+                xext = _loadLibrary("Xext", _XEXT_FUNCTIONS)
+                if xext is not None and xext.XShmQueryExtension(display):
+                    try:
+                        backend = XShmCaptureBackend(xlib, xext, display, self._lock)
+                        backend.capture(0, 0, 1, 1)
+                        self._capture_backend = backend
+                    except OSError as e:
+                        # Typically a remote display, which can't share memory with this process
+                        Debug.log(3, "MIT-SHM unavailable ({}), using XGetImage".format(e))
+            if self._capture_backend is None:
+                self._capture_backend = XGetImageCaptureBackend(xlib, display, self._lock)
+
+    def getClock(self):
+        """ Returns the clock that waits and timeouts are measured by (the ``time`` module) """
+        return time
+
+    ## Screen functions
+
+    def getBitmapFromRect(self, x, y, w, h):
+        """ Capture the specified area of the (virtual) screen.
+
+        Only the pixels of the requested area (limited to the virtual screen) are read.
+        Returns a writable array (see ``getSharedBitmapFromRect()``).
+        """
+        return toWritable(self.getSharedBitmapFromRect(x, y, w, h))
+    def getSharedBitmapFromRect(self, x, y, w, h):
+        """ Like ``getBitmapFromRect()``, but captures are shared for ``Settings.FrameCacheTTL``
+        seconds, so the returned array may be a read-only view of a recent frame """
+        x, y, w, h = clipToRect((x, y, w, h), self._getVirtualScreenRect())
+        if w <= 0 or h <= 0:
+            return numpy.zeros((max(h, 0), max(w, 0), 3), dtype=numpy.uint8)
+        return self._frame_cache.getBitmap((x, y, w, h), self._capture_backend.capture)
+    def setCaptureBackend(self, backend):
+        """ Replaces the backend used to read pixels from the screen """
+        if not isinstance(backend, CaptureBackend):
+            raise TypeError("Expected a CaptureBackend object")
+        self._capture_backend = backend
+        self._frame_cache.invalidate()
+    def getCaptureBackend(self):
+        """ Returns the backend used to read pixels from the screen """
+        if self._capture_backend is None:
+            self._connect()
+        return self._capture_backend
+    def getFrameCacheStats(self):
+        """ Returns the frame cache's hit and miss counters as a dict """
+        return self._frame_cache.getStats()
+    def resetFrameCache(self):
+        """ Discards cached frames and resets the frame cache's counters """
+        self._frame_cache.invalidate()
+        self._frame_cache.resetStats()
+    def getScreenBounds(self, screenId):
+        """ Returns the screen size of the specified monitor (0 being the main monitor). """
+        screen_details = self.getScreenDetails()
+        if not isinstance(screenId, int) or screenId < -1 or screenId >= len(screen_details):
+            raise ValueError("Invalid screen ID")
+        if screenId == -1:
+            # -1 represents the entire virtual screen
+            return self._getVirtualScreenRect()
+        return screen_details[screenId]["rect"]
+    def getScreenDetails(self):
+        """ Return list of attached monitors
+
+        For each monitor (as dict), ``monitor["rect"]`` represents the screen as positioned
+        in virtual screen. List is returned in device order, with the first element (0)
+        representing the primary monitor.
+        """
+        self._connect()
+        rects = []
+        with self._lock:
+            if self._xinerama is not None and self._xinerama.XineramaIsActive(self._display):
+                count = ctypes.c_int()
+                infos = self._xinerama.XineramaQueryScreens(self._display, ctypes.byref(count))
+                if infos:
+                    rects = [(i.x_org, i.y_org, i.width, i.height) for i in infos[:count.value]]
+                    self._xlib.XFree(infos)
+        if not rects:
+            rects = [self._getVirtualScreenRect()]
+        # The primary monitor is the one at the origin
+        rects.sort(key=lambda rect: not (rect[0] == 0 and rect[1] == 0))
+        return [{"rect": rect} for rect in rects]
+    def isPointVisible(self, x, y):
+        """ Checks if a point is visible on any monitor. """
+        for screen in self.getScreenDetails():
+            s_x, s_y, s_w, s_h = screen["rect"]
+            if (s_x <= x < (s_x + s_w)) and (s_y <= y < (s_y + s_h)):
+                return True
+        return False
+    def _getVirtualScreenRect(self):
+        """ Returns the rect of the root window (which spans all monitors) as (x, y, w, h) """
+        self._connect()
+        with self._lock:
+            return (0,
+                    0,
+                    self._xlib.XDisplayWidth(self._display, self._screen),
+                    self._xlib.XDisplayHeight(self._display, self._screen))
+
+    ## Clipboard functions
+
+    def osCopy(self):
+        """ Triggers the OS "copy" keyboard shortcut """
+        from .InputEmulation import Keyboard
+        k = Keyboard()
+        k.keyDown("{CTRL}")
+        k.type("c")
+        k.keyUp("{CTRL}")
+    def osPaste(self):
+        """ Triggers the OS "paste" keyboard shortcut """
+        from .InputEmulation import Keyboard
+        k = Keyboard()
+        k.keyDown("{CTRL}")
+        k.type("v")
+        k.keyUp("{CTRL}")
+
+    ## Window functions
+
+    def getWindowByTitle(self, wildcard, order=0):
+        """ Returns a handle for the first window that matches the provided "wildcard" regex """
+        for hwnd in self._getWindowList():
+            title = self.getWindowTitle(hwnd)
+            if title is not None and re.search(wildcard, title, flags=re.I):
+                # Matches - make sure we get it in the correct order
+                if order == 0:
+                    return hwnd
+                order -= 1
+        return None
+    def getWindowByPID(self, pid, order=0):
+        """ Returns a handle for the first window that matches the provided PID """
+        if pid <= 0:
+            return None
+        for hwnd in self._getWindowList():
+            if self.getWindowPID(hwnd) == pid:
+                # Matches - make sure we get it in the correct order
+                if order == 0:
+                    return hwnd
+                order -= 1
+        return None
+    def getWindowRect(self, hwnd):
+        """ Returns a rect (x,y,w,h) for the specified window's area """
+        self._connect()
+        attributes = XWindowAttributes()
+        x = ctypes.c_int()
+        y = ctypes.c_int()
+        child = ctypes.c_ulong()
+        with self._lock:
+            if not self._xlib.XGetWindowAttributes(self._display, hwnd, ctypes.byref(attributes)):
+                return None
+            if not self._xlib.XTranslateCoordinates(
+                    self._display, hwnd, self._root, 0, 0, ctypes.byref(x), ctypes.byref(y), ctypes.byref(child)):
+                return None
+        return (x.value, y.value, attributes.width, attributes.height)
+    def focusWindow(self, hwnd):
+        """ Brings specified window to the front """
+        self._connect()
+        Debug.log(3, "Focusing window: " + str(hwnd))
+        CURRENT_TIME = 0
+        with self._lock:
+            self._xlib.XMapRaised(self._display, hwnd)
+            self._xlib.XSetInputFocus(self._display, hwnd, REVERT_TO_PARENT, CURRENT_TIME)
+            self._xlib.XFlush(self._display)
+    def getWindowTitle(self, hwnd):
+        """ Gets the title for the specified window """
+        self._connect()
+        title = self._getProperty(hwnd, "_NET_WM_NAME", self._getAtom("UTF8_STRING"))
+        if title is not None:
+            return title.decode("utf-8", "replace")
+        name = ctypes.c_char_p()
+        with self._lock:
+            if not self._xlib.XFetchName(self._display, hwnd, ctypes.byref(name)) or not name.value:
+                return None
+            title = name.value
+            self._xlib.XFree(name)
+        return title.decode("latin-1")
+    def getWindowPID(self, hwnd):
+        """ Gets the process ID that the specified window belongs to """
+        pid = self._getProperty(hwnd, "_NET_WM_PID", XA_CARDINAL)
+        return int(pid[0]) if pid else None
+    def getForegroundWindow(self):
+        """ Returns a handle to the window in the foreground """
+        self._connect()
+        active = self._getProperty(self._root, "_NET_ACTIVE_WINDOW", XA_WINDOW)
+        if active and active[0]:
+            return int(active[0])
+        window = ctypes.c_ulong()
+        revert_to = ctypes.c_int()
+        with self._lock:
+            self._xlib.XGetInputFocus(self._display, ctypes.byref(window), ctypes.byref(revert_to))
+        return window.value
+
+    def _getAtom(self, name):
+        """ Returns the X atom for ``name`` """
+        self._connect()
+        with self._lock:
+            if name not in self._atoms:
+                self._atoms[name] = self._xlib.XInternAtom(self._display, name.encode("ascii"), False)
+            return self._atoms[name]
+    def _getProperty(self, window, name, property_type):
+        """ Returns the value of the window property ``name``, or None if it isn't set
+
+        32-bit properties are returned as a list of ints, and others as a byte string.
+        """
+        self._connect()
+        actual_type = ctypes.c_ulong()
+        actual_format = ctypes.c_int()
+        count = ctypes.c_ulong()
+        bytes_after = ctypes.c_ulong()
+        data = ctypes.c_void_p()
+        MAX_LENGTH = 0x10000 # In 32-bit units
+        SUCCESS = 0
+        with self._lock:
+            status = self._xlib.XGetWindowProperty(
+                self._display,
+                window,
+                self._getAtom(name),
+                0,
+                MAX_LENGTH,
+                False,
+                property_type,
+                ctypes.byref(actual_type),
+                ctypes.byref(actual_format),
+                ctypes.byref(count),
+                ctypes.byref(bytes_after),
+                ctypes.byref(data))
+            if status != SUCCESS or not data.value:
+                return None
+            try:
+                if actual_type.value != property_type:
+                    return None
+                if actual_format.value == 32:
+                    # Xlib returns 32-bit items as C longs
+                    return list(ctypes.cast(data, ctypes.POINTER(ctypes.c_ulong))[:count.value])
+                return ctypes.string_at(data, count.value * actual_format.value // 8)
+            finally:
+                self._xlib.XFree(data)
+    def _getWindowList(self):
+        """ Returns the handles of the top-level windows, topmost first """
+        self._connect()
+        windows = self._getProperty(self._root, "_NET_CLIENT_LIST_STACKING", XA_WINDOW)
+        if windows is None:
+            windows = self._getProperty(self._root, "_NET_CLIENT_LIST", XA_WINDOW)
+        if windows is not None:
+            # Stacking order is bottom to top
+            return [int(hwnd) for hwnd in reversed(windows)]
+        # Without a (EWMH-compliant) window manager, as on a bare Xvfb, use the visible
+        # children of the root window
+        root = ctypes.c_ulong()
+        parent = ctypes.c_ulong()
+        children = ctypes.POINTER(ctypes.c_ulong)()
+        count = ctypes.c_uint()
+        with self._lock:
+            if not self._xlib.XQueryTree(
+                    self._display, self._root, ctypes.byref(root), ctypes.byref(parent),
+                    ctypes.byref(children), ctypes.byref(count)):
+                return []
+            windows = list(children[:count.value]) if children else []
+            if children:
+                self._xlib.XFree(children)
+            visible = []
+            for hwnd in reversed(windows):
+                attributes = XWindowAttributes()
+                if (self._xlib.XGetWindowAttributes(self._display, hwnd, ctypes.byref(attributes))
+                        and attributes.map_state == IS_VIEWABLE):
+                    visible.append(int(hwnd))
+        return visible
+
+    ## Highlighting functions
+
+    def highlight(self, rect, color="red", seconds=None):
+        """ Simulates a transparent rectangle over the specified ``rect`` on the screen.
+
+        Actually takes a screenshot of the region and displays with a
+        rectangle border in a borderless window (due to Tkinter limitations)
+
+        If a Tkinter root window has already been created somewhere else,
+        uses that instead of creating a new one.
+        """
+        if tk._default_root is None:
+            Debug.log(3, "Creating new temporary Tkinter root")
+            root = tk.Tk()
+            root.withdraw()
+        else:
+            Debug.log(3, "Borrowing existing Tkinter root")
+            root = tk._default_root
+        image_to_show = self.getSharedBitmapFromRect(*rect)
+        app = highlightWindow(root, rect, color, image_to_show)
+        if seconds == 0:
+            t = threading.Thread(target=app.do_until_timeout)
+            t.start()
+            return app
+        app.do_until_timeout(seconds)
+
+    ## Process functions
+
+    def isPIDValid(self, pid):
+        """ Checks if a PID is associated with a running process """
+        try:
+            os.kill(pid, 0) # Does nothing if valid, raises exception otherwise
+        except OSError as e:
+            # EPERM: the process exists, but belongs to another user
+            return e.errno == errno.EPERM
+        return True
+    def killProcess(self, pid):
+        """ Kills the process with the specified PID (if possible) """
+        os.kill(pid, signal.SIGTERM)
+    def getProcessName(self, pid):
+        """ Returns the name of the executable running as the given PID """
+        if pid <= 0:
+            return ""
+        try:
+            return os.path.basename(os.readlink("/proc/{}/exe".format(pid)))
+        except OSError:
+            # Processes of other users can't be inspected, but their name is public
+            try:
+                with open("/proc/{}/comm".format(pid)) as comm:
+                    return comm.read().strip()
+            except (IOError, OSError):
+                return ""
+
+## Screen capture backends
+
+def _toBGR(image, w, h):
+    """ Converts the pixels of a 32-bit ZPixmap ``XImage`` to a BGR numpy array """
+    if image.bits_per_pixel != 32:
+        raise OSError("Unsupported display depth ({} bits per pixel); use a 24-bit screen".format(
+            image.bits_per_pixel))
+    buffer_type = ctypes.c_uint8 * (image.bytes_per_line * h)
+    pixels = numpy.frombuffer(buffer_type.from_address(image.data), dtype=numpy.uint8)
+    pixels = pixels.reshape((h, image.bytes_per_line // 4, 4))[:, :w]
+    if image.byte_order == LSB_FIRST and image.red_mask == 0xFF0000:
+        # Memory layout is BGRX
+        return cv2.cvtColor(pixels, cv2.COLOR_BGRA2BGR)
+    if image.byte_order == LSB_FIRST and image.red_mask == 0xFF:
+        return cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGR)
+    raise OSError("Unsupported pixel format (red mask {:#x}, byte order {})".format(
+        image.red_mask, image.byte_order))
+
+class XShmCaptureBackend(CaptureBackend):
+    """ Reads a rect of the screen through an MIT-SHM shared memory segment
+
+    The X server writes the pixels straight into memory shared with this process, instead of
+    sending them over its connection, so the only copy made is the conversion to BGR. A
+    segment is kept for each of the last few rect sizes captured, since scripts usually poll
+    the same few regions.
+    """
+    def __init__(self, xlib, xext, display, lock, max_segments=4):
+        self._xlib = xlib
+        self._xext = xext
+        self._display = display
+        self._lock = lock
+        self._max_segments = max_segments
+        self._libc = _loadLibrary("c", _LIBC_FUNCTIONS)
+        if self._libc is None:
+            raise OSError("libc not found")
+        screen = xlib.XDefaultScreen(display)
+        self._root = xlib.XDefaultRootWindow(display)
+        self._visual = xlib.XDefaultVisual(display, screen)
+        self._depth = xlib.XDefaultDepth(display, screen)
+        self._segments = [] # List of ((w, h), image, shminfo), most recently used last
+
+    def capture(self, x, y, w, h):
+        """ Captures the rect (x, y, w, h) of the virtual screen
+
+        Returns a numpy array (BGR channel order, for compatibility with OpenCV)
+        """
+        with self._lock:
+            image, shminfo = self._getSegment(w, h)
+            if not self._xext.XShmGetImage(self._display, self._root, image, x, y, ALL_PLANES):
+                raise OSError("XShmGetImage failed")
+            return _toBGR(image.contents, w, h)
+    def close(self):
+        """ Detaches and frees the shared memory segments """
+        with self._lock:
+            for _, image, shminfo in self._segments:
+                self._release(image, shminfo)
+            self._segments = []
+
+    def _getSegment(self, w, h):
+        """ Returns an ``(XImage, XShmSegmentInfo)`` pair attached to a segment for a w*h rect """
+        for i, (size, image, shminfo) in enumerate(self._segments):
+            if size == (w, h):
+                # Move to the end to mark as most recently used
+                self._segments.append(self._segments.pop(i))
+                return (image, shminfo)
+        shminfo = XShmSegmentInfo()
+        image = self._xext.XShmCreateImage(
+            self._display, self._visual, self._depth, Z_PIXMAP, None, ctypes.byref(shminfo), w, h)
+        if not image:
+            raise OSError("XShmCreateImage failed")
+        shminfo.shmid = self._libc.shmget(IPC_PRIVATE, image.contents.bytes_per_line * h, IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            # Read errno before any other call (Xlib's included) replaces it
+            error = ctypes.get_errno()
+            self._xlib.XDestroyImage(image)
+            raise OSError(error, "shmget failed")
+        address = self._libc.shmat(shminfo.shmid, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            error = ctypes.get_errno()
+            self._libc.shmctl(shminfo.shmid, IPC_RMID, None)
+            self._xlib.XDestroyImage(image)
+            raise OSError(error, "shmat failed")
+        shminfo.shmaddr = address
+        shminfo.readOnly = False
+        image.contents.data = address
+        del _x_errors[:]
+        attached = self._xext.XShmAttach(self._display, ctypes.byref(shminfo))
+        self._xlib.XSync(self._display, False)
+        # Removed once both sides detach, so the segment can't outlive this process
+        self._libc.shmctl(shminfo.shmid, IPC_RMID, None)
+        if not attached or _x_errors:
+            self._xlib.XDestroyImage(image)
+            self._libc.shmdt(address)
+            raise OSError("XShmAttach failed")
+        self._segments.append(((w, h), image, shminfo))
+        while len(self._segments) > self._max_segments:
+            _, old_image, old_shminfo = self._segments.pop(0)
+            self._release(old_image, old_shminfo)
+        return (image, shminfo)
+    def _release(self, image, shminfo):
+        self._xext.XShmDetach(self._display, ctypes.byref(shminfo))
+        self._xlib.XSync(self._display, False)
+        # Shared memory images don't free their data
+        self._xlib.XDestroyImage(image)
+        self._libc.shmdt(shminfo.shmaddr)
+
+class XGetImageCaptureBackend(CaptureBackend):
+    """ Reads a rect of the screen with ``XGetImage``, for displays without MIT-SHM (such as
+    remote displays) """
+    def __init__(self, xlib, display, lock):
+        self._xlib = xlib
+        self._display = display
+        self._lock = lock
+        self._root = xlib.XDefaultRootWindow(display)
+
+    def capture(self, x, y, w, h):
+        """ Captures the rect (x, y, w, h) of the virtual screen
+
+        Returns a numpy array (BGR channel order, for compatibility with OpenCV)
+        """
+        with self._lock:
+            image = self._xlib.XGetImage(self._display, self._root, x, y, w, h, ALL_PLANES, Z_PIXMAP)
+            if not image:
+                raise OSError("XGetImage failed")
+            try:
+                return _toBGR(image.contents, w, h)
+            finally:
+                self._xlib.XDestroyImage(image)
+
+## Helper class for highlighting
+
+class highlightWindow(tk.Toplevel):
+    def __init__(self, root, rect, frame_color, screen_cap):
+        """ Accepts rect as (x,y,w,h) """
+        self.root = root
+        tk.Toplevel.__init__(self, self.root, bg="red", bd=0)
+
+        ## Set toplevel geometry, remove borders, and push to the front
+        self.geometry("{2}x{3}+{0}+{1}".format(*rect))
+        self.overrideredirect(1)
+        self.attributes("-topmost", True)
+
+        ## Create canvas and fill it with the provided image. Then draw rectangle outline
+        self.canvas = tk.Canvas(
+            self,
+            width=rect[2],
+            height=rect[3],
+            bd=0,
+            bg="blue",
+            highlightthickness=0)
+        self.tk_image = ImageTk.PhotoImage(Image.fromarray(screen_cap[..., [2, 1, 0]]))
+        self.canvas.create_image(0, 0, image=self.tk_image, anchor=tk.NW)
+        self.canvas.create_rectangle(
+            2,
+            2,
+            rect[2]-2,
+            rect[3]-2,
+            outline=frame_color,
+            width=4)
+        self.canvas.pack(fill=tk.BOTH, expand=tk.YES)
+
+        ## Lift to front if necessary and refresh.
+        self.lift()
+        self.update()
+    def do_until_timeout(self, seconds=None):
+        if seconds is not None:
+            self.root.after(seconds*1000, self.root.destroy)
+        self.root.mainloop()
+
+    def close(self):
+        self.root.destroy()
@@ -0,0 +1,303 @@
+""" Virtual, display-less platform, for running Lackey in tests, benchmarks, and CI containers.
+
+Selected instead of the OS platform by setting the ``LACKEY_PLATFORM`` environment variable
+to ``virtual`` before importing Lackey.
+"""
+
+import os
+import re
+import threading
+
+import numpy
+import cv2
+
+from .SettingsDebug import Debug
+from .ScreenCapture import CaptureBackend, FrameSequenceBackend, FrameCache, clipToRect, toWritable
+from .InputEmulation import InputRecorder, setInputDevices
+
+class VirtualClock(object):
+    """ Clock that only advances when slept on (or advanced explicitly)
+
+    Implements the ``time()`` and ``sleep()`` functions of the ``time`` module, so waits,
+    timeouts, and scan intervals take no real time, and scripted frames appear exactly when
+    they are scheduled to.
+    """
+    def __init__(self, start=0.0):
+        self._now = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        """ Returns the current time in seconds """
+        with self._lock:
+            return self._now
+    def sleep(self, seconds):
+        """ Advances the clock by ``seconds``, returning immediately """
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        self.advance(seconds)
+    def advance(self, seconds):
+        """ Moves the clock forward by ``seconds`` """
+        with self._lock:
+            self._now += seconds
+
+class _VirtualHighlight(object):
+    """ Stands in for a highlight window """
+    def __init__(self, manager, rect):
+        self._manager = manager
+        self._rect = rect
+    def close(self):
+        self._manager._input.record("screen", "unhighlight", self._rect)
+
+class PlatformManagerVirtual(object):
+    """ Platform with a scripted screen and recorded input
+
+    The screen shows the frames given with ``setFrame()`` or ``addFrame()`` (BGR numpy
+    arrays or image files), scheduled on a ``VirtualClock`` (see ``getClock()``), and is a
+    single monitor of the size given by ``LACKEY_VIRTUAL_SCREEN`` (e.g. ``1280x720``;
+    ``1920x1080`` by default) unless changed with ``setScreens()``. Mouse and keyboard input
+    is recorded rather than sent (see ``getInputEvents()``), as are window focus changes and
+    highlights. Windows are scripted with ``addWindow()``.
+    """
+    def __init__(self, clock=None):
+        self._clock = clock if clock is not None else VirtualClock()
+        size = os.environ.get("LACKEY_VIRTUAL_SCREEN", "1920x1080")
+        match = re.match(r"^(\d+)x(\d+)$", size)
+        if match is None:
+            raise ValueError("Invalid LACKEY_VIRTUAL_SCREEN size: {}".format(size))
+        self._screens = [(0, 0, int(match.group(1)), int(match.group(2)))]
+        self._windows = [] # List of dicts with "title", "rect", and "pid", topmost first
+        self._next_hwnd = 1
+        self._foreground = None
+        self._capture_backend = FrameSequenceBackend(clock=self._clock)
+        self._frame_cache = FrameCache(clock=self._clock)
+        self._input = InputRecorder(self._clock)
+        setInputDevices(self._input.mouse, self._input.keyboard, self._clock)
+
+    def getClock(self):
+        """ Returns the clock that waits and timeouts are measured by """
+        return self._clock
+    def getInputEvents(self):
+        """ Returns the recorded input events (see ``InputRecorder.getEvents()``) """
+        return self._input.getEvents()
+    def clearInputEvents(self):
+        """ Discards the recorded input events """
+        self._input.clear()
+
+    ## Screen functions
+
+    def setFrame(self, image):
+        """ Shows ``image`` (a BGR numpy array, or the path of an image file) from now on,
+        discarding any scheduled frames """
+        self._capture_backend.setFrame(self._toFrame(image))
+        self._frame_cache.invalidate()
+    def addFrame(self, image, start=None):
+        """ Schedules ``image`` (a BGR numpy array, or the path of an image file) to be shown
+        from time ``start`` on (by the clock; by default, from now on) """
+        self._capture_backend.addFrame(self._toFrame(image), start)
+        self._frame_cache.invalidate()
+    def _toFrame(self, image):
+        if isinstance(image, numpy.ndarray):
+            return image
+        frame = cv2.imread(image)
+        if frame is None:
+            raise ValueError("Unable to read image file: {}".format(image))
+        return frame
+    def setScreens(self, rects):
+        """ Replaces the monitors with the given rects (x, y, w, h), the first being the
+        primary monitor
+
+        If this is the platform Regions use, their cached monitor layout is discarded too.
+        """
+        if not rects:
+            raise ValueError("Expected at least one screen")
+        self._screens = [tuple(rect) for rect in rects]
+        self._frame_cache.invalidate()
+        from .RegionMatching import PlatformManager, Screen
+        if PlatformManager is self:
+            Screen.getTopology().invalidate()
+
+    def getBitmapFromRect(self, x, y, w, h):
+        """ Capture the specified area of the (virtual) screen.
+
+        Areas not covered by the current frame are black.
+        Returns a writable array (see ``getSharedBitmapFromRect()``).
+        """
+        return toWritable(self.getSharedBitmapFromRect(x, y, w, h))
+    def getSharedBitmapFromRect(self, x, y, w, h):
+        """ Like ``getBitmapFromRect()``, but captures are shared for ``Settings.FrameCacheTTL``
+        seconds (by the clock), so the returned array may be a read-only view of a recent frame """
+        x, y, w, h = clipToRect((x, y, w, h), self._getVirtualScreenRect())
+        if w <= 0 or h <= 0:
+            return numpy.zeros((max(h, 0), max(w, 0), 3), dtype=numpy.uint8)
+        return self._frame_cache.getBitmap((x, y, w, h), self._capture_backend.capture)
+    def setCaptureBackend(self, backend):
+        """ Replaces the backend used to read pixels from the screen """
+        if not isinstance(backend, CaptureBackend):
+            raise TypeError("Expected a CaptureBackend object")
+        self._capture_backend = backend
+        self._frame_cache.invalidate()
+    def getCaptureBackend(self):
+        """ Returns the backend used to read pixels from the screen """
+        return self._capture_backend
+    def getFrameCacheStats(self):
+        """ Returns the frame cache's hit and miss counters as a dict """
+        return self._frame_cache.getStats()
+    def resetFrameCache(self):
+        """ Discards cached frames and resets the frame cache's counters """
+        self._frame_cache.invalidate()
+        self._frame_cache.resetStats()
+    def getScreenBounds(self, screenId):
+        """ Returns the screen size of the specified monitor (0 being the main monitor). """
+        screen_details = self.getScreenDetails()
+        if not isinstance(screenId, int) or screenId < -1 or screenId >= len(screen_details):
+            raise ValueError("Invalid screen ID")
+        if screenId == -1:
+            # -1 represents the entire virtual screen
+            return self._getVirtualScreenRect()
+        return screen_details[screenId]["rect"]
+    def getScreenDetails(self):
+        """ Return list of attached monitors
+
+        For each monitor (as dict), ``monitor["rect"]`` represents the screen as positioned
+        in virtual screen. List is returned in device order, with the first element (0)
+        representing the primary monitor.
+        """
+        return [{"rect": rect} for rect in self._screens]
+    def isPointVisible(self, x, y):
+        """ Checks if a point is visible on any monitor. """
+        for screen in self.getScreenDetails():
+            s_x, s_y, s_w, s_h = screen["rect"]
+            if (s_x <= x < (s_x + s_w)) and (s_y <= y < (s_y + s_h)):
+                return True
+        return False
+    def _getVirtualScreenRect(self):
+        """ Returns the rect of all attached screens as (x, y, w, h) """
+        min_x = min(rect[0] for rect in self._screens)
+        min_y = min(rect[1] for rect in self._screens)
+        max_x = max(rect[0]+rect[2] for rect in self._screens)
+        max_y = max(rect[1]+rect[3] for rect in self._screens)
+        return (min_x, min_y, max_x-min_x, max_y-min_y)
+
+    ## Clipboard functions
+
+    def osCopy(self):
+        """ Triggers the OS "copy" keyboard shortcut (recorded as keyboard input) """
+        from .InputEmulation import Keyboard
+        k = Keyboard()
+        k.keyDown("{CTRL}")
+        k.type("c")
+        k.keyUp("{CTRL}")
+    def osPaste(self):
+        """ Triggers the OS "paste" keyboard shortcut (recorded as keyboard input) """
+        from .InputEmulation import Keyboard
+        k = Keyboard()
+        k.keyDown("{CTRL}")
+        k.type("v")
+        k.keyUp("{CTRL}")
+
+    ## Window functions
+
+    def addWindow(self, title, rect, pid=None):
+        """ Opens a scripted window on top of the others, and returns its handle
+
+        ``pid`` defaults to the current process.
+        """
+        hwnd = self._next_hwnd
+        self._next_hwnd += 1
+        self._windows.insert(0, {
+            "hwnd": hwnd,
+            "title": title,
+            "rect": tuple(rect),
+            "pid": pid if pid is not None else os.getpid()})
+        self._foreground = hwnd
+        return hwnd
+    def removeWindow(self, hwnd):
+        """ Closes a scripted window """
+        self._windows = [window for window in self._windows if window["hwnd"] != hwnd]
+        if self._foreground == hwnd:
+            self._foreground = self._windows[0]["hwnd"] if self._windows else None
+    def _getWindow(self, hwnd):
+        for window in self._windows:
+            if window["hwnd"] == hwnd:
+                return window
+        return None
+
+    def getWindowByTitle(self, wildcard, order=0):
+        """ Returns a handle for the first window that matches the provided "wildcard" regex """
+        for window in self._windows:
+            if re.search(wildcard, window["title"], flags=re.I):
+                # Matches - make sure we get it in the correct order
+                if order == 0:
+                    return window["hwnd"]
+                order -= 1
+        return None
+    def getWindowByPID(self, pid, order=0):
+        """ Returns a handle for the first window that matches the provided PID """
+        for window in self._windows:
+            if window["pid"] == pid:
+                # Matches - make sure we get it in the correct order
+                if order == 0:
+                    return window["hwnd"]
+                order -= 1
+        return None
+    def getWindowRect(self, hwnd):
+        """ Returns a rect (x,y,w,h) for the specified window's area """
+        window = self._getWindow(hwnd)
+        return window["rect"] if window is not None else None
+    def focusWindow(self, hwnd):
+        """ Brings specified window to the front """
+        Debug.log(3, "Focusing window: " + str(hwnd))
+        window = self._getWindow(hwnd)
+        if window is None:
+            return
+        self._windows.remove(window)
+        self._windows.insert(0, window)
+        self._foreground = hwnd
+        self._input.record("window", "focus", hwnd)
+    def getWindowTitle(self, hwnd):
+        """ Gets the title for the specified window """
+        window = self._getWindow(hwnd)
+        return window["title"] if window is not None else None
+    def getWindowPID(self, hwnd):
+        """ Gets the process ID that the specified window belongs to """
+        window = self._getWindow(hwnd)
+        return window["pid"] if window is not None else None
+    def getForegroundWindow(self):
+        """ Returns a handle to the window in the foreground """
+        return self._foreground
+
+    ## Highlighting functions
+
+    def highlight(self, rect, color="red", seconds=None):
+        """ Records a highlight of the specified ``rect`` on the screen.
+
+        As with the OS platforms, waits ``seconds`` (on the clock) unless ``seconds`` is 0,
+        in which case an object whose ``close()`` ends the highlight is returned.
+        """
+        rect = tuple(rect)
+        self._input.record("screen", "highlight", (rect, color))
+        highlight = _VirtualHighlight(self, rect)
+        if seconds == 0:
+            return highlight
+        if seconds is not None:
+            self._clock.sleep(seconds)
+        highlight.close()
+
+    ## Process functions
+
+    def isPIDValid(self, pid):
+        """ Checks if a PID belongs to this process or to a scripted window """
+        return pid == os.getpid() or self.getWindowByPID(pid) is not None
+    def killProcess(self, pid):
+        """ Closes the scripted windows of the process with the specified PID
+
+        No actual process is killed. """
+        self._input.record("process", "kill", pid)
+        for window in list(self._windows):
+            if window["pid"] == pid:
+                self.removeWindow(window["hwnd"])
+    def getProcessName(self, pid):
+        """ Returns the name of the process with the given PID (the title of its first
+        scripted window) """
+        hwnd = self.getWindowByPID(pid)
+        return self.getWindowTitle(hwnd) if hwnd is not None else ""
@@ -11,9 +11,10 @@ try:
 except ImportError:
     import tkinter as tk
 from ctypes import wintypes
-from PIL import Image, ImageTk, ImageOps
+from PIL import Image, ImageTk
 
 from .SettingsDebug import Debug
+from .ScreenCapture import CaptureBackend, FrameCache, clipToRect, toWritable
 
 # Python 3 compatibility
 try:
@@ -39,6 +40,8 @@ class PlatformManagerWindows(object):
         self._gdi32 = gdi32
         self._kernel32 = kernel32
         self._psapi = psapi
+        self._capture_backend = GdiCaptureBackend(user32, gdi32)
+        self._frame_cache = FrameCache()
 
         # Pay attention to different screen DPI settings
         self._user32.SetProcessDPIAware()
@@ -214,19 +217,41 @@ class PlatformManagerWindows(object):
             raise ctypes.WinError(ctypes.get_last_error())
         return args
 
+    def getClock(self):
+        """ Returns the clock that waits and timeouts are measured by (the ``time`` module) """
+        return time
+
     ## Screen functions
     def getBitmapFromRect(self, x, y, w, h):
-        """ Capture the specified area of the (virtual) screen. """
-        min_x, min_y, screen_width, screen_height = self._getVirtualScreenRect()
-        img = self._getVirtualScreenBitmap()
-        # Limit the coordinates to the virtual screen
-        # Then offset so 0,0 is the top left corner of the image
-        # (Top left of virtual screen could be negative)
-        x1 = min(max(min_x, x), min_x+screen_width) - min_x
-        y1 = min(max(min_y, y), min_y+screen_height) - min_y
-        x2 = min(max(min_x, x+w), min_x+screen_width) - min_x
-        y2 = min(max(min_y, y+h), min_y+screen_height) - min_y
-        return numpy.array(img.crop((x1, y1, x2, y2)))
+        """ Capture the specified area of the (virtual) screen.
+
+        Only the pixels of the requested area (limited to the virtual screen) are read.
+        Returns a writable array (see ``getSharedBitmapFromRect()``).
+        """
+        return toWritable(self.getSharedBitmapFromRect(x, y, w, h))
+    def getSharedBitmapFromRect(self, x, y, w, h):
+        """ Like ``getBitmapFromRect()``, but captures are shared for ``Settings.FrameCacheTTL``
+        seconds, so the returned array may be a read-only view of a recent frame """
+        x, y, w, h = clipToRect((x, y, w, h), self._getVirtualScreenRect())
+        if w <= 0 or h <= 0:
+            return numpy.zeros((max(h, 0), max(w, 0), 3), dtype=numpy.uint8)
+        return self._frame_cache.getBitmap((x, y, w, h), self._capture_backend.capture)
+    def setCaptureBackend(self, backend):
+        """ Replaces the backend used to read pixels from the screen """
+        if not isinstance(backend, CaptureBackend):
+            raise TypeError("Expected a CaptureBackend object")
+        self._capture_backend = backend
+        self._frame_cache.invalidate()
+    def getCaptureBackend(self):
+        """ Returns the backend used to read pixels from the screen """
+        return self._capture_backend
+    def getFrameCacheStats(self):
+        """ Returns the frame cache's hit and miss counters as a dict """
+        return self._frame_cache.getStats()
+    def resetFrameCache(self):
+        """ Discards cached frames and resets the frame cache's counters """
+        self._frame_cache.invalidate()
+        self._frame_cache.resetStats()
     def getScreenBounds(self, screenId):
         """ Returns the screen size of the specified monitor (0 being the main monitor). """
         screen_details = self.getScreenDetails()
@@ -270,134 +295,6 @@ class PlatformManagerWindows(object):
         if hmon == 0:
             return False
         return True
-    def _captureScreen(self, device_name):
-        """ Captures a bitmap from the given monitor device name
-
-        Returns as a PIL Image (BGR rather than RGB, for compatibility with OpenCV)
-        """
-
-        ## Define constants/structs
-        class HBITMAP(ctypes.Structure):
-            _fields_ = [("bmType", ctypes.c_long),
-                        ("bmWidth", ctypes.c_long),
-                        ("bmHeight", ctypes.c_long),
-                        ("bmWidthBytes", ctypes.c_long),
-                        ("bmPlanes", ctypes.wintypes.WORD),
-                        ("bmBitsPixel", ctypes.wintypes.WORD),
-                        ("bmBits", ctypes.wintypes.LPVOID)]
-        class BITMAPINFOHEADER(ctypes.Structure):
-            _fields_ = [("biSize", ctypes.wintypes.DWORD),
-                        ("biWidth", ctypes.c_long),
-                        ("biHeight", ctypes.c_long),
-                        ("biPlanes", ctypes.wintypes.WORD),
-                        ("biBitCount", ctypes.wintypes.WORD),
-                        ("biCompression", ctypes.wintypes.DWORD),
-                        ("biSizeImage", ctypes.wintypes.DWORD),
-                        ("biXPelsPerMeter", ctypes.c_long),
-                        ("biYPelsPerMeter", ctypes.c_long),
-                        ("biClrUsed", ctypes.wintypes.DWORD),
-                        ("biClrImportant", ctypes.wintypes.DWORD)]
-        class BITMAPINFO(ctypes.Structure):
-            _fields_ = [("bmiHeader", BITMAPINFOHEADER),
-                        ("bmiColors", ctypes.wintypes.DWORD*3)]
-        HORZRES = ctypes.c_int(8)
-        VERTRES = ctypes.c_int(10)
-        SRCCOPY =    0x00CC0020
-        CAPTUREBLT = 0x40000000
-        DIB_RGB_COLORS = 0
-
-        ## Begin logic
-        self._gdi32.CreateDCW.restype = ctypes.c_void_p
-        hdc = self._gdi32.CreateDCW(ctypes.c_wchar_p(str(device_name)), 0, 0, 0) # Convert to bytestring for c_wchar_p type
-        if hdc == 0:
-            raise ValueError("Empty hdc provided")
-
-        # Get monitor specs
-        self._gdi32.GetDeviceCaps.argtypes = [ctypes.c_void_p, ctypes.c_int]
-        screen_width = self._gdi32.GetDeviceCaps(hdc, HORZRES)
-        screen_height = self._gdi32.GetDeviceCaps(hdc, VERTRES)
-
-        # Create memory device context for monitor
-        self._gdi32.CreateCompatibleDC.restype = ctypes.c_void_p
-        self._gdi32.CreateCompatibleDC.argtypes = [ctypes.c_void_p]
-        hCaptureDC = self._gdi32.CreateCompatibleDC(hdc)
-        if hCaptureDC == 0:
-            raise WindowsError("gdi:CreateCompatibleDC failed")
-
-        # Create bitmap compatible with monitor
-        self._gdi32.CreateCompatibleBitmap.restype = ctypes.c_void_p
-        self._gdi32.CreateCompatibleBitmap.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
-        hCaptureBmp = self._gdi32.CreateCompatibleBitmap(hdc, screen_width, screen_height)
-        if hCaptureBmp == 0:
-            raise WindowsError("gdi:CreateCompatibleBitmap failed")
-
-        # Select hCaptureBmp into hCaptureDC device context
-        self._gdi32.SelectObject.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-        self._gdi32.SelectObject(hCaptureDC, hCaptureBmp)
-
-        # Perform bit-block transfer from screen to device context (and thereby hCaptureBmp)
-        self._gdi32.BitBlt.argtypes = [
-            ctypes.c_void_p,
-            ctypes.c_int,
-            ctypes.c_int,
-            ctypes.c_int,
-            ctypes.c_int,
-            ctypes.c_void_p,
-            ctypes.c_int,
-            ctypes.c_int,
-            ctypes.c_ulong
-        ]
-        self._gdi32.BitBlt(hCaptureDC, 0, 0, screen_width, screen_height, hdc, 0, 0, SRCCOPY | CAPTUREBLT)
-
-        # Capture image bits from bitmap
-        img_info = BITMAPINFO()
-        img_info.bmiHeader.biSize = ctypes.sizeof(BITMAPINFOHEADER)
-        img_info.bmiHeader.biWidth = screen_width
-        img_info.bmiHeader.biHeight = screen_height
-        img_info.bmiHeader.biPlanes = 1
-        img_info.bmiHeader.biBitCount = 32
-        img_info.bmiHeader.biCompression = 0
-        img_info.bmiHeader.biClrUsed = 0
-        img_info.bmiHeader.biClrImportant = 0
-
-        buffer_length = screen_width * 4 * screen_height
-        image_data = ctypes.create_string_buffer(buffer_length)
-
-        self._gdi32.GetDIBits.restype = ctypes.c_int
-        self._gdi32.GetDIBits.argtypes = [
-            ctypes.c_void_p,
-            ctypes.c_void_p,
-            ctypes.c_uint,
-            ctypes.c_uint,
-            ctypes.c_void_p,
-            ctypes.c_void_p,
-            ctypes.c_uint
-        ]
-        scanlines = self._gdi32.GetDIBits(
-            hCaptureDC,
-            hCaptureBmp,
-            0,
-            screen_height,
-            ctypes.byref(image_data),
-            ctypes.byref(img_info),
-            DIB_RGB_COLORS)
-        if scanlines != screen_height:
-            raise WindowsError("gdi:GetDIBits failed")
-        final_image = ImageOps.flip(
-            Image.frombuffer(
-                "RGBX",
-                (screen_width, screen_height),
-                image_data,
-                "raw",
-                "RGBX",
-                0,
-                1))
-        # Destroy created device context & GDI bitmap
-        self._gdi32.DeleteObject.argtypes = [ctypes.c_void_p]
-        self._gdi32.DeleteObject(hdc)
-        self._gdi32.DeleteObject(hCaptureDC)
-        self._gdi32.DeleteObject(hCaptureBmp)
-        return final_image
     def _getMonitorInfo(self):
         """ Returns info about the attached monitors, in device order
 
@@ -460,31 +357,6 @@ class PlatformManagerWindows(object):
                 self._user32.GetSystemMetrics(SM_YVIRTUALSCREEN), \
                 self._user32.GetSystemMetrics(SM_CXVIRTUALSCREEN), \
                 self._user32.GetSystemMetrics(SM_CYVIRTUALSCREEN))
-    def _getVirtualScreenBitmap(self):
-        """ Returns a PIL bitmap (BGR channel order) of all monitors
-
-        Arranged like the Virtual Screen
-        """
-
-        # Collect information about the virtual screen & monitors
-        min_x, min_y, screen_width, screen_height = self._getVirtualScreenRect()
-        monitors = self._getMonitorInfo()
-
-        # Initialize new black image the size of the virtual screen
-        virt_screen = Image.new("RGB", (screen_width, screen_height))
-
-        # Capture images of each of the monitors and overlay on the virtual screen
-        for monitor_id in range(0, len(monitors)):
-            img = self._captureScreen(monitors[monitor_id]["name"])
-            # Capture virtscreen coordinates of monitor
-            x1, y1, x2, y2 = monitors[monitor_id]["rect"]
-            # Convert to image-local coordinates
-            x = x1 - min_x
-            y = y1 - min_y
-            # Paste on the virtual screen
-            virt_screen.paste(img, (x, y))
-        return virt_screen
-
 
     ## Clipboard functions
     def osCopy(self):
@@ -595,7 +467,7 @@ class PlatformManagerWindows(object):
             Debug.log(3, "Borrowing existing Tkinter root")
             temporary_root = False
             root = tk._default_root
-        image_to_show = self.getBitmapFromRect(*rect)
+        image_to_show = self.getSharedBitmapFromRect(*rect)
         app = highlightWindow(root, rect, color, image_to_show)
         if seconds == 0:
             t = threading.Thread(target=app.do_until_timeout)
@@ -652,6 +524,121 @@ class PlatformManagerWindows(object):
         self._psapi.GetModuleFileNameExA(hProcess, 0, ctypes.byref(proc_name), MAX_PATH_LEN)
         return os.path.basename(proc_name.value.decode("utf-8"))
 
+## Screen capture backend
+
+class GdiCaptureBackend(CaptureBackend):
+    """ Reads a rect of the virtual screen with a single GDI BitBlt """
+    def __init__(self, user32, gdi32):
+        self._user32 = user32
+        self._gdi32 = gdi32
+
+    def capture(self, x, y, w, h):
+        """ Captures the rect (x, y, w, h) of the virtual screen
+
+        Returns a numpy array (BGR channel order, for compatibility with OpenCV)
+        """
+
+        ## Define constants/structs
+        class BITMAPINFOHEADER(ctypes.Structure):
+            _fields_ = [("biSize", ctypes.wintypes.DWORD),
+                        ("biWidth", ctypes.c_long),
+                        ("biHeight", ctypes.c_long),
+                        ("biPlanes", ctypes.wintypes.WORD),
+                        ("biBitCount", ctypes.wintypes.WORD),
+                        ("biCompression", ctypes.wintypes.DWORD),
+                        ("biSizeImage", ctypes.wintypes.DWORD),
+                        ("biXPelsPerMeter", ctypes.c_long),
+                        ("biYPelsPerMeter", ctypes.c_long),
+                        ("biClrUsed", ctypes.wintypes.DWORD),
+                        ("biClrImportant", ctypes.wintypes.DWORD)]
+        class BITMAPINFO(ctypes.Structure):
+            _fields_ = [("bmiHeader", BITMAPINFOHEADER),
+                        ("bmiColors", ctypes.wintypes.DWORD*3)]
+        SRCCOPY =    0x00CC0020
+        CAPTUREBLT = 0x40000000
+        DIB_RGB_COLORS = 0
+
+        ## Begin logic
+        # The desktop DC spans the whole virtual screen, so (x, y) can be used as-is
+        self._user32.GetDC.restype = ctypes.c_void_p
+        self._user32.GetDC.argtypes = [ctypes.c_void_p]
+        hdc = self._user32.GetDC(None)
+        if not hdc:
+            raise WindowsError("user32:GetDC failed")
+
+        # Create memory device context and a bitmap the size of the requested rect
+        self._gdi32.CreateCompatibleDC.restype = ctypes.c_void_p
+        self._gdi32.CreateCompatibleDC.argtypes = [ctypes.c_void_p]
+        hCaptureDC = self._gdi32.CreateCompatibleDC(hdc)
+        if not hCaptureDC:
+            raise WindowsError("gdi:CreateCompatibleDC failed")
+        self._gdi32.CreateCompatibleBitmap.restype = ctypes.c_void_p
+        self._gdi32.CreateCompatibleBitmap.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        hCaptureBmp = self._gdi32.CreateCompatibleBitmap(hdc, w, h)
+        if not hCaptureBmp:
+            raise WindowsError("gdi:CreateCompatibleBitmap failed")
+        self._gdi32.SelectObject.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self._gdi32.SelectObject(hCaptureDC, hCaptureBmp)
+
+        # Perform bit-block transfer of just the requested rect
+        self._gdi32.BitBlt.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_ulong
+        ]
+        self._gdi32.BitBlt(hCaptureDC, 0, 0, w, h, hdc, x, y, SRCCOPY | CAPTUREBLT)
+
+        # Capture image bits from bitmap (negative height = top-down rows, no flip needed)
+        img_info = BITMAPINFO()
+        img_info.bmiHeader.biSize = ctypes.sizeof(BITMAPINFOHEADER)
+        img_info.bmiHeader.biWidth = w
+        img_info.bmiHeader.biHeight = -h
+        img_info.bmiHeader.biPlanes = 1
+        img_info.bmiHeader.biBitCount = 32
+        img_info.bmiHeader.biCompression = 0
+        img_info.bmiHeader.biClrUsed = 0
+        img_info.bmiHeader.biClrImportant = 0
+
+        image_data = ctypes.create_string_buffer(w * 4 * h)
+
+        self._gdi32.GetDIBits.restype = ctypes.c_int
+        self._gdi32.GetDIBits.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_uint,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_uint
+        ]
+        scanlines = self._gdi32.GetDIBits(
+            hCaptureDC,
+            hCaptureBmp,
+            0,
+            h,
+            ctypes.byref(image_data),
+            ctypes.byref(img_info),
+            DIB_RGB_COLORS)
+
+        # Destroy created device context & GDI bitmap
+        self._gdi32.DeleteObject.argtypes = [ctypes.c_void_p]
+        self._gdi32.DeleteObject(hCaptureBmp)
+        self._gdi32.DeleteDC.argtypes = [ctypes.c_void_p]
+        self._gdi32.DeleteDC(hCaptureDC)
+        self._user32.ReleaseDC.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self._user32.ReleaseDC(None, hdc)
+        if scanlines != h:
+            raise WindowsError("gdi:GetDIBits failed")
+
+        # Memory layout is BGRX; drop the padding byte
+        return numpy.frombuffer(image_data, dtype=numpy.uint8).reshape((h, w, 4))[:, :, :3].copy()
+
 ## Helper class for highlighting
 
 class highlightWindow(tk.Toplevel):
@@ -12,7 +12,6 @@ import pyperclip
 import tempfile
 import platform
 import numpy
-import time
 import uuid
 import cv2
 import sys
@@ -23,17 +22,34 @@ from .InputEmulation import Mouse as MouseClass, Keyboard
 from .Exceptions import FindFailed, ImageMissing
 from .SettingsDebug import Settings, Debug
 from .TemplateMatchers import PyramidTemplateMatcher as TemplateMatcher
+from .TemplateMatchers import Haystack, IncrementalScoreMap, compilePattern, borrowThreadPool
+from .ImageCache import CachedImage, NeedleCache
+from .HintStore import getHintStore
+from .FrameRecorder import getFrameRecorder
+from .ScreenCapture import clipToRect, toWritable
+from .ScreenTopology import ScreenTopology
 from .Geometry import Location
 
-if platform.system() == "Windows" or os.environ.get('READTHEDOCS') == 'True':
+if os.environ.get("LACKEY_PLATFORM") == "virtual":
+    # Scripted screen and recorded input, for running without a display
+    from .PlatformManagerVirtual import PlatformManagerVirtual
+    PlatformManager = PlatformManagerVirtual()
+elif platform.system() == "Windows" or os.environ.get('READTHEDOCS') == 'True':
     # Avoid throwing an error if it's just being imported for documentation purposes
     from .PlatformManagerWindows import PlatformManagerWindows
     PlatformManager = PlatformManagerWindows()
 elif platform.system() == "Darwin":
     from .PlatformManagerDarwin import PlatformManagerDarwin
     PlatformManager = PlatformManagerDarwin()
+elif platform.system() == "Linux":
+    from .PlatformManagerLinux import PlatformManagerLinux
+    PlatformManager = PlatformManagerLinux()
 else:
-    raise NotImplementedError("Lackey is currently only compatible with Windows and OSX.")
+    raise NotImplementedError("Lackey is currently only compatible with Windows, OSX, and Linux.")
+# Waits, timeouts, and scan intervals are measured by the platform's clock
+_clock = PlatformManager.getClock()
+# Monitor layout, read once (see ``Screen.resetMonitors()``)
+_topology = ScreenTopology(PlatformManager, _clock)
     
 
 # Python 3 compatibility
@@ -51,6 +67,22 @@ except:
 Mouse = MouseClass()
 keyboard = Keyboard()
 
+def _getScreenGeometry():
+    """ Returns a string describing the positions and sizes of the attached screens """
+    return _topology.getGeometry()
+
+def _isSameFrame(bitmap, previous):
+    """ Returns True if ``bitmap`` has exactly the same pixels as the ``previous`` capture """
+    if previous is None or not Settings.SkipUnchangedFrames:
+        return False
+    return bitmap is previous or (bitmap.shape == previous.shape and numpy.array_equal(bitmap, previous))
+
+def _getTargetOffset(pattern, scale):
+    """ Returns the target offset of ``pattern`` for a match found at ``scale`` """
+    if scale == 1:
+        return pattern.offset
+    return Location(round(pattern.offset.x * scale), round(pattern.offset.y * scale))
+
 class Pattern(object):
     """ Defines a pattern based on a bitmap, similarity, and target offset """
     def __init__(self, target=None):
@@ -58,11 +90,15 @@ class Pattern(object):
         self.similarity = Settings.MinSimilarity
         self.offset = Location(0, 0)
         self.imagePattern = False
+        self.image = None
+        self._needle = None
         if isinstance(target, Pattern):
-            self.image = target.getImage()
+            self.path = target.path
+            self.image = target.image
             self.similarity = target.similarity
             self.offset = target.offset.offset(0, 0) # Clone Location
             self.imagePattern = target.isImagePattern()
+            self._needle = target._needle
         elif isinstance(target, basestring):
             self.setFilename(target)
         elif isinstance(target, numpy.ndarray):
@@ -111,14 +147,39 @@ class Pattern(object):
             print(Settings.ImagePaths)
             raise ImageMissing(ImageMissingEvent(pattern=self, event_type="IMAGEMISSING"))
         self.path = full_path
-        self.image = cv2.imread(self.path)
+        cached = NeedleCache.get(self.path)
+        self.image = cached.image if cached is not None else None
         return self
     def setImage(self, img):
         self.image = img
         self.imagePattern = True
+        self._needle = CachedImage(img)
         return self
     def getImage(self):
-        return self.image
+        """ Returns the pattern's image as a numpy array (BGR channel order)
+
+        Images loaded from a file are served from the needle cache, and reloaded if the
+        file has changed since it was cached.
+        """
+        return self.getNeedle().image
+    def getNeedle(self):
+        """ Returns the pattern's image as a ``CachedImage``, which the template matchers use
+        to reuse grayscale and pyramid variants between searches. """
+        if self.path is not None and not self.imagePattern:
+            cached = NeedleCache.get(self.path)
+            if cached is not None:
+                self.image = cached.image
+                return cached
+        if self.image is None:
+            raise ValueError("Unable to load image '{}'".format(self.path))
+        if self._needle is None or self._needle.image is not self.image:
+            self._needle = CachedImage(self.image)
+        return self._needle
+    def getCompiled(self):
+        """ Returns the pattern's image preprocessed for the template matchers (grayscale,
+        pyramid levels, and solid color classification). Built on first use, then reused by
+        every search for this image. """
+        return compilePattern(self.getNeedle())
     def getTargetOffset(self):
         """ Returns the target offset as a Location(dx, dy) """
         return self.offset
@@ -130,6 +191,35 @@ class Pattern(object):
         haystack.show()
 
 class Region(object):
+    """ A rectangular area of the screen, which can be searched and interacted with
+
+    Scripts create many Regions (every ``Match``, and every ``offset()``, ``above()``, etc.),
+    so instances are kept small: attributes are stored in ``__slots__``, and the observer,
+    highlighter, and raster are only set up when they are first used.
+    """
+    __slots__ = (
+        "x", "y", "w", "h", "autoWaitTimeout",
+        "_lastMatch", "_lastMatches", "_lastMatchTime", "_framesSkipped", "_lastFindPath",
+        "_defaultScanRate", "_defaultTypeSpeed", "_observeScanRate", "_repeatWaitTime",
+        "_throwException", "_findFailedResponse", "_findFailedHandler", "_imageMissingHandler",
+        "_lazyObserver", "_highlighter", "_raster", "_observer_process")
+    FOREVER = None
+    # Defaults until first set on an instance (see __getattr__)
+    _lazyDefaults = {
+        "_lastFindPath": None,
+        "_defaultScanRate": None,
+        "_defaultTypeSpeed": 0.05,
+        "_observeScanRate": None,
+        "_repeatWaitTime": 0.3,
+        "_throwException": True,
+        "_findFailedResponse": "ABORT",
+        "_findFailedHandler": None,
+        "_imageMissingHandler": None,
+        "_lazyObserver": None,
+        "_highlighter": None,
+        "_raster": (0, 0),
+        "_observer_process": None,
+    }
     def __init__(self, *args):
         if len(args) == 4:
             x, y, w, h = args
@@ -151,25 +241,30 @@ class Region(object):
             h = 1
         else:
             raise TypeError("Unrecognized argument(s) for Region()")
-        self.FOREVER = None
 
-        self.setROI(x, y, w, h)
+        self.x = int(x)
+        self.y = int(y)
+        self.w = max(1, int(w))
+        self.h = max(1, int(h))
         self._lastMatch = None
-        self._lastMatches = []
+        self._lastMatches = ()
         self._lastMatchTime = 0
+        self._framesSkipped = 0
         self.autoWaitTimeout = 3.0
-        # Converts searches per second to actual second interval
-        self._defaultScanRate = None
-        self._defaultTypeSpeed = 0.05
-        self._raster = (0, 0)
-        self._observer = Observer(self)
-        self._observeScanRate = None
-        self._repeatWaitTime = 0.3
-        self._throwException = True
-        self._findFailedResponse = "ABORT"
-        self._findFailedHandler = None
-        self._highlighter = None
-    
+
+    def __getattr__(self, name):
+        # Only called for slots that haven't been set yet
+        try:
+            return Region._lazyDefaults[name]
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+    @property
+    def _observer(self):
+        """ The region's ``Observer``, created when first needed """
+        if self._lazyObserver is None:
+            self._lazyObserver = Observer(self)
+        return self._lazyObserver
+
     CREATE_X_DIRECTION_LEFT = 0
     CREATE_X_DIRECTION_RIGHT = 1
     CREATE_Y_DIRECTION_TOP = 0
@@ -310,6 +405,22 @@ class Region(object):
     def getTime(self):
         """ Returns the elapsed time in milliseconds to find the last match """
         return self._lastMatchTime
+    def getFramesSkipped(self):
+        """ Returns the number of captures that searches in this region didn't re-match,
+        because nothing in the region had changed since the last unsuccessful attempt """
+        return self._framesSkipped
+    def resetFramesSkipped(self):
+        """ Resets the counter returned by ``getFramesSkipped()`` """
+        self._framesSkipped = 0
+    def getLastFindPath(self):
+        """ Returns how the last match found by ``exists()`` (or ``find()``, ``wait()``, etc.)
+        was located:
+
+        * "LASTSEEN" - at the exact position where the pattern was last found
+        * "NEARBY" - within ``Settings.LastSeenMargin`` pixels of that position
+        * "FULL" - by searching the whole region
+        """
+        return self._lastFindPath
 
     def setAutoWaitTimeout(self, seconds):
         """ Specify the time to wait for an image to appear on the screen """
@@ -449,9 +560,20 @@ class Region(object):
     def getBitmap(self):
         """ Captures screen area of this region, at least the part that is on the screen
 
-        Returns image as numpy array
+        Returns image as a (writable) numpy array.
+
+        If ``Settings.FrameRecordPath`` is set, the capture is recorded there.
         """
-        return PlatformManager.getBitmapFromRect(self.x, self.y, self.w, self.h)
+        return toWritable(self._getSharedBitmap())
+    def _getSharedBitmap(self):
+        """ Like ``getBitmap()``, but the array may be a read-only view of a frame shared with
+        other searches (see ``Settings.FrameCacheTTL``) """
+        bitmap = PlatformManager.getSharedBitmapFromRect(self.x, self.y, self.w, self.h)
+        recorder = getFrameRecorder()
+        if recorder is not None:
+            rect = clipToRect((self.x, self.y, self.w, self.h), _topology.getBounds(-1))
+            recorder.record(rect, bitmap, _clock.time())
+        return bitmap
     def debugPreview(self, title="Debug"):
         """ Displays the region in a preview window.
 
@@ -512,7 +634,7 @@ class Region(object):
             path = pattern.path if isinstance(pattern, Pattern) else pattern
             findFailedRetry = self._raiseFindFailed("Could not find pattern '{}'".format(path))
             if findFailedRetry:
-                time.sleep(self._repeatWaitTime)
+                _clock.sleep(self._repeatWaitTime)
         return match
     def findAll(self, pattern):
         """ Searches for an image pattern in the given region
@@ -520,33 +642,20 @@ class Region(object):
         Returns ``Match`` object if ``pattern`` exists, empty array otherwise (does not
         throw exception). Sikuli supports OCR search with a text parameter. This does not (yet).
         """
-        find_time = time.time()
-        r = self.clipRegionToScreen()
-        if r is None:
-            raise ValueError("Region outside all visible screens")
-            return None
-        seconds = self.autoWaitTimeout
-        if not isinstance(pattern, Pattern):
-            if not isinstance(pattern, basestring):
-                raise TypeError("find expected a string [image path] or Pattern object")
-            pattern = Pattern(pattern)
-        needle = cv2.imread(pattern.path)
-        if needle is None:
-            raise ValueError("Unable to load image '{}'".format(pattern.path))
-        needle_height, needle_width, needle_channels = needle.shape
-        positions = []
-        timeout = time.time() + seconds
-
-        # Check TemplateMatcher for valid matches
-        matches = []
-        while time.time() < timeout and len(matches) == 0:
-            matcher = TemplateMatcher(r.getBitmap())
-            matches = matcher.findAllMatches(needle, pattern.similarity)
-            time.sleep(1/self._defaultScanRate if self._defaultScanRate is not None else 1/Settings.WaitScanRate)
+        find_time = _clock.time()
+        pattern = self._toPattern(pattern)
+        needle = pattern.getCompiled()
+
+        # Check TemplateMatcher for valid matches, at each scale in turn
+        result = self._scan(
+            lambda matcher, r: self._findAllMatches(matcher, r, needle, pattern.similarity),
+            self.autoWaitTimeout)
 
-        if len(matches) == 0:
+        if not result:
             Debug.info("Couldn't find '{}' with enough similarity.".format(pattern.path))
             return iter([])
+        matches, scaled = result
+        needle_height, needle_width = scaled.shape[:2]
 
         # Matches found! Turn them into Match objects
         lastMatches = []
@@ -556,11 +665,11 @@ class Region(object):
             lastMatches.append(
                 Match(
                     confidence,
-                    pattern.offset,
+                    _getTargetOffset(pattern, scaled.scale),
                     ((x+self.x, y+self.y), (needle_width, needle_height))))
         self._lastMatches = iter(lastMatches)
         Debug.info("Found match(es) for pattern '{}' at similarity ({})".format(pattern.path, pattern.similarity))
-        self._lastMatchTime = (time.time() - find_time) * 1000 # Capture find time in milliseconds
+        self._lastMatchTime = (_clock.time() - find_time) * 1000 # Capture find time in milliseconds
         return self._lastMatches
 
     def wait(self, pattern, seconds=None):
@@ -573,26 +682,22 @@ class Region(object):
         if isinstance(pattern, (int, float)):
             if pattern == FOREVER:
                 while True:
-                    time.sleep(1) # Infinite loop
-            time.sleep(pattern)
+                    _clock.sleep(1) # Infinite loop
+            _clock.sleep(pattern)
             return None
 
         if seconds is None:
             seconds = self.autoWaitTimeout
-        
+
         findFailedRetry = True
-        timeout = time.time() + seconds
         while findFailedRetry:
-            while True:
-                match = self.exists(pattern)
-                if match:
-                    return match
-                if time.time() >= timeout:
-                    break
+            match = self.exists(pattern, seconds)
+            if match:
+                return match
             path = pattern.path if isinstance(pattern, Pattern) else pattern
             findFailedRetry = self._raiseFindFailed("Could not find pattern '{}'".format(path))
             if findFailedRetry:
-                time.sleep(self._repeatWaitTime)
+                _clock.sleep(self._repeatWaitTime)
         return None
     def waitVanish(self, pattern, seconds=None):
         """ Waits until the specified pattern is not visible on screen.
@@ -600,26 +705,16 @@ class Region(object):
         If ``seconds`` pass and the pattern is still visible, raises FindFailed exception.
         Sikuli supports OCR search with a text parameter. This does not (yet).
         """
-        r = self.clipRegionToScreen()
-        if r is None:
-            raise ValueError("Region outside all visible screens")
-            return None
         if seconds is None:
             seconds = self.autoWaitTimeout
-        if not isinstance(pattern, Pattern):
-            if not isinstance(pattern, basestring):
-                raise TypeError("find expected a string [image path] or Pattern object")
-            pattern = Pattern(pattern)
-
-        needle = cv2.imread(pattern.path)
-        match = True
-        timeout = time.time() + seconds
-
-        while match and time.time() < timeout:
-            matcher = TemplateMatcher(r.getBitmap())
-            # When needle disappears, matcher returns None
-            match = matcher.findBestMatch(needle, pattern.similarity)
-            time.sleep(1/self._defaultScanRate if self._defaultScanRate is not None else 1/Settings.WaitScanRate)
+        pattern = self._toPattern(pattern)
+        needle = pattern.getCompiled()
+
+        # When needle disappears, matcher returns None
+        match = self._scan(
+            lambda matcher, r: self._findBestMatch(matcher, r, needle, pattern.similarity),
+            seconds,
+            vanish=True)
         if match:
             return False
             #self._findFailedHandler(FindFailed("Pattern '{}' did not vanish".format(pattern.path)))
@@ -629,48 +724,38 @@ class Region(object):
         Returns Match if pattern exists, None otherwise (does not throw exception)
         Sikuli supports OCR search with a text parameter. This does not (yet).
         """
-        find_time = time.time()
-        r = self.clipRegionToScreen()
-        if r is None:
-            raise ValueError("Region outside all visible screens")
-            return None
+        find_time = _clock.time()
         if seconds is None:
             seconds = self.autoWaitTimeout
         if isinstance(pattern, int):
             # Actually just a "wait" statement
-            time.sleep(pattern)
+            _clock.sleep(pattern)
             return
         if not pattern:
-            time.sleep(seconds)
-        if not isinstance(pattern, Pattern):
-            if not isinstance(pattern, basestring):
-                raise TypeError("find expected a string [image path] or Pattern object")
-            pattern = Pattern(pattern)
-        needle = cv2.imread(pattern.path)
-        if needle is None:
-            raise ValueError("Unable to load image '{}'".format(pattern.path))
-        needle_height, needle_width, needle_channels = needle.shape
-        match = None
-        timeout = time.time() + seconds
+            _clock.sleep(seconds)
+        pattern = self._toPattern(pattern)
+        needle = pattern.getCompiled()
 
         # Consult TemplateMatcher to find needle
-        while not match:
-            matcher = TemplateMatcher(r.getBitmap())
-            match = matcher.findBestMatch(needle, pattern.similarity)
-            time.sleep(1/self._defaultScanRate if self._defaultScanRate is not None else 1/Settings.WaitScanRate)
-            if time.time() > timeout:
-                break
+        if Settings.IncrementalMatching and pattern.similarity < 1.0:
+            score_map = IncrementalScoreMap(needle)
+        else:
+            score_map = None
+        match = self._scan(
+            lambda matcher, r: self._findBestMatch(matcher, r, needle, pattern.similarity, score_map),
+            seconds)
 
         if match is None:
             Debug.info("Couldn't find '{}' with enough similarity.".format(pattern.path))
             return None
 
         # Translate local position into global screen position
-        position, confidence = match
+        position, confidence, scaled = match
+        needle_height, needle_width = scaled.shape[:2]
         position = (position[0] + self.x, position[1] + self.y)
         self._lastMatch = Match(
             confidence,
-            pattern.offset,
+            _getTargetOffset(pattern, scaled.scale),
             (position, (needle_width, needle_height)))
         #self._lastMatch.debug_preview()
         Debug.info("Found match for pattern '{}' at ({},{}) with confidence ({}). Target at ({},{})".format(
@@ -680,8 +765,142 @@ class Region(object):
             self._lastMatch.getScore(),
             self._lastMatch.getTarget().x,
             self._lastMatch.getTarget().y))
-        self._lastMatchTime = (time.time() - find_time) * 1000 # Capture find time in milliseconds
+        self._lastMatchTime = (_clock.time() - find_time) * 1000 # Capture find time in milliseconds
         return self._lastMatch
+    def _findBestMatch(self, matcher, r, needle, similarity, score_map=None):
+        """ Finds ``needle`` (a compiled pattern) with ``matcher``, which searches the region ``r``
+
+        Tries each scale in ``Settings.MatchScales`` (see ``_getScaledNeedles()``), and
+        remembers the one that matched. ``score_map``, if given, is only used for scale 1.0.
+        Returns a tuple of ``(position, confidence, scaled_needle)``, or None.
+        """
+        key, scaled_needles = self._getScaledNeedles(needle, r)
+        for scaled in scaled_needles:
+            if scaled.scale != 1 and (scaled.shape[0] > r.h or scaled.shape[1] > r.w):
+                # Scaled up beyond the search area
+                continue
+            match = self._findAtScale(
+                matcher,
+                r,
+                scaled,
+                similarity,
+                score_map if scaled is needle else None)
+            if match is not None:
+                needle.preferredScales[key] = scaled.scale
+                return match + (scaled,)
+        return None
+    def _findAllMatches(self, matcher, r, needle, similarity):
+        """ Finds every match of ``needle`` (a compiled pattern) with ``matcher``, which searches
+        the region ``r``, at the first scale in ``Settings.MatchScales`` with any
+
+        Returns a tuple of ``(matches, scaled_needle)``, or None.
+        """
+        key, scaled_needles = self._getScaledNeedles(needle, r)
+        for scaled in scaled_needles:
+            if scaled.scale != 1 and (scaled.shape[0] > r.h or scaled.shape[1] > r.w):
+                continue
+            matches = matcher.findAllMatches(scaled, similarity)
+            if matches:
+                needle.preferredScales[key] = scaled.scale
+                return (matches, scaled)
+        return None
+    def _getScaledNeedles(self, needle, r):
+        """ Returns the key for ``r``'s screen, and ``needle`` resized to each scale in
+        ``Settings.MatchScales``; the scale that last matched on that screen comes first """
+        scales = [float(scale) for scale in Settings.MatchScales] or [1.0]
+        if len(scales) == 1:
+            return (None, [needle.getScaled(scales[0])])
+        screen_id = _topology.getScreenAt(r.x, r.y)
+        key = _topology.getBounds(screen_id) if screen_id is not None else None
+        preferred = needle.preferredScales.get(key)
+        if preferred in scales:
+            scales.remove(preferred)
+            scales.insert(0, preferred)
+        return (key, [needle.getScaled(scale) for scale in scales])
+    def _findAtScale(self, matcher, r, needle, similarity, score_map=None):
+        """ Finds ``needle`` (a compiled pattern) with ``matcher``, which searches the region ``r``
+
+        If ``Settings.CheckLastSeen`` is set, first checks the position where the pattern was
+        last found, then the area around it, and only then searches the whole region. Records
+        the step that found the match (see ``getLastFindPath()``).
+
+        If ``score_map`` (an ``IncrementalScoreMap``) is given, it is used instead of the
+        matcher's pyramid search for the whole region.
+
+        If ``Settings.HintStorePath`` is set, positions are also saved to (and, for patterns
+        not yet found in this run, loaded from) the hint store.
+        """
+        match = None
+        store = getHintStore() if Settings.CheckLastSeen else None
+        loaded = False
+        if store is not None and needle.lastSeen is None:
+            hint = store.get(needle.getHash(), _getScreenGeometry())
+            if hint is not None:
+                needle.lastSeen = hint[0]
+                loaded = True
+        if Settings.CheckLastSeen and needle.lastSeen is not None:
+            position = (needle.lastSeen[0] - r.x, needle.lastSeen[1] - r.y)
+            match = matcher.findBestMatchNear(needle, similarity, position)
+            path = "LASTSEEN"
+            if match is None and Settings.LastSeenMargin > 0:
+                match = matcher.findBestMatchNear(needle, similarity, position, Settings.LastSeenMargin)
+                path = "NEARBY"
+        if match is None:
+            if score_map is not None:
+                match = score_map.findBestMatch(matcher.getHaystack(), similarity)
+            else:
+                match = matcher.findBestMatch(needle, similarity)
+            path = "FULL"
+        if match is not None:
+            position = (match[0][0] + r.x, match[0][1] + r.y)
+            # Save new positions, and refresh loaded hints so they aren't discarded as stale
+            if store is not None and (path != "LASTSEEN" or loaded):
+                store.put(needle.getHash(), _getScreenGeometry(), position, match[1])
+            needle.lastSeen = position
+            self._lastFindPath = path
+            Debug.log(3, "Found by {} search".format(path))
+        return match
+    def _toPattern(self, pattern):
+        """ Returns ``pattern`` as a ``Pattern`` object (strings are treated as image paths) """
+        if not isinstance(pattern, Pattern):
+            if not isinstance(pattern, basestring):
+                raise TypeError("find expected a string [image path] or Pattern object")
+            pattern = Pattern(pattern)
+        return pattern
+    def _scan(self, search, seconds, vanish=False):
+        """ Polling engine behind ``exists()``, ``wait()``, ``waitVanish()``, and ``findAll()``
+
+        Captures the region and calls ``search(matcher, r)`` with a ``TemplateMatcher`` for the
+        frame and the (clipped) region it was captured from, until it returns a result (or, if ``vanish`` is True, until it returns nothing)
+        or ``seconds`` have passed. Returns the last result.
+
+        Returns as soon as the search succeeds. Between scans, sleeps only for what is left
+        of the scan interval (``1/getWaitScanRate()``) after capturing and matching, and
+        never past the deadline; the last scan starts at the deadline at the latest. Frames
+        identical to the last one searched aren't searched again.
+        """
+        r = self.clipRegionToScreen()
+        if r is None:
+            raise ValueError("Region outside all visible screens")
+        deadline = _clock.time() + seconds
+        interval = 1.0 / self.getWaitScanRate()
+        previous = None
+        result = None
+        while True:
+            scan_start = _clock.time()
+            bitmap = r._getSharedBitmap()
+            if _isSameFrame(bitmap, previous):
+                # Nothing changed since the last search, so neither would the result
+                self._framesSkipped += 1
+            else:
+                result = search(TemplateMatcher(bitmap), r)
+                previous = bitmap
+                if bool(result) != vanish:
+                    return result
+            now = _clock.time()
+            if now >= deadline:
+                return result
+            _clock.sleep(max(0, min(scan_start + interval, deadline) - now))
 
     def click(self, target=None, modifiers=""):
         """ Moves the cursor to the target location and clicks the default mouse button. """
@@ -705,12 +924,12 @@ class Region(object):
             keyboard.keyDown(modifiers)
 
         Mouse.moveSpeed(target_location, Settings.MoveMouseDelay)
-        time.sleep(0.1) # For responsiveness
+        _clock.sleep(0.1) # For responsiveness
         if Settings.ClickDelay > 0:
-            time.sleep(min(1.0, Settings.ClickDelay))
+            _clock.sleep(min(1.0, Settings.ClickDelay))
             Settings.ClickDelay = 0.0
         Mouse.click()
-        time.sleep(0.1)
+        _clock.sleep(0.1)
 
         if modifiers != 0:
             keyboard.keyUp(modifiers)
@@ -736,17 +955,17 @@ class Region(object):
             keyboard.keyDown(modifiers)
 
         Mouse.moveSpeed(target_location, Settings.MoveMouseDelay)
-        time.sleep(0.1)
+        _clock.sleep(0.1)
         if Settings.ClickDelay > 0:
-            time.sleep(min(1.0, Settings.ClickDelay))
+            _clock.sleep(min(1.0, Settings.ClickDelay))
             Settings.ClickDelay = 0.0
         Mouse.click()
-        time.sleep(0.1)
+        _clock.sleep(0.1)
         if Settings.ClickDelay > 0:
-            time.sleep(min(1.0, Settings.ClickDelay))
+            _clock.sleep(min(1.0, Settings.ClickDelay))
             Settings.ClickDelay = 0.0
         Mouse.click()
-        time.sleep(0.1)
+        _clock.sleep(0.1)
 
         if modifiers != 0:
             keyboard.keyUp(modifiers)
@@ -772,12 +991,12 @@ class Region(object):
             keyboard.keyDown(modifiers)
 
         Mouse.moveSpeed(target_location, Settings.MoveMouseDelay)
-        time.sleep(0.1)
+        _clock.sleep(0.1)
         if Settings.ClickDelay > 0:
-            time.sleep(min(1.0, Settings.ClickDelay))
+            _clock.sleep(min(1.0, Settings.ClickDelay))
             Settings.ClickDelay = 0.0
         Mouse.click(button=Mouse.RIGHT)
-        time.sleep(0.1)
+        _clock.sleep(0.1)
 
         if modifiers != "":
             keyboard.keyUp(modifiers)
@@ -822,7 +1041,7 @@ class Region(object):
         else:
             raise TypeError("drag expected dragFrom to be Pattern, String, Match, Region, or Location object")
         Mouse.moveSpeed(dragFromLocation, Settings.MoveMouseDelay)
-        time.sleep(Settings.DelayBeforeMouseDown)
+        _clock.sleep(Settings.DelayBeforeMouseDown)
         Mouse.buttonDown()
         Debug.history("Began drag at {}".format(dragFromLocation))
     def dropAt(self, dragTo=None, delay=None):
@@ -846,7 +1065,7 @@ class Region(object):
             raise TypeError("dragDrop expected dragTo to be Pattern, String, Match, Region, or Location object")
 
         Mouse.moveSpeed(dragToLocation, Settings.MoveMouseDelay)
-        time.sleep(delay if delay is not None else Settings.DelayBeforeDrop)
+        _clock.sleep(delay if delay is not None else Settings.DelayBeforeDrop)
         Mouse.buttonUp()
         Debug.history("Ended drag at {}".format(dragToLocation))
     def dragDrop(self, target, target2=None, modifiers=""):
@@ -869,7 +1088,7 @@ class Region(object):
             dragTo = target2
 
         self.drag(dragFrom)
-        time.sleep(Settings.DelayBeforeDrag)
+        _clock.sleep(Settings.DelayBeforeDrag)
         self.dropAt(dragTo)
 
         if modifiers != "":
@@ -918,7 +1137,7 @@ class Region(object):
         kb.type(text, typeSpeed)
         if modifiers:
             kb.keyUp(modifiers)
-        time.sleep(0.2)
+        _clock.sleep(0.2)
     def paste(self, *args):
         """ Usage: paste([PSMRL], text)
 
@@ -939,7 +1158,7 @@ class Region(object):
         pyperclip.copy(text)
         # Triggers OS paste for foreground window
         PlatformManager.osPaste()
-        time.sleep(0.2)
+        _clock.sleep(0.2)
     def getClipboard(self):
         """ Returns the contents of the clipboard
 
@@ -1016,9 +1235,7 @@ class Region(object):
         Settings.TypeDelay = millisecs
     def isRegionValid(self):
         """ Returns false if the whole region is not even partially inside any screen, otherwise true """
-        screens = PlatformManager.getScreenDetails()
-        for screen in screens:
-            s_x, s_y, s_w, s_h = screen["rect"]
+        for s_x, s_y, s_w, s_h in _topology.getScreens():
             if self.x+self.w >= s_x and s_x+s_w >= self.x and self.y+self.h >= s_y and s_y+s_h >= self.y:
                 # Rects overlap
                 return True
@@ -1033,11 +1250,8 @@ class Region(object):
         """
         if not self.isRegionValid():
             return None
-        screens = PlatformManager.getScreenDetails()
-        total_x, total_y, total_w, total_h = Screen(-1).getBounds()
-        containing_screen = None
-        for screen in screens:
-            s_x, s_y, s_w, s_h = screen["rect"]
+        total_x, total_y, total_w, total_h = _topology.getBounds(-1)
+        for s_x, s_y, s_w, s_h in _topology.getScreens():
             if self.x >= s_x and self.x+self.w <= s_x+s_w and self.y >= s_y and self.y+self.h <= s_y+s_h:
                 # Region completely inside screen
                 return self
@@ -1192,14 +1406,10 @@ class Region(object):
             return self
     def setRows(self, rows):
         """ Sets the number of rows in the raster (if columns have not been initialized, set to 1 as well) """
-        self._raster[0] = rows
-        if self._raster[1] == 0:
-            self._raster[1] = 1
+        self._raster = (int(rows), self._raster[1] or 1)
     def setCols(self, columns):
         """ Sets the number of columns in the raster (if rows have not been initialized, set to 1 as well) """
-        self._raster[1] = columns
-        if self._raster[0] == 0:
-            self._raster[0] = 1
+        self._raster = (self._raster[0] or 1, int(columns))
     def isRasterValid(self):
         return self.getCols() > 0 and self.getRows() > 0
     def getRows(self):
@@ -1276,7 +1486,7 @@ class Region(object):
 
     def saveScreenCapture(self, path=None, name=None):
         """ Saves the region's bitmap """
-        bitmap = self.getBitmap()
+        bitmap = self._getSharedBitmap()
         target_file = None
         if path is None and name is None:
             _, target_file = tempfile.mkstemp(".png")
@@ -1364,8 +1574,89 @@ class Region(object):
             path = pattern.path if isinstance(pattern, Pattern) else pattern
             findFailedRetry = self._raiseFindFailed("Could not find pattern '{}'".format(path))
             if findFailedRetry:
-                time.sleep(self._repeatWaitTime)
+                _clock.sleep(self._repeatWaitTime)
         return best_match
+    def findAny(self, *patterns):
+        """ Searches for several patterns in a single capture of the region
+
+        Accepts patterns as separate arguments or as one list. Returns a list of ``Match``
+        objects for the patterns that were found, in the order the patterns were given; each
+        match's ``getIndex()`` is the position of its pattern in that order. Does not wait or
+        throw exceptions.
+        """
+        find_time = _clock.time()
+        results = self._searchPatterns(patterns, find_all=False)
+        matches = [match for match in results if match is not None]
+        self._lastMatches = iter(matches)
+        self._lastMatchTime = (_clock.time() - find_time) * 1000 # Capture find time in milliseconds
+        return matches
+    def findAllOf(self, *patterns):
+        """ Finds all matches for each of several patterns in a single capture of the region
+
+        Accepts patterns as separate arguments or as one list. Returns a list with one entry
+        per pattern (in the order given): a list of that pattern's ``Match`` objects, empty if
+        it wasn't found. Does not wait or throw exceptions.
+        """
+        find_time = _clock.time()
+        results = self._searchPatterns(patterns, find_all=True)
+        self._lastMatches = iter([match for matches in results for match in matches])
+        self._lastMatchTime = (_clock.time() - find_time) * 1000 # Capture find time in milliseconds
+        return results
+    def _searchPatterns(self, patterns, find_all):
+        """ Captures the region once and matches every pattern against that frame.
+
+        ``patterns`` is a tuple of patterns, or a tuple holding one list of them. Each pattern
+        is searched for as by ``exists()`` (or, if ``find_all`` is True, ``findAll()``), at
+        each scale in ``Settings.MatchScales``, on ``Settings.FindThreads`` worker threads.
+        Returns one result per pattern: a ``Match`` (or None) if ``find_all`` is False, else a
+        list of ``Match`` objects.
+        """
+        if len(patterns) == 1 and isinstance(patterns[0], (list, tuple)):
+            patterns = patterns[0]
+        r = self.clipRegionToScreen()
+        if r is None:
+            raise ValueError("Region outside all visible screens")
+        patterns = [self._toPattern(pattern) for pattern in patterns]
+        haystack = Haystack.forImage(r._getSharedBitmap())
+
+        def search(pattern):
+            matcher = TemplateMatcher(haystack)
+            needle = pattern.getCompiled()
+            if find_all:
+                return self._findAllMatches(matcher, r, needle, pattern.similarity)
+            return self._findBestMatch(matcher, r, needle, pattern.similarity)
+
+        threads = int(Settings.FindThreads)
+        if threads > 1 and len(patterns) > 1:
+            with borrowThreadPool("find", threads) as pool:
+                results = pool.map(search, patterns)
+        else:
+            results = [search(pattern) for pattern in patterns]
+
+        def to_match(index, pattern, position, confidence, scaled):
+            needle_height, needle_width = scaled.shape[:2]
+            match = Match(
+                confidence,
+                _getTargetOffset(pattern, scaled.scale),
+                ((position[0] + r.x, position[1] + r.y), (needle_width, needle_height)))
+            match.setIndex(index)
+            return match
+
+        matches = []
+        for index, (pattern, result) in enumerate(zip(patterns, results)):
+            if find_all:
+                found, scaled = result if result is not None else ([], None)
+                matches.append([to_match(index, pattern, position, confidence, scaled)
+                                for position, confidence in found])
+            elif result is not None:
+                matches.append(to_match(index, pattern, *result))
+            else:
+                matches.append(None)
+            Debug.info("{} match(es) for pattern '{}' at similarity ({})".format(
+                len(matches[-1]) if find_all else int(result is not None),
+                pattern.path,
+                pattern.similarity))
+        return matches
     def compare(self, image):
         """ Compares the region to the specified image """
         return exists(Pattern(image), 0)
@@ -1412,13 +1703,13 @@ class Region(object):
         if isinstance(min_changed_pixels, int) and (callable(handler) or handler is None):
             return self._observer.register_event(
                 "CHANGE",
-                pattern=(min_changed_pixels, self.getBitmap()),
+                pattern=(min_changed_pixels, self._getSharedBitmap()),
                 handler=handler)
         elif (callable(min_changed_pixels) or min_changed_pixels is None) and (callable(handler) or handler is None):
             handler = min_changed_pixels or handler
             return self._observer.register_event(
                 "CHANGE",
-                pattern=(Settings.ObserveMinChangedPixels, self.getBitmap()),
+                pattern=(Settings.ObserveMinChangedPixels, self._getSharedBitmap()),
                 handler=handler)
         else:
             raise ValueError("Unsupported arguments for onChange method")
@@ -1427,7 +1718,7 @@ class Region(object):
         ``screen_state`` and the current state.
         """
         r = self.clipRegionToScreen()
-        current_state = r.getBitmap()
+        current_state = r._getSharedBitmap()
         diff = numpy.subtract(current_state, screen_state)
         return (numpy.count_nonzero(diff) >= min_changed_pixels)
 
@@ -1446,16 +1737,16 @@ class Region(object):
 
         # Set timeout
         if seconds is not None:
-            timeout = time.time() + seconds
+            timeout = _clock.time() + seconds
         else:
             timeout = None
 
         # Start observe loop
-        while (not self._observer.isStopped) and (seconds is None or time.time() < timeout):
+        while (not self._observer.isStopped) and (seconds is None or _clock.time() < timeout):
             # Check registered events
             self._observer.check_events()
             # Sleep for scan rate
-            time.sleep(1/self.getObserveScanRate())
+            _clock.sleep(1/self.getObserveScanRate())
         return True
     def getObserveScanRate(self):
         """ Gets the number of times per second the observe loop should run """
@@ -1752,7 +2043,9 @@ class ObserveEvent(object):
             raise TypeError("This is a(n) {} event, but method getImage is only valid for the following event types: ({})".format(self._type, ", ".join(valid_types)))
         elif self._pattern is None:
             raise ValueError("This event's pattern was not set!")
-        return cv2.imread(self._pattern.path)
+        if isinstance(self._pattern, Pattern):
+            return self._pattern.getImage()
+        return Pattern(self._pattern).getImage()
     def getMatch(self):
         valid_types = ["APPEAR", "VANISH"]
         if self._type not in valid_types:
@@ -1799,12 +2092,14 @@ class ImageMissingEvent(ObserveEvent):
         return self._pattern
 class Match(Region):
     """ Extended Region object with additional data on click target, match score """
+    __slots__ = ("_score", "_target", "_index")
     def __init__(self, score, target, rect):
         super(Match, self).__init__(rect[0][0], rect[0][1], rect[1][0], rect[1][1])
         self._score = float(score)
         if not target or not isinstance(target, Location):
             raise TypeError("Match expected target to be a Location object")
         self._target = target
+        self._index = None
 
     def getScore(self):
         """ Returns confidence score of the match """
@@ -1814,6 +2109,14 @@ class Match(Region):
         """ Returns the location of the match click target (center by default, but may be offset) """
         return self.getCenter().offset(self._target.x, self._target.y)
 
+    def getIndex(self):
+        """ Returns the position of the matched pattern in the list passed to ``findAny()``
+        (None for matches from other searches) """
+        return self._index
+    def setIndex(self, index):
+        """ Sets the index returned by ``getIndex()`` """
+        self._index = index
+
     def __repr__(self):
         return "Match[{},{} {}x{}] score={:2f}, target={}".format(self.x, self.y, self.w, self.h, self._score, self._target.getTuple())
 
@@ -1833,10 +2136,12 @@ class Screen(Region):
     it follows the latter convention. We've opted to make Screen(0) the actual primary monitor
     (wherever the Start Menu/System Menu Bar is) across the board.
     """
+    # Unlike other Regions, Screens keep a __dict__: there are only a few of them, and
+    # scripts commonly set their own attributes on them (in observer handlers, for example)
     primaryScreen = 0
     def __init__(self, screenId=None):
         """ Defaults to the main screen. """
-        if not isinstance(screenId, int) or screenId < -1 or screenId >= len(PlatformManager.getScreenDetails()):
+        if not isinstance(screenId, int) or screenId < -1 or screenId >= _topology.getCount():
             screenId = Screen.getPrimaryID()
         self._screenId = screenId
         x, y, w, h = self.getBounds()
@@ -1845,10 +2150,14 @@ class Screen(Region):
     @classmethod
     def getNumberScreens(cls):
         """ Get the number of screens in a multi-monitor environment at the time the script is running """
-        return len(PlatformManager.getScreenDetails())
+        return _topology.getCount()
+    @classmethod
+    def getTopology(cls):
+        """ Returns the (cached) layout of the monitors, as a ``ScreenTopology`` """
+        return _topology
     def getBounds(self):
         """ Returns bounds of screen as (x, y, w, h) """
-        return PlatformManager.getScreenBounds(self._screenId)
+        return _topology.getBounds(self._screenId)
     def capture(self, *args): #x=None, y=None, w=None, h=None):
         """ Captures the region as an image """
         if len(args) == 0:
@@ -1907,15 +2216,21 @@ class Screen(Region):
         """ Prints debug information about currently detected screens """
         Debug.info("*** monitor configuration [ {} Screen(s)] ***".format(cls.getNumberScreens()))
         Debug.info("*** Primary is Screen {}".format(cls.primaryScreen))
-        for index, screen in enumerate(PlatformManager.getScreenDetails()):
-            Debug.info("Screen {}: ({}, {}, {}, {})".format(index, *screen["rect"]))
+        for index, rect in enumerate(_topology.getScreens()):
+            Debug.info("Screen {}: ({}, {}, {}, {})".format(index, *rect))
         Debug.info("*** end monitor configuration ***")
     def resetMonitors(self):
-        """ Recalculates screen based on changed monitor setup """
+        """ Recalculates screen based on changed monitor setup
+
+        The monitor layout is cached, so this is needed to pick up changes to it (unless
+        ``Settings.MonitorCheckInterval`` is set).
+        """
         Debug.error("*** BE AWARE: experimental - might not work ***")
         Debug.error("Re-evaluation of the monitor setup has been requested")
         Debug.error("... Current Region/Screen objects might not be valid any longer")
         Debug.error("... Use existing Region/Screen objects only if you know what you are doing!")
+        _topology.invalidate()
+        PlatformManager.resetFrameCache()
         self.__init__(self._screenId)
         self.showMonitors()
     def newRegion(self, loc, width, height):
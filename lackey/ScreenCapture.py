@@ -0,0 +1,210 @@
+""" Screen capture backends used by the PlatformManagers.
+
+A capture backend reads the pixels of a single rect of the virtual screen. PlatformManagers
+clip the requested rect to the virtual screen and then delegate to their backend, so only
+the requested pixels are ever read from the display.
+"""
+import threading
+import weakref
+import bisect
+import time
+import numpy
+
+from .SettingsDebug import Settings
+
+class CaptureBackend(object):
+    """ Interface for screen capture backends
+
+    Subclasses implement ``capture()``, which returns the pixels of the rect ``(x, y, w, h)``
+    (in virtual screen coordinates) as a numpy array of shape ``(h, w, 3)`` in BGR channel
+    order. The rect passed in has already been clipped to the virtual screen.
+    """
+    def capture(self, x, y, w, h):
+        """ Returns the pixels of the specified rect as a BGR numpy array """
+        raise NotImplementedError("Capture backends must implement capture()")
+
+class ArrayCaptureBackend(CaptureBackend):
+    """ Pure-Python capture backend that serves pixels from a numpy array
+
+    Stands in for the OS capture backends in tests. ``frame`` is a BGR array representing
+    the virtual screen, with its top left corner at ``origin`` (which may be negative, as
+    with a monitor positioned left of or above the primary screen).
+    """
+    def __init__(self, frame, origin=(0, 0)):
+        self.setFrame(frame, origin)
+
+    def setFrame(self, frame, origin=None):
+        """ Replaces the array served by this backend """
+        _checkFrame(frame)
+        self._frame = frame
+        if origin is not None:
+            self._origin = tuple(origin)
+    def getRect(self):
+        """ Returns the rect ``(x, y, w, h)`` covered by the served array """
+        return (self._origin[0], self._origin[1], self._frame.shape[1], self._frame.shape[0])
+
+    def capture(self, x, y, w, h):
+        """ Returns a copy of the requested part of the array
+
+        Pixels outside the served array are black, as they would be on a real virtual screen.
+        """
+        return _cropFrame(self._frame, self._origin, (x, y, w, h))
+
+def _checkFrame(frame):
+    if frame.ndim != 3 or frame.shape[2] != 3:
+        raise ValueError("Expected a BGR image of shape (h, w, 3)")
+def _cropFrame(frame, origin, rect):
+    """ Copies ``rect`` out of ``frame`` (positioned at ``origin``), padding with black """
+    x, y, w, h = rect
+    bitmap = numpy.zeros((h, w, 3), dtype=numpy.uint8)
+    o_x, o_y = origin
+    x1 = max(x, o_x)
+    y1 = max(y, o_y)
+    x2 = min(x+w, o_x+frame.shape[1])
+    y2 = min(y+h, o_y+frame.shape[0])
+    if x2 > x1 and y2 > y1:
+        bitmap[y1-y:y2-y, x1-x:x2-x] = frame[y1-o_y:y2-o_y, x1-o_x:x2-o_x]
+    return bitmap
+
+class FrameSequenceBackend(ArrayCaptureBackend):
+    """ Serves a scripted sequence of frames, each shown from a given time on
+
+    ``frames`` is a list of ``(start, frame)`` tuples, where ``start`` is a time by ``clock``
+    (any object with a ``time()`` method, like the ``time`` module, which is the default).
+    Each capture serves the latest frame that has started; before the first start time,
+    the first frame is served. Frames are positioned as with ``ArrayCaptureBackend``.
+    """
+    def __init__(self, frames=(), clock=time, origin=(0, 0)):
+        self._clock = clock
+        self._origin = tuple(origin)
+        self._starts = []
+        self._frames = []
+        self._lock = threading.Lock()
+        for start, frame in frames:
+            self.addFrame(frame, start)
+
+    def addFrame(self, frame, start=None):
+        """ Shows ``frame`` from time ``start`` on (by default, from now on) """
+        _checkFrame(frame)
+        if start is None:
+            start = self._clock.time()
+        with self._lock:
+            # Frames with the same start time are shown in the order they were added
+            index = bisect.bisect_right(self._starts, start)
+            self._starts.insert(index, start)
+            self._frames.insert(index, frame)
+    def setFrame(self, frame, origin=None):
+        """ Replaces the whole sequence with ``frame`` """
+        _checkFrame(frame)
+        with self._lock:
+            self._starts = [float("-inf")]
+            self._frames = [frame]
+        if origin is not None:
+            self._origin = tuple(origin)
+    def getFrameCount(self):
+        """ Returns the number of frames in the sequence """
+        return len(self._frames)
+    def getRect(self):
+        """ Returns the rect ``(x, y, w, h)`` covered by the current frame """
+        frame = self._getCurrentFrame()
+        return (self._origin[0], self._origin[1], frame.shape[1], frame.shape[0])
+
+    def capture(self, x, y, w, h):
+        """ Returns a copy of the requested part of the current frame (black if there are no
+        frames) """
+        return _cropFrame(self._getCurrentFrame(), self._origin, (x, y, w, h))
+    def _getCurrentFrame(self):
+        with self._lock:
+            if not self._frames:
+                return numpy.zeros((0, 0, 3), dtype=numpy.uint8)
+            index = bisect.bisect_right(self._starts, self._clock.time())
+            return self._frames[max(index - 1, 0)]
+
+def toWritable(bitmap):
+    """ Returns ``bitmap``, or a copy of it if it's read-only (like a cached frame) """
+    return bitmap if bitmap.flags.writeable else bitmap.copy()
+
+def clipToRect(rect, bounds):
+    """ Clips ``rect`` to ``bounds`` (both as ``(x, y, w, h)``)
+
+    Returns the clipped rect; width and height are zero if the two do not overlap.
+    """
+    x, y, w, h = rect
+    min_x, min_y, bounds_w, bounds_h = bounds
+    x1 = min(max(min_x, x), min_x+bounds_w)
+    y1 = min(max(min_y, y), min_y+bounds_h)
+    x2 = min(max(min_x, x+w), min_x+bounds_w)
+    y2 = min(max(min_y, y+h), min_y+bounds_h)
+    return (x1, y1, x2-x1, y2-y1)
+
+class FrameCache(object):
+    """ Shares recent captures between callers
+
+    A capture is reused for any rect it contains until it is older than the time-to-live
+    (``Settings.FrameCacheTTL`` seconds, unless ``ttl`` is given), by ``clock`` (the ``time``
+    module, unless another object with a ``time()`` method is given). Cached frames are
+    read-only, and contained rects are returned as numpy views of them, so several Regions
+    polling within the same few milliseconds share one capture.
+
+    Since mouse and keyboard input may change the screen, input sent through Lackey discards
+    the frames of every cache (see ``invalidateFrameCaches()``).
+    """
+    def __init__(self, ttl=None, max_frames=8, clock=time):
+        self._ttl = ttl
+        self._clock = clock
+        self._max_frames = max_frames
+        self._frames = [] # List of (timestamp, rect, bitmap), newest first
+        self._lock = threading.Lock()
+        self._generation = 0 # Incremented by invalidate()
+        _frame_caches.add(self)
+        self.hits = 0
+        self.misses = 0
+
+    def getTTL(self):
+        """ Returns the time-to-live of cached frames in seconds """
+        return self._ttl if self._ttl is not None else Settings.FrameCacheTTL
+    def getBitmap(self, rect, capture):
+        """ Returns the pixels of ``rect`` (x, y, w, h), using ``capture(x, y, w, h)`` on a miss """
+        ttl = self.getTTL()
+        if not ttl or ttl <= 0:
+            # Cache disabled
+            with self._lock:
+                self.misses += 1
+            return capture(*rect)
+        x, y, w, h = rect
+        with self._lock:
+            now = self._clock.time()
+            self._frames = [frame for frame in self._frames if now - frame[0] < ttl]
+            for timestamp, (f_x, f_y, f_w, f_h), bitmap in self._frames:
+                if f_x <= x and f_y <= y and x+w <= f_x+f_w and y+h <= f_y+f_h:
+                    self.hits += 1
+                    return bitmap[y-f_y:y-f_y+h, x-f_x:x-f_x+w]
+            self.misses += 1
+            generation = self._generation
+        bitmap = capture(*rect)
+        bitmap.setflags(write=False)
+        with self._lock:
+            # A capture that started before invalidate() may show the old screen
+            if generation == self._generation:
+                self._frames.insert(0, (self._clock.time(), tuple(rect), bitmap))
+                del self._frames[self._max_frames:]
+        return bitmap
+    def invalidate(self):
+        """ Discards all cached frames """
+        with self._lock:
+            self._frames = []
+            self._generation += 1
+    def getStats(self):
+        """ Returns a dict with the cache's ``hits``, ``misses``, and ``ttl`` """
+        return {"hits": self.hits, "misses": self.misses, "ttl": self.getTTL()}
+    def resetStats(self):
+        """ Resets the hit and miss counters """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+_frame_caches = weakref.WeakSet()
+def invalidateFrameCaches():
+    """ Discards the cached frames of every ``FrameCache`` """
+    for cache in list(_frame_caches):
+        cache.invalidate()
@@ -0,0 +1,72 @@
+""" Cached layout of the attached monitors, shared by all Regions """
+import threading
+import time
+
+from .SettingsDebug import Debug, Settings
+
+class ScreenTopology(object):
+    """ The rects of the attached monitors, read from a PlatformManager once and then reused
+
+    Regions consult the monitor layout for every search and most geometry operations, and
+    reading it from the OS can be slow (on Windows, it enumerates the monitors through a
+    callback). The layout is kept until ``invalidate()`` is called (as by
+    ``Screen.resetMonitors()``). If ``Settings.MonitorCheckInterval`` is set, it is also
+    re-read when it is older than that many seconds (by ``clock``), and if it has changed,
+    the PlatformManager's cached captures are discarded.
+    """
+    def __init__(self, manager, clock=time):
+        self._manager = manager
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._screens = None # Tuple of monitor rects, primary first
+        self._virtual_rect = None
+        self._checked = None
+
+    def getScreens(self):
+        """ Returns the rects (x, y, w, h) of the monitors, the primary monitor first """
+        return self._getLayout()[0]
+    def getCount(self):
+        """ Returns the number of monitors """
+        return len(self.getScreens())
+    def getBounds(self, screenId):
+        """ Returns the rect of the specified monitor, or of the whole virtual screen if
+        ``screenId`` is -1 """
+        screens, virtual_rect = self._getLayout()
+        if not isinstance(screenId, int) or screenId < -1 or screenId >= len(screens):
+            raise ValueError("Invalid screen ID")
+        if screenId == -1:
+            return virtual_rect
+        return screens[screenId]
+    def getScreenAt(self, x, y):
+        """ Returns the ID of the first monitor containing the point (x, y), or None """
+        for index, (s_x, s_y, s_w, s_h) in enumerate(self.getScreens()):
+            if s_x <= x < s_x + s_w and s_y <= y < s_y + s_h:
+                return index
+        return None
+    def getGeometry(self):
+        """ Returns a string describing the positions and sizes of the monitors """
+        return ";".join("{},{},{},{}".format(*rect) for rect in self.getScreens())
+    def invalidate(self):
+        """ Discards the layout, so it is read again on next use """
+        with self._lock:
+            self._screens = None
+            self._virtual_rect = None
+
+    def _getLayout(self):
+        """ Returns the ``(screens, virtual_rect)``, reading them if they aren't cached (or are
+        due for a check) """
+        interval = Settings.MonitorCheckInterval
+        with self._lock:
+            now = self._clock.time()
+            if self._screens is not None and not (interval and now - self._checked >= interval):
+                return (self._screens, self._virtual_rect)
+            previous = self._screens
+            self._screens = tuple(tuple(screen["rect"]) for screen in self._manager.getScreenDetails())
+            self._virtual_rect = tuple(self._manager.getScreenBounds(-1))
+            self._checked = now
+            layout = (self._screens, self._virtual_rect)
+        if previous is not None and previous != layout[0]:
+            Debug.info("Monitor configuration changed: {}".format(
+                ";".join("{},{},{},{}".format(*rect) for rect in layout[0])))
+            self._manager.resetFrameCache()
+        return layout
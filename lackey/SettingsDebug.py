@@ -155,6 +155,27 @@ class SettingsMaster(object):
     WaitScanRate = 3	# Searches per second
     ObserveScanRate = 3 # Searches per second (observers)
     OberveMinChangedPixels = 50 # Threshold to trigger onChange() (not implemented yet)
+    FindThreads = 1 # Worker threads for multi-pattern searches (findAny, findAllOf)
+    MatchWorkers = 1 # Worker threads for tiled matching of large regions (1 = single pass)
+    MatchTileSize = 512 # Size (in pixels) of the tiles matched in parallel
+    IncrementalMatching = False # Waits only re-match the tiles of the region that changed
+    FrameCacheTTL = 0.05 # Seconds a screen capture is shared between searches, until input is sent (0 to disable)
+    MonitorCheckInterval = 0 # Seconds between checks for a changed monitor layout (0 to only re-read it in Screen.resetMonitors())
+    SkipUnchangedFrames = True # Don't re-run a failed search until the region's pixels change
+    KeyPixelMinArea = 40000 # Needles with at least this many pixels are prefiltered by key pixels
+    KeyPixelCount = 64 # Number of key pixels checked by the prefilter
+    KeyPixelCandidates = 16 # Positions per half-needle cell scored in full after the prefilter
+    KeyPixelMargin = 0.2 # How far below the similarity a position's key pixels may score and still be scored in full (a few pixels vary more than the whole needle)
+    PyramidMaxLevels = 4 # Most pyramid levels a pattern is searched at (fewer if calibration rules them out)
+    PyramidMinScore = 0.7 # Reduced levels where a perfect match scores lower than this aren't searched
+    PyramidMargin = 0.05 # Extra similarity allowance at reduced levels, beyond the calibrated drop
+    ColorVerification = False # Check grayscale matches against the pattern's colors
+    MatchScales = [1.0] # Scales at which patterns are searched for, e.g. [1.0, 2.0, 0.5] for HiDPI screens
+    CheckLastSeen = True # Check where a pattern was last found before searching the whole region
+    LastSeenMargin = 50 # Pixels around the last seen position searched next (0 to skip this step)
+    HintStorePath = None # File where last seen positions are saved between runs (None to disable)
+    HintStoreSize = 10000 # Maximum number of positions kept in the hint store
+    FrameRecordPath = None # File that every captured region is recorded to, for offline replay (None to disable)
 
     ## Keyboard/Mouse Settings
     MoveMouseDelay = 0.3 # Time to take moving mouse to target location
@@ -174,6 +195,7 @@ class SettingsMaster(object):
     except AttributeError:
         BundlePath = os.path.dirname(os.path.abspath(os.getcwd()))
     ImagePaths = []
+    NeedleCacheSize = 64*1024*1024 # Bytes of decoded pattern images to keep in memory
     OcrDataPath = None
 
     ## Popup settings
@@ -1,9 +1,741 @@
 from PIL import Image
+import multiprocessing.pool
+import contextlib
+import hashlib
+import collections
 import itertools
+import threading
 import numpy
 import cv2
 
-from .SettingsDebug import Debug
+from .SettingsDebug import Debug, Settings
+from .ImageCache import CachedImage
+
+class CompiledPattern(object):
+    """ Needle preprocessed for the template matchers
+
+    Holds the grayscale needle, its pyramid levels, and its solid-color classification, so a
+    pattern is only preprocessed once no matter how many times it is searched for.
+
+    The pyramid is calibrated when the pattern is compiled: each reduced level is matched
+    against reduced copies of the needle itself, which gives the score a perfect match loses
+    at that level (``similarityDrops``). Levels that lose too much detail to be searched
+    reliably (scoring less than ``Settings.PyramidMinScore``) are left out, so detailed
+    needles get shallow pyramids and plain ones deep pyramids.
+
+    Reduced levels are matched without their edge pixels (see ``getLevelCore()``), which
+    reduction blends with whatever surrounds the needle on screen.
+    """
+    def __init__(self, image, levels=None):
+        self.image = image
+        self.scale = 1.0
+        self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) # Convert to grayscale
+        self.isSolidColor = (numpy.ptp(self.gray) == 0)
+        self.isSolidBlack = self.isSolidColor and self.gray.mean() == 0
+        if self.isSolidColor:
+            # Correlation is undefined for a solid needle, so use SQDIFF_NORMED instead
+            Debug.log(3, "Solid color, using SQDIFF")
+            self.method = cv2.TM_SQDIFF_NORMED
+        else:
+            self.method = cv2.TM_CCOEFF_NORMED
+        # SQDIFF_NORMED is undefined for solid black, so black needles are matched
+        # against an inverted haystack
+        matching_needle = numpy.invert(self.gray) if self.isSolidBlack else self.gray
+        pyramid = _build_pyramid(matching_needle, levels if levels is not None else Settings.PyramidMaxLevels)
+        drops = _calibratePyramid(pyramid, self.method)
+        depth = 1
+        while depth < len(pyramid) and 1-drops[-depth-1] >= Settings.PyramidMinScore:
+            depth += 1
+        self.pyramid = pyramid[-depth:]
+        # Score lost by a perfect match at each level of the pyramid (smallest first)
+        self.similarityDrops = drops[-depth:]
+        Debug.log(3, "Pyramid of {} levels (of {}), similarity drops {}".format(
+            depth,
+            len(pyramid),
+            ", ".join("{:.3f}".format(drop) for drop in drops)))
+        # Screen position (x, y) where the pattern was last found, checked first by later
+        # searches (see ``PyramidTemplateMatcher.findBestMatchNear()``)
+        self.lastSeen = None
+        # Scale that last matched, by screen (see ``getScaled()``)
+        self.preferredScales = {}
+        self._hash = None
+        self._levels = levels
+        self._scaled = {}
+        self._scaled_lock = threading.Lock()
+        self._key_pixels = {}
+
+    @property
+    def shape(self):
+        """ Shape of the original (color) needle """
+        return self.image.shape
+
+    def getHash(self):
+        """ Returns a hex digest identifying the needle's pixels """
+        if self._hash is None:
+            digest = hashlib.sha1(str(self.image.shape).encode("ascii"))
+            digest.update(numpy.ascontiguousarray(self.image).tobytes())
+            self._hash = digest.hexdigest()
+        return self._hash
+
+    def getScaled(self, scale):
+        """ Returns the pattern resized by ``scale``, compiled (and kept for later searches) """
+        if scale == 1:
+            return self
+        with self._scaled_lock:
+            if scale not in self._scaled:
+                height, width = self.image.shape[:2]
+                size = (max(1, int(round(width*scale))), max(1, int(round(height*scale))))
+                resized = cv2.resize(
+                    self.image,
+                    size,
+                    interpolation=(cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR))
+                scaled = CompiledPattern(resized, self._levels)
+                scaled.scale = scale
+                self._scaled[scale] = scaled
+            return self._scaled[scale]
+
+    def getDepth(self, haystack_shape):
+        """ Returns the number of pyramid levels worth searching in a haystack of
+        ``haystack_shape``
+
+        A smaller level is only added while the next larger one still has more than a few
+        thousand positions to score, so small regions are matched directly.
+        """
+        depth = 1
+        while depth < len(self.pyramid):
+            factor = 2**(depth-1)
+            level_h, level_w = self.pyramid[-depth].shape[:2]
+            positions = (
+                max(0, haystack_shape[0]//factor - level_h + 1)
+                * max(0, haystack_shape[1]//factor - level_w + 1))
+            if positions < _MIN_PYRAMID_POSITIONS:
+                break
+            depth += 1
+        return depth
+
+    def getLevelSimilarity(self, similarity, level):
+        """ Returns the threshold for candidates at pyramid level ``level`` (smallest first)
+        in a search for ``similarity``
+
+        Reduced levels are relaxed by their calibrated drop, plus ``Settings.PyramidMargin``.
+        """
+        if level >= len(self.pyramid)-1:
+            return similarity
+        return max(0, similarity - self.similarityDrops[level] - Settings.PyramidMargin)
+
+    def getLevelCore(self, level):
+        """ Returns the part of pyramid level ``level`` that is matched, and its offset in the
+        level, as ``(core, border)``
+
+        The original-size level is matched whole. Reduced levels leave out a border (of
+        ``_LEVEL_BORDERS`` pixels), whose values depend on the pixels around the needle as much
+        as on the needle, so that a needle scores the same on any background.
+        """
+        border = _getLevelBorder(len(self.pyramid)-1-level)
+        return (_getCore(self.pyramid[level], border), border)
+
+    def getKeyPixels(self, level):
+        """ Returns the key pixels of pyramid level ``level``, for large needles
+
+        Returns a tuple of ``(ys, xs, weights, centered, norm)``: the coordinates of up to
+        ``Settings.KeyPixelCount`` high-variance pixels, spread over a grid across the level's
+        core (see ``getLevelCore()``), and their mean-subtracted values; then the whole
+        mean-subtracted core and its norm, for scoring single positions. Coordinates are
+        relative to the core. Returns None if the needle is smaller than
+        ``Settings.KeyPixelMinArea`` pixels, or is a solid color.
+        """
+        if self.isSolidColor or self.gray.size < Settings.KeyPixelMinArea:
+            return None
+        if level not in self._key_pixels:
+            image = self.getLevelCore(level)[0].astype(numpy.float32)
+            # Local variance over a 3x3 window
+            variance = cv2.blur(image**2, (3, 3)) - cv2.blur(image, (3, 3))**2
+            grid = max(1, int(numpy.sqrt(Settings.KeyPixelCount)))
+            ys = []
+            xs = []
+            for rows in numpy.array_split(numpy.arange(image.shape[0]), grid):
+                for cols in numpy.array_split(numpy.arange(image.shape[1]), grid):
+                    if len(rows) and len(cols):
+                        cell = variance[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+                        y, x = numpy.unravel_index(numpy.argmax(cell), cell.shape)
+                        ys.append(rows[0] + y)
+                        xs.append(cols[0] + x)
+            ys = numpy.array(ys)
+            xs = numpy.array(xs)
+            weights = image[ys, xs] - image[ys, xs].mean()
+            centered = numpy.ascontiguousarray(image - image.mean())
+            norm = float(numpy.sqrt(numpy.sum(centered**2)))
+            if not numpy.any(weights):
+                self._key_pixels[level] = None
+            else:
+                self._key_pixels[level] = (ys, xs, weights, centered, norm)
+        return self._key_pixels[level]
+
+    def getSize(self):
+        """ Returns the number of bytes held by the compiled pattern (and its resized versions) """
+        with self._scaled_lock:
+            scaled = list(self._scaled.values())
+        # The original-size pyramid level is usually ``gray`` itself
+        arrays = [self.gray] + self.pyramid
+        arrays.extend(key_pixels[3] for key_pixels in self._key_pixels.values() if key_pixels)
+        return (_getArraysSize(arrays)
+                + sum(pattern.image.nbytes + pattern.getSize() for pattern in scaled))
+
+def compilePattern(needle):
+    """ Returns a ``CompiledPattern`` for ``needle``
+
+    ``needle`` may be a numpy array, a ``CachedImage`` (whose compiled pattern is stored
+    with the image, and built only once), or an existing ``CompiledPattern``.
+    """
+    if isinstance(needle, CompiledPattern):
+        return needle
+    if isinstance(needle, CachedImage):
+        return needle.getVariant("compiled", lambda: CompiledPattern(needle.image))
+    return CompiledPattern(needle)
+
+class Haystack(object):
+    """ Captured frame prepared for the template matchers
+
+    The grayscale conversion and each pyramid level are built on first use and shared by
+    every search on the frame, whatever the pyramid depth of the needle.
+    """
+    _shared = collections.OrderedDict()
+    _shared_lock = threading.Lock()
+    # Bytes of frames and derived images kept for reuse (the most recent Haystack is always
+    # kept). A 1080p frame with its integral images takes about 45 MB.
+    _shared_bytes = 64 * 1024 * 1024
+
+    def __init__(self, image):
+        self.image = image
+        self._gray = image if image.ndim == 2 else None
+        self._levels = {}
+        self._integrals = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def forImage(cls, image):
+        """ Returns a ``Haystack`` for ``image``, reusing a recent one for the same frame
+
+        Only read-only images (like the frames served by
+        ``PlatformManager.getSharedBitmapFromRect``) are shared, since their pixels can't
+        change under the cached pyramid.
+        """
+        if image.flags.writeable:
+            return cls(image)
+        base = image.base if image.base is not None else image
+        key = (id(base), image.__array_interface__["data"][0], image.shape, image.strides)
+        with cls._shared_lock:
+            haystack = cls._shared.pop(key, None)
+            if haystack is None:
+                haystack = cls(image)
+            # Holding the image keeps its buffer (and so the key) from being reused
+            cls._shared[key] = haystack
+            # Haystacks grow as they're searched, so the total is checked on each lookup
+            total = sum(shared.getSize() for shared in cls._shared.values())
+            while len(cls._shared) > 1 and total > cls._shared_bytes:
+                total -= cls._shared.popitem(last=False)[1].getSize()
+        return haystack
+
+    @property
+    def gray(self):
+        """ Grayscale version of the frame """
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+    @property
+    def shape(self):
+        return self.image.shape
+    def getSize(self):
+        """ Returns the bytes held by the frame and the images derived from it """
+        with self._lock:
+            arrays = [self.image]
+            if self._gray is not None:
+                arrays.append(self._gray)
+            for chain in self._levels.values():
+                arrays.extend(chain)
+            for integrals in self._integrals.values():
+                arrays.extend(integrals)
+            return _getArraysSize(arrays)
+
+    def getPyramid(self, levels, inverted=False):
+        """ Returns up to ``levels`` reduced-size grayscale images, from smallest to original size
+
+        If ``inverted`` is True, the levels are built from the inverted frame (used to match
+        solid black needles).
+        """
+        with self._lock:
+            if inverted not in self._levels:
+                self._levels[inverted] = [numpy.invert(self.gray) if inverted else self.gray]
+            chain = self._levels[inverted]
+            while len(chain) < levels and not any(x < 20 for x in chain[-1].shape[:2]):
+                chain.append(cv2.pyrDown(chain[-1]))
+            return list(reversed(chain[:levels]))
+
+    def getIntegrals(self, image):
+        """ Returns the integral images ``(sums, squares)`` of ``image``, one of the grayscale
+        levels returned by ``getPyramid()`` (not inverted)
+
+        Both are float64 arrays one pixel larger than ``image`` in each direction, so the sum
+        (or sum of squares) of any window takes four lookups (see ``getWindowSums()``).
+        """
+        with self._lock:
+            key = image.shape
+            if key not in self._integrals:
+                self._integrals[key] = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+            return self._integrals[key]
+
+    def getWindowSums(self, image, window_shape, rect=None):
+        """ Returns the sums and sums of squares of the pixels of ``image`` (a pyramid level)
+        in each window of ``window_shape`` (h, w)
+
+        The windows are those of a ``matchTemplate`` result map, optionally limited to the
+        positions in ``rect`` (x, y, w, h).
+        """
+        sums, squares = self.getIntegrals(image)
+        window_h, window_w = window_shape[:2]
+        if rect is None:
+            rect = (0, 0, image.shape[1] - window_w + 1, image.shape[0] - window_h + 1)
+        x, y, w, h = rect
+        def window(integral):
+            total = integral[y+window_h:y+window_h+h, x+window_w:x+window_w+w] - integral[y:y+h, x+window_w:x+window_w+w]
+            total -= integral[y+window_h:y+window_h+h, x:x+w]
+            total += integral[y:y+h, x:x+w]
+            return total
+        return (window(sums), window(squares))
+
+# Worker thread pools by name (OpenCV releases the GIL while matching)
+_thread_pools = {} # Name -> (workers, pool)
+_thread_pool_users = {} # Pool -> number of callers using it
+_thread_pools_lock = threading.Lock()
+@contextlib.contextmanager
+def borrowThreadPool(name, workers):
+    """ Context manager that provides the thread pool called ``name``, with ``workers``
+    threads, replacing the current one if its size has changed
+
+    Each use gets its own pool (tiled matching is "tiles", multi-pattern searches are "find"),
+    so work running on one pool can wait on another without deadlocking. A replaced pool is
+    closed once the callers still using it are done with it.
+    """
+    with _thread_pools_lock:
+        size, pool = _thread_pools.get(name, (0, None))
+        if size != workers:
+            if pool is not None and not _thread_pool_users.get(pool):
+                pool.close()
+            pool = multiprocessing.pool.ThreadPool(workers)
+            _thread_pools[name] = (workers, pool)
+        _thread_pool_users[pool] = _thread_pool_users.get(pool, 0) + 1
+    try:
+        yield pool
+    finally:
+        with _thread_pools_lock:
+            _thread_pool_users[pool] -= 1
+            if not _thread_pool_users[pool]:
+                del _thread_pool_users[pool]
+                if _thread_pools[name][1] is not pool:
+                    pool.close()
+
+def matchTemplate(haystack, needle, method):
+    """ Same as ``cv2.matchTemplate``, but splits large searches into tiles matched in parallel
+
+    If ``Settings.MatchWorkers`` is greater than 1, the result map is divided into tiles of
+    about ``Settings.MatchTileSize`` pixels square (never smaller than the needle). Each tile
+    is matched against the haystack area it depends on (which overlaps its neighbours by the
+    needle size, less one pixel), so the merged map holds the same scores as a single pass
+    (up to floating point rounding in OpenCV's DFT-based correlation).
+    """
+    workers = int(Settings.MatchWorkers)
+    result_h = haystack.shape[0] - needle.shape[0] + 1
+    result_w = haystack.shape[1] - needle.shape[1] + 1
+    tile_h, tile_w = _getTileSize(needle)
+    if workers <= 1 or result_h <= 0 or result_w <= 0 or (result_h <= tile_h and result_w <= tile_w):
+        return cv2.matchTemplate(haystack, needle, method)
+
+    result = numpy.empty((result_h, result_w), dtype=numpy.float32)
+    tiles = [(y, x) for y in range(0, result_h, tile_h) for x in range(0, result_w, tile_w)]
+    _matchTiles(haystack, needle, method, result, tiles, (tile_h, tile_w), workers)
+    return result
+
+def _getTileSize(needle):
+    """ Returns the (height, width) of the result tiles used for ``needle`` """
+    return (max(int(Settings.MatchTileSize), needle.shape[0]),
+            max(int(Settings.MatchTileSize), needle.shape[1]))
+
+def _matchTiles(haystack, needle, method, result, tiles, tile_size, workers):
+    """ Fills the tiles of ``result`` whose top left corners (y, x) are listed in ``tiles`` """
+    needle_h, needle_w = needle.shape[:2]
+    tile_h, tile_w = tile_size
+    def match_tile(tile):
+        y, x = tile
+        h = min(tile_h, result.shape[0] - y)
+        w = min(tile_w, result.shape[1] - x)
+        result[y:y+h, x:x+w] = cv2.matchTemplate(
+            haystack[y:y+h+needle_h-1, x:x+w+needle_w-1],
+            needle,
+            method)
+    if workers > 1 and len(tiles) > 1:
+        with borrowThreadPool("tiles", workers) as pool:
+            pool.map(match_tile, tiles)
+    else:
+        for tile in tiles:
+            match_tile(tile)
+
+class IncrementalScoreMap(object):
+    """ Score map for repeated searches of one needle in frames of the same size
+
+    The map is computed in tiles (see ``matchTemplate()``). On each ``update()``, only the
+    tiles whose input area changed since the previous frame are recomputed, so the map is
+    always identical to computing every tile again, but a frame where only a spinner moved
+    costs a few small matches.
+    """
+    def __init__(self, needle):
+        self.needle = compilePattern(needle)
+        self._frame = None
+        self._scores = None
+        self._tile_size = None
+        self.tilesMatched = 0
+        self.tilesSkipped = 0
+
+    def update(self, haystack):
+        """ Returns the score map for ``haystack`` (a ``Haystack``), updating only changed tiles """
+        needle = self.needle
+        lvl_needle = needle.pyramid[-1]
+        frame = haystack.getPyramid(1, needle.isSolidBlack)[0]
+        needle_h, needle_w = lvl_needle.shape[:2]
+        if needle_h > frame.shape[0] or needle_w > frame.shape[1]:
+            raise ValueError("Image to find is larger than search area")
+        result_h = frame.shape[0] - needle_h + 1
+        result_w = frame.shape[1] - needle_w + 1
+        tile_h, tile_w = _getTileSize(lvl_needle)
+        rows = -(-result_h // tile_h)
+        cols = -(-result_w // tile_w)
+
+        if self._frame is None or self._frame.shape != frame.shape or self._tile_size != (tile_h, tile_w):
+            self._scores = numpy.empty((result_h, result_w), dtype=numpy.float32)
+            dirty = numpy.ones((rows, cols), dtype=bool)
+        else:
+            # Reduce the changed pixels to blocks the size of a tile. Since tiles are at
+            # least as big as the needle, each tile's input spans its own block and the
+            # blocks just below and to the right of it.
+            changed = (frame != self._frame)
+            blocks = numpy.zeros(((rows+1)*tile_h, (cols+1)*tile_w), dtype=bool)
+            blocks[:frame.shape[0], :frame.shape[1]] = changed
+            blocks = blocks.reshape(rows+1, tile_h, cols+1, tile_w).any(axis=(1, 3))
+            dirty = blocks[:-1, :-1] | blocks[1:, :-1] | blocks[:-1, 1:] | blocks[1:, 1:]
+
+        tiles = [(row*tile_h, col*tile_w) for row, col in zip(*numpy.nonzero(dirty))]
+        _matchTiles(frame, lvl_needle, needle.method, self._scores, tiles, (tile_h, tile_w), int(Settings.MatchWorkers))
+        self.tilesMatched += len(tiles)
+        self.tilesSkipped += rows*cols - len(tiles)
+        self._frame = frame
+        self._tile_size = (tile_h, tile_w)
+        return self._scores
+
+    def findBestMatch(self, haystack, similarity):
+        """ Updates the score map for ``haystack`` (a ``Haystack``) and returns the best match
+        as a tuple of ``(position, confidence)``, or None if it isn't similar enough """
+        return _pickBestMatch(haystack, self.update(haystack), self.needle, similarity)
+
+def _getKeyPixelScores(haystack, key_pixels, rect):
+    """ Returns the correlation of the key pixels (see ``CompiledPattern.getKeyPixels()``) with
+    ``haystack`` at each position in ``rect`` (x, y, w, h)
+
+    Only the key pixels are read at each position, so this costs the same however large the
+    needle is.
+    """
+    ys, xs, weights = key_pixels[:3]
+    x, y, w, h = rect
+    sums = numpy.zeros((h, w), dtype=numpy.float32)
+    squares = numpy.zeros((h, w), dtype=numpy.float32)
+    products = numpy.zeros((h, w), dtype=numpy.float32)
+    for key_y, key_x, weight in zip(ys, xs, weights):
+        samples = haystack[y+key_y:y+key_y+h, x+key_x:x+key_x+w].astype(numpy.float32)
+        sums += samples
+        squares += samples**2
+        products += samples * weight
+    # Pearson correlation of the sampled pixels with the key pixels (the weights sum to zero)
+    variance = numpy.maximum(squares - sums**2 / len(weights), 0)
+    denominator = numpy.sqrt(variance * float(numpy.sum(weights**2)))
+    scores = numpy.zeros_like(products)
+    numpy.divide(products, denominator, out=scores, where=denominator > 0)
+    return scores
+
+def _getScoreAt(haystack, key_pixels, x, y):
+    """ Returns the ``TM_CCOEFF_NORMED`` score of the needle of ``key_pixels`` at (x, y)
+
+    For a single position this is much cheaper than ``cv2.matchTemplate``, which transforms
+    the whole window.
+    """
+    centered, norm = key_pixels[3:]
+    window = haystack[y:y+centered.shape[0], x:x+centered.shape[1]]
+    _, stddev = cv2.meanStdDev(window)
+    denominator = norm * float(stddev[0, 0]) * numpy.sqrt(window.size)
+    if denominator == 0:
+        return 0
+    # The needle is mean-subtracted, so the window's mean doesn't affect the dot product
+    score = float(numpy.dot(window.astype(numpy.float32).ravel(), centered.ravel())) / denominator
+    # Clamp float32 rounding, as OpenCV does
+    return min(max(score, -1.0), 1.0)
+
+def _pickKeyPixelCandidates(key_scores, width, threshold, needle_shape):
+    """ Returns the indexes of the positions in ``key_scores`` (the flattened key pixel scores
+    of a region ``width`` positions wide) to score in full
+
+    These are the best ``Settings.KeyPixelCandidates`` positions scoring ``threshold`` or
+    better in each cell of a grid of half-needle cells. The region may hold several matches
+    (as in a flat-background region of interest), and the best positions cluster around the
+    strongest one, so a single cap for the region could miss the others.
+    """
+    candidates = numpy.flatnonzero(key_scores >= threshold)
+    c_y, c_x = numpy.divmod(candidates, width)
+    cells = (c_y // (needle_shape[0]//2 + 1)) * (width // (needle_shape[1]//2 + 1) + 1)
+    cells += c_x // (needle_shape[1]//2 + 1)
+    # Order by cell, best first within each cell, then keep the first few of each cell
+    order = numpy.lexsort((-key_scores[candidates], cells))
+    cells = cells[order]
+    starts = numpy.flatnonzero(numpy.r_[True, cells[1:] != cells[:-1]])
+    ranks = numpy.arange(len(cells)) - numpy.repeat(starts, numpy.diff(numpy.r_[starts, len(cells)]))
+    return candidates[order[ranks < Settings.KeyPixelCandidates]]
+
+def _getSolidScores(haystack, image, needle_shape, color, rect=None):
+    """ Returns the ``TM_SQDIFF_NORMED`` scores of a solid ``color`` needle of ``needle_shape``
+    in ``image`` (a pyramid level of ``haystack``), at each position (optionally limited to
+    ``rect``)
+
+    With a constant needle, the squared difference expands into the window's sum and sum of
+    squares, so each position costs a few integral image lookups whatever the needle size.
+    Black needles are scored as if matched against the inverted haystack (as the pyramid
+    search does), since ``TM_SQDIFF_NORMED`` is undefined for them.
+    """
+    sums, squares = haystack.getWindowSums(image, needle_shape, rect)
+    count = needle_shape[0] * needle_shape[1]
+    color = float(color)
+    if color == 0:
+        # Inverted: the needle is all 255, and each pixel is 255-I
+        differences = squares
+        denominator = sums
+        denominator *= -2*255.0
+        denominator += squares
+        denominator += count*255.0**2
+        numpy.maximum(denominator, 0, out=denominator)
+        denominator *= count*255.0**2
+    else:
+        differences = sums
+        differences *= -2*color
+        differences += squares
+        differences += count*color**2
+        denominator = squares * (count*color**2)
+    numpy.maximum(differences, 0, out=differences)
+    numpy.sqrt(denominator, out=denominator)
+    scores = numpy.ones(differences.shape, dtype=numpy.float32)
+    numpy.divide(differences, denominator, out=scores, where=denominator > 0, casting="unsafe")
+    # Clamped like OpenCV's own normalized scores
+    return numpy.minimum(scores, 1, out=scores)
+
+def _getFlatMask(haystack, image, needle_shape):
+    """ Returns a mask of the positions in ``image`` (a pyramid level of ``haystack``) whose
+    window of ``needle_shape`` is not a single flat color
+
+    A flat window has no variance, so its normalized correlation with any needle is zero
+    (``TM_CCOEFF_NORMED`` can't reach a positive similarity there).
+    """
+    sums, squares = haystack.getWindowSums(image, needle_shape)
+    count = needle_shape[0] * needle_shape[1]
+    # Integer pixels: any window with two different values has a squared deviation >= 0.5
+    return (squares - sums**2 / count) >= 0.5
+
+def _getPeaks(heatmap, needle, similarity):
+    """ Returns the distinct matches for ``needle`` (a ``CompiledPattern``) in ``heatmap`` as
+    ``(position, confidence)`` tuples, best first """
+    if needle.method == cv2.TM_SQDIFF_NORMED:
+        # Invert confidence if we used the SQDIFF method
+        return [
+            (position, 1 - confidence)
+            for position, confidence
+            in findPeaks(heatmap, 1-similarity, needle.shape, needle.method)]
+    return findPeaks(heatmap, similarity, needle.shape, needle.method)
+
+def _pickBestMatch(haystack, heatmap, needle, similarity, offset=(0, 0)):
+    """ Returns the best ``(position, confidence)`` for ``needle`` in ``heatmap`` (whose top
+    left corner is at ``offset`` in ``haystack``), or None if nothing is similar enough
+
+    With color verification on, this is the best candidate that also matches in color.
+    """
+    if _isColorVerified(haystack, needle):
+        for position, confidence in _getPeaks(heatmap, needle, similarity):
+            position = (offset[0] + position[0], offset[1] + position[1])
+            verified = verifyColor(haystack, needle, similarity, [(position, confidence)])
+            if verified:
+                return verified[0]
+        return None
+    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(heatmap)
+    if needle.method == cv2.TM_SQDIFF_NORMED:
+        if min_val > 1-similarity:
+            return None
+        # Invert confidence if we used the SQDIFF method
+        return ((offset[0] + min_loc[0], offset[1] + min_loc[1]), 1 - min_val)
+    if max_val < similarity:
+        return None
+    return ((offset[0] + max_loc[0], offset[1] + max_loc[1]), max_val)
+
+def _isColorVerified(haystack, needle):
+    """ Returns True if matches of ``needle`` in ``haystack`` should be checked in color """
+    return Settings.ColorVerification and haystack.image.ndim == 3 and needle.image.ndim == 3
+
+def verifyColor(haystack, needle, similarity, matches):
+    """ Returns the ``matches`` (``(position, confidence)`` tuples found in grayscale) whose
+    windows of ``haystack`` (a ``Haystack``) also match ``needle`` in color
+
+    Windows are scored with ``TM_CCOEFF_NORMED`` over the BGR channels, so a red icon doesn't
+    match a green one of the same brightness. Solid color needles, for which correlation is
+    undefined, are scored by their mean squared difference instead. Each match's confidence
+    becomes the lower of its grayscale and color scores. Matches are returned unchanged if
+    ``Settings.ColorVerification`` is off.
+    """
+    needle = compilePattern(needle)
+    if not _isColorVerified(haystack, needle):
+        return matches
+    needle_h, needle_w = needle.shape[:2]
+    verified = []
+    for (x, y), confidence in matches:
+        window = haystack.image[y:y+needle_h, x:x+needle_w]
+        if needle.isSolidColor:
+            difference = window.astype(numpy.float32) - needle.image.astype(numpy.float32)
+            score = 1 - float(numpy.mean(difference**2)) / (255**2)
+        else:
+            score = float(cv2.matchTemplate(window, needle.image, cv2.TM_CCOEFF_NORMED)[0, 0])
+        if score >= similarity:
+            verified.append(((x, y), min(confidence, score)))
+        else:
+            Debug.log(3, "Match at {} rejected by color ({})".format((x, y), score))
+    return verified
+
+def findPeaks(match, threshold, needle_shape, method=cv2.TM_CCOEFF_NORMED):
+    """ Returns the distinct matches in the score map ``match``, best first
+
+    Scores must be at or above ``threshold`` (or at or below it, for the SQDIFF methods).
+    Only the best score in any neighbourhood of half the needle size in each direction is
+    kept, so a hit is reported once rather than once per neighbouring pixel, while tightly
+    packed needles (like a grid of icons) are each found.
+
+    Returns a list of ``((x, y), score)`` tuples, with no limit on the number of matches.
+    """
+    if method in (cv2.TM_SQDIFF_NORMED, cv2.TM_SQDIFF):
+        # Negate so that higher is always better
+        scores = -match
+        threshold = -threshold
+    else:
+        scores = match
+    candidates = scores >= threshold
+    if not candidates.any():
+        return []
+    radius_y = needle_shape[0] // 2
+    radius_x = needle_shape[1] // 2
+    # A local maximum is unchanged by dilation over its neighbourhood
+    kernel = numpy.ones((2*radius_y+1, 2*radius_x+1), dtype=numpy.uint8)
+    candidates &= (scores >= cv2.dilate(scores, kernel))
+    ys, xs = numpy.nonzero(candidates)
+    values = scores[ys, xs]
+
+    # Flat score maps (such as a solid needle on a solid background) have plateaus of
+    # equal peaks, so keep only the best candidate in each cell of a grid of half-needle
+    # cells before resolving the remaining ties in order of score.
+    cell_h = radius_y + 1
+    cell_w = radius_x + 1
+    order = numpy.lexsort((xs, ys, -values))
+    cells = (ys[order] // cell_h) * (scores.shape[1] // cell_w + 1) + (xs[order] // cell_w)
+    _, first = numpy.unique(cells, return_index=True)
+    order = order[numpy.sort(first)]
+
+    peaks = []
+    kept = {}
+    for x, y in zip(xs[order], ys[order]):
+        cell_y = y // cell_h
+        cell_x = x // cell_w
+        suppressed = False
+        for neighbour in itertools.product(range(cell_y-1, cell_y+2), range(cell_x-1, cell_x+2)):
+            other = kept.get(neighbour)
+            if other is not None and abs(other[0]-x) <= radius_x and abs(other[1]-y) <= radius_y:
+                suppressed = True
+                break
+        if not suppressed:
+            kept[(cell_y, cell_x)] = (x, y)
+            peaks.append(((int(x), int(y)), float(match[y, x])))
+    return peaks
+
+# Smallest needle size (in pixels, either side) worth matching at a reduced pyramid level
+_MIN_LEVEL_SIZE = 6
+# Edge pixels left out when matching reduced levels, by number of reductions (see
+# ``CompiledPattern.getLevelCore()``). A pixel reduced once depends on pixels up to 1 level
+# pixel away, and after more reductions, up to 2 (less than 1.75, plus up to 1 for the phase).
+_LEVEL_BORDERS = (0, 1, 2)
+# Result map size below which a pyramid level is matched directly (see ``getDepth()``)
+_MIN_PYRAMID_POSITIONS = 4096
+
+def _getArraysSize(arrays):
+    """ Returns the bytes held by ``arrays``, counting an array listed more than once once """
+    unique = {id(array): array for array in arrays}
+    return sum(array.nbytes for array in unique.values())
+
+def _build_pyramid(image, levels):
+    """ Returns a list of reduced-size images, from smallest to original size """
+    pyramid = [image]
+    for l in range(levels-1):
+        if any((x+1)//2 < _MIN_LEVEL_SIZE for x in pyramid[-1].shape[:2]):
+            break
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return list(reversed(pyramid))
+
+def _getLevelBorder(reductions):
+    """ Returns the edge pixels left out of a needle level reduced ``reductions`` times """
+    return _LEVEL_BORDERS[min(reductions, len(_LEVEL_BORDERS)-1)]
+
+def _getCore(image, border):
+    """ Returns ``image`` without its outermost ``border`` pixels """
+    return image[border:image.shape[0]-border, border:image.shape[1]-border]
+
+# Backgrounds a needle is calibrated on: its own edges continued, and contrasting flat colors
+_CALIBRATION_BACKGROUNDS = (
+    (cv2.BORDER_REPLICATE, 0),
+    (cv2.BORDER_REFLECT_101, 0),
+    (cv2.BORDER_CONSTANT, 0),
+    (cv2.BORDER_CONSTANT, 255))
+
+def _calibratePyramid(pyramid, method):
+    """ Returns the score lost by a perfect match at each level of the needle's ``pyramid``
+    (smallest first, so the last drop is zero)
+
+    The needle is placed on a canvas, at each pixel phase of the level's reduction, with its
+    edges continued (replicated or mirrored) around it, and the canvas is reduced as a
+    haystack would be. The drop is one minus the lowest score of the reduced needle's core
+    (see ``CompiledPattern.getLevelCore()``) on these canvases.
+    """
+    needle = pyramid[-1]
+    drops = []
+    for level in range(len(pyramid)-1):
+        reductions = len(pyramid)-1-level
+        factor = 2**reductions
+        worst = 1.0
+        for border, value in _CALIBRATION_BACKGROUNDS:
+            for phase_x, phase_y in itertools.product(range(factor), repeat=2):
+                canvas = cv2.copyMakeBorder(
+                    needle,
+                    2*factor + phase_y,
+                    2*factor,
+                    2*factor + phase_x,
+                    2*factor,
+                    border,
+                    value=value)
+                for _ in range(reductions):
+                    canvas = cv2.pyrDown(canvas)
+                scores = cv2.matchTemplate(canvas, _getCore(pyramid[level], _getLevelBorder(reductions)), method)
+                if method == cv2.TM_SQDIFF_NORMED:
+                    score = 1 - scores.min()
+                else:
+                    score = scores.max()
+                worst = min(worst, float(score))
+        drops.append(max(0.0, 1 - worst))
+    drops.append(0.0)
+    return drops
 
 class NaiveTemplateMatcher(object):
     """ Python wrapper for OpenCV's TemplateMatcher 
@@ -11,6 +743,8 @@ class NaiveTemplateMatcher(object):
     Does not try to optimize speed
     """
     def __init__(self, haystack):
+        if isinstance(haystack, Haystack):
+            haystack = haystack.image
         self.haystack = haystack
 
     def findBestMatch(self, needle, similarity):
@@ -21,10 +755,12 @@ class NaiveTemplateMatcher(object):
         *Developer's Note - Despite the name, this method actually returns the **first** result
         with enough similarity, not the **best** result.*
         """
+        if not isinstance(needle, numpy.ndarray):
+            needle = needle.image
         method = cv2.TM_CCOEFF_NORMED
         position = None
 
-        match = cv2.matchTemplate(self.haystack, needle, method)
+        match = matchTemplate(self.haystack, needle, method)
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(match)
         if method == cv2.TM_SQDIFF_NORMED or method == cv2.TM_SQDIFF:
             confidence = min_val
@@ -48,72 +784,344 @@ class NaiveTemplateMatcher(object):
         Returns an array of tuples ``(position, confidence)`` if match(es) is/are found,
         or an empty array otherwise.
         """
-        positions = []
+        if not isinstance(needle, numpy.ndarray):
+            needle = needle.image
         method = cv2.TM_CCOEFF_NORMED
 
-        match = cv2.matchTemplate(self.haystack, self.needle, method)
+        match = matchTemplate(self.haystack, needle, method)
 
-        indices = (-match).argpartition(100, axis=None)[:100] # Review the 100 top matches
-        unraveled_indices = numpy.array(numpy.unravel_index(indices, match.shape)).T
-        for location in unraveled_indices:
-            y, x = location
-            confidence = match[y][x]
-            if method == cv2.TM_SQDIFF_NORMED or method == cv2.TM_SQDIFF:
-                if confidence <= 1-similarity:
-                    positions.append(((x, y), confidence))
-            else:
-                if confidence >= similarity:
-                    positions.append(((x, y), confidence))
+        if method == cv2.TM_SQDIFF_NORMED or method == cv2.TM_SQDIFF:
+            threshold = 1-similarity
+        else:
+            threshold = similarity
+        positions = findPeaks(match, threshold, needle.shape, method)
 
         positions.sort(key=lambda x: (x[0][1], x[0][0]))
         return positions
 
+# Odd multipliers for the rolling hashes (odd, so they are invertible modulo 2**64)
+_ROW_BASE = 0x9E3779B97F4A7C15
+_COLUMN_BASE = 0xC2B2AE3D27D4EB4F
+# Needle pixels compared at each candidate before falling back to hashing or full comparison
+_EXACT_SAMPLES = 16
+# Hashing a window costs about as much as comparing this many of its pixels
+_HASH_COST = 16
+# Pixels of the haystack copied at once when comparing candidates in full
+_VERIFY_CHUNK = 1 << 22
+
+def _inverse(base):
+    """ Returns the multiplicative inverse of the odd number ``base`` modulo 2**64 """
+    inverse = base
+    for _ in range(6):
+        # Newton's iteration doubles the number of correct low bits each time
+        inverse = (inverse * (2 - base * inverse)) % (1 << 64)
+    return inverse
+
+def _powers(base, count):
+    """ Returns ``base**0 .. base**(count-1)`` modulo 2**64 as a uint64 array """
+    powers = numpy.full(count, base, dtype=numpy.uint64)
+    powers[0] = 1
+    return numpy.cumprod(powers, dtype=numpy.uint64)
+
+def _windowHashes(values, window, base, axis):
+    """ Returns the polynomial hash of every run of ``window`` values along ``axis``
+
+    Hashes are computed modulo 2**64 (numpy's uint64 arithmetic wraps around). Each value
+    is weighted by its absolute position, so the run sums come from a single cumulative sum,
+    and are then normalized to the run's start by multiplying with the inverse powers.
+    """
+    count = values.shape[axis]
+    shape = [1, 1]
+    shape[axis] = -1
+    weighted = values * _powers(base, count).reshape(shape)
+    prefix = numpy.cumsum(weighted, axis=axis, dtype=numpy.uint64)
+    if axis == 0:
+        sums = prefix[window-1:].copy()
+        sums[1:] -= prefix[:count-window]
+    else:
+        sums = prefix[:, window-1:].copy()
+        sums[:, 1:] -= prefix[:, :count-window]
+    return sums * _powers(_inverse(base), count-window+1).reshape(shape)
+
+def _packPixels(image):
+    """ Returns each pixel of a BGR (or grayscale) image as a single integer value """
+    if image.ndim == 2:
+        return image
+    # Pad each pixel to four bytes, then read those as one 32-bit value
+    bgra = numpy.ascontiguousarray(cv2.cvtColor(image, cv2.COLOR_BGR2BGRA))
+    return bgra.view(numpy.uint32)[:, :, 0]
+
+def _getSamplePixels(needle):
+    """ Returns up to ``_EXACT_SAMPLES`` pixels of a packed needle as ``(y, x, value)``, those
+    with the rarest values in the needle first (they are likely the rarest on screen, too) """
+    values, inverse, counts = numpy.unique(needle, return_inverse=True, return_counts=True)
+    order = numpy.argsort(counts[inverse.ravel()], kind="mergesort")[:_EXACT_SAMPLES]
+    ys, xs = numpy.unravel_index(order, needle.shape)
+    return [(int(y), int(x), needle[y, x]) for y, x in zip(ys, xs)]
+
+def _windowView(image, window_shape):
+    """ Returns a read-only view of every ``window_shape`` (h, w) window of a 2D image, with
+    shape (positions_h, positions_w, h, w) """
+    window_h, window_w = window_shape
+    return numpy.lib.stride_tricks.as_strided(
+        image,
+        shape=(image.shape[0]-window_h+1, image.shape[1]-window_w+1, window_h, window_w),
+        strides=image.strides*2,
+        writeable=False)
+
+class ExactTemplateMatcher(object):
+    """ Finds pixel-exact occurrences of a needle (similarity 1.0)
+
+    Candidates are the windows whose pixel at one spot matches the needle's rarest color,
+    narrowed down by comparing a few more of the needle's pixels, and then compared in full.
+    If that would still leave too many to compare (as with a repetitive screen), the windows
+    are first filtered with a 2D rolling hash, which costs the same whatever the size of the
+    needle. Solid color needles are matched by counting, from an integral image, the pixels
+    of each window with the needle's color.
+    """
+    def __init__(self, haystack):
+        if not isinstance(haystack, Haystack):
+            haystack = Haystack.forImage(haystack)
+        self._haystack = haystack
+
+    def findBestMatch(self, needle, similarity=1.0):
+        """ Returns the first exact match of ``needle`` as ``(position, 1.0)``, or None """
+        needle = compilePattern(needle)
+        xs, ys = self._findMatches(self._haystack.image, needle.image)
+        if not len(xs):
+            return None
+        return ((int(xs[0]), int(ys[0])), 1.0)
+
+    def findBestMatchNear(self, needle, similarity, position, margin=0):
+        """ Returns an exact match of ``needle`` at ``position`` (x, y), or within ``margin``
+        pixels of it, as ``(position, 1.0)``; or None """
+        needle = compilePattern(needle)
+        haystack = self._haystack.image
+        needle_h, needle_w = needle.shape[:2]
+        x, y = position
+        x1 = max(x - margin, 0)
+        y1 = max(y - margin, 0)
+        x2 = min(x + needle_w + margin, haystack.shape[1])
+        y2 = min(y + needle_h + margin, haystack.shape[0])
+        if x2 - x1 < needle_w or y2 - y1 < needle_h:
+            return None
+        if margin == 0:
+            window = haystack[y:y+needle_h, x:x+needle_w]
+            return ((x, y), 1.0) if numpy.array_equal(window, needle.image) else None
+        xs, ys = self._findMatches(haystack[y1:y2, x1:x2], needle.image)
+        if not len(xs):
+            return None
+        return ((x1 + int(xs[0]), y1 + int(ys[0])), 1.0)
+
+    def findAllMatches(self, needle, similarity=1.0):
+        """ Returns all exact matches of ``needle`` as a list of ``(position, 1.0)`` tuples
+
+        As with the other matchers, overlapping matches closer than half the needle size are
+        reported once (see ``findPeaks()``).
+        """
+        needle = compilePattern(needle)
+        haystack = self._haystack.image
+        xs, ys = self._findMatches(haystack, needle.image)
+        if not len(xs):
+            return []
+        scores = numpy.zeros(
+            (haystack.shape[0] - needle.shape[0] + 1, haystack.shape[1] - needle.shape[1] + 1),
+            dtype=numpy.float32)
+        scores[ys, xs] = 1
+        positions = findPeaks(scores, 1, needle.shape)
+        positions.sort(key=lambda x: (x[0][1], x[0][0]))
+        return positions
+
+    @staticmethod
+    def _findMatches(haystack, needle):
+        """ Returns the positions of the windows of ``haystack`` equal to ``needle``, as arrays
+        of x and y coordinates in reading order """
+        if haystack.ndim != needle.ndim or haystack.shape[2:] != needle.shape[2:]:
+            raise ValueError("Image to find doesn't have the same channels as search area")
+        needle_h, needle_w = needle.shape[:2]
+        if needle_h > haystack.shape[0] or needle_w > haystack.shape[1]:
+            raise ValueError("Image to find is larger than search area")
+        result_h = haystack.shape[0] - needle_h + 1
+        result_w = haystack.shape[1] - needle_w + 1
+        packed = _packPixels(haystack)
+        packed_needle = _packPixels(needle)
+
+        if (packed_needle == packed_needle[0, 0]).all():
+            # Solid color: count the pixels of that color in each window
+            sums = cv2.integral((packed == packed_needle[0, 0]).view(numpy.uint8))
+            counts = sums[needle_h:, needle_w:] - sums[:result_h, needle_w:]
+            counts -= sums[needle_h:, :result_w]
+            counts += sums[:result_h, :result_w]
+            ys, xs = numpy.nonzero(counts == needle_h * needle_w)
+            return (xs, ys)
+
+        samples = _getSamplePixels(packed_needle)
+        s_y, s_x, value = samples[0]
+        ys, xs = numpy.nonzero(packed[s_y:s_y+result_h, s_x:s_x+result_w] == value)
+        for s_y, s_x, value in samples[1:]:
+            if not len(ys):
+                break
+            keep = packed[ys+s_y, xs+s_x] == value
+            ys = ys[keep]
+            xs = xs[keep]
+        if len(ys) * packed_needle.size > packed.size * _HASH_COST:
+            # Comparing every candidate would cost more than hashing every window
+            def hash_windows(image):
+                rows = _windowHashes(image.astype(numpy.uint64), needle_w, _ROW_BASE, axis=1)
+                return _windowHashes(rows, needle_h, _COLUMN_BASE, axis=0)
+            keep = hash_windows(packed)[ys, xs] == hash_windows(packed_needle)[0, 0]
+            ys = ys[keep]
+            xs = xs[keep]
+
+        # Compare the remaining candidates in full, a batch at a time
+        windows = _windowView(packed, (needle_h, needle_w))
+        batch = max(1, _VERIFY_CHUNK // packed_needle.size)
+        keep = numpy.zeros(len(ys), dtype=bool)
+        for start in range(0, len(ys), batch):
+            candidates = windows[ys[start:start+batch], xs[start:start+batch]]
+            keep[start:start+batch] = (candidates == packed_needle).all(axis=(1, 2))
+        return (xs[keep], ys[keep])
+
 class PyramidTemplateMatcher(object):
     """ Python wrapper for OpenCV's TemplateMatcher
 
     Uses a pyramid model to optimize matching speed
     """
     def __init__(self, haystack):
-        self.haystack = cv2.cvtColor(haystack, cv2.COLOR_BGR2GRAY) # Convert to grayscale
-        self._iterations = 3 # Number of times to downsample
+        if not isinstance(haystack, Haystack):
+            haystack = Haystack.forImage(haystack)
+        self._haystack = haystack
+
+    @property
+    def haystack(self):
+        """ Grayscale version of the haystack """
+        return self._haystack.gray
+
+    def getHaystack(self):
+        """ Returns the ``Haystack`` searched by this matcher """
+        return self._haystack
 
     def findBestMatch(self, needle, similarity):
         """ Finds the best match using a search pyramid to improve efficiency
 
         Pyramid implementation unashamedly stolen from https://github.com/stb-tester/stb-tester
 
+        ``needle`` may be a numpy array, a ``CachedImage``, or a ``CompiledPattern`` (see
+        ``compilePattern()``); the latter two are only preprocessed once.
+
+        Exact searches (``similarity`` of 1.0 or more) use ``ExactTemplateMatcher``.
+
         *Developer's Note - Despite the name, this method actually returns the **first** result
         with enough similarity, not the **best** result.*
         """
-        needle = cv2.cvtColor(needle, cv2.COLOR_BGR2GRAY) # Convert to grayscale
-        haystack = self.haystack
-        # Check if haystack or needle are a solid color - if so, switch to SQDIFF_NORMED
-
-        if self._is_solid_color(needle):
-            print("Solid color, using SQDIFF")
-            method = cv2.TM_SQDIFF_NORMED
-            if self._is_solid_black(needle):
-                print("Inverting images")
-                # Invert needle & haystack before matching
-                needle = numpy.invert(needle)
-                haystack = numpy.invert(haystack)
+        if similarity >= 1.0:
+            return ExactTemplateMatcher(self._haystack).findBestMatch(needle, similarity)
+        needle = compilePattern(needle)
+        matches_heatmap = self._search(needle, similarity)
+        if matches_heatmap is None:
+            return None
+        return _pickBestMatch(self._haystack, matches_heatmap, needle, similarity)
+
+    def findBestMatchNear(self, needle, similarity, position, margin=0):
+        """ Checks for ``needle`` at ``position`` (x, y) in the haystack, or within ``margin``
+        pixels of it
+
+        Only the original-size haystack around ``position`` is matched, so this costs about as
+        much as comparing the needle with a patch of the screen. Scores are the same as those
+        of ``findBestMatch()``. Returns a tuple of ``(position, confidence)`` if a match is
+        found, or ``None`` otherwise.
+        """
+        if similarity >= 1.0:
+            return ExactTemplateMatcher(self._haystack).findBestMatchNear(needle, similarity, position, margin)
+        needle = compilePattern(needle)
+        method = needle.method
+        lvl_needle = needle.pyramid[-1]
+        lvl_haystack = self._haystack.getPyramid(1, needle.isSolidBlack)[0]
+        needle_h, needle_w = lvl_needle.shape[:2]
+        x, y = position
+        x1 = max(x - margin, 0)
+        y1 = max(y - margin, 0)
+        x2 = min(x + needle_w + margin, lvl_haystack.shape[1])
+        y2 = min(y + needle_h + margin, lvl_haystack.shape[0])
+        if x2 - x1 < needle_w or y2 - y1 < needle_h:
+            # Position is (partly) outside the haystack
+            return None
+
+        if needle.isSolidColor:
+            matches_heatmap = _getSolidScores(
+                self._haystack,
+                self._haystack.getPyramid(1)[0],
+                lvl_needle.shape,
+                needle.gray[0, 0],
+                (x1, y1, x2 - x1 - needle_w + 1, y2 - y1 - needle_h + 1))
         else:
-            #print("Not Solid color, using CCOEFF")
-            method = cv2.TM_CCOEFF_NORMED
-
-        levels = 3
-        needle_pyramid = self._build_pyramid(needle, levels)
-        # Needle will be smaller than haystack, so may not be able to create
-        # ``levels`` smaller versions of itself. If not, create only as many
-        # levels for ``haystack`` as we could for ``needle``.
-        haystack_pyramid = self._build_pyramid(haystack, min(levels, len(needle_pyramid)))
+            matches_heatmap = matchTemplate(lvl_haystack[y1:y2, x1:x2], lvl_needle, method)
+        return _pickBestMatch(self._haystack, matches_heatmap, needle, similarity, (x1, y1))
+
+    def findAllMatches(self, needle, similarity):
+        """ Finds all matches above ``similarity`` using a search pyramid to improve efficiency
+
+        Candidates from every level are refined together in a single pass down the pyramid,
+        and the distinct peaks of the original-size heatmap are returned (see ``findPeaks()``).
+
+        Exact searches (``similarity`` of 1.0 or more) use ``ExactTemplateMatcher``.
+
+        Pyramid implementation unashamedly stolen from https://github.com/stb-tester/stb-tester
+        """
+        if similarity >= 1.0:
+            return ExactTemplateMatcher(self._haystack).findAllMatches(needle, similarity)
+        needle = compilePattern(needle)
+        matches_heatmap = self._search(needle, similarity)
+        if matches_heatmap is None:
+            return []
+
+        positions = verifyColor(
+            self._haystack,
+            needle,
+            similarity,
+            _getPeaks(matches_heatmap, needle, similarity))
+        positions.sort(key=lambda x: (x[0][1], x[0][0]))
+        return positions
+
+    def _search(self, needle, similarity):
+        """ Runs ``needle`` (a ``CompiledPattern``) down the search pyramid
+
+        Each level only searches the regions of interest that scored above the (relaxed)
+        threshold at the previous level. Returns the heatmap for the original-size haystack,
+        scored in every region that survived to the last level, or None if no candidate made
+        it that far.
+
+        Solid color needles are scored from integral images (see ``_getSolidScores()``), at a
+        cost that doesn't depend on their size. Other needles skip the flat areas of the
+        haystack at the first level, since correlation can't find anything there.
+        """
+        method = needle.method
+
+        # Search as many levels as are worth it for this haystack (see
+        # ``CompiledPattern.getDepth()``). The haystack may not shrink as far as the
+        # needle, in which case its smallest levels are skipped. Solid black needles
+        # are matched against the inverted haystack.
+        haystack_pyramid = self._haystack.getPyramid(
+            needle.getDepth(self._haystack.gray.shape),
+            needle.isSolidBlack)
+        first_level = len(needle.pyramid) - len(haystack_pyramid)
+        needle_pyramid = needle.pyramid[first_level:]
+        if needle.isSolidColor:
+            # Scored from the integrals of the original pyramid, even for black needles
+            solid_pyramid = self._haystack.getPyramid(len(haystack_pyramid))
         roi_mask = None
 
         # Run through each level in the pyramid, refining found ROIs
         for level in range(len(haystack_pyramid)):
+            # Reduce similarity to allow for scaling distortion
+            # (unless we are on the original image)
+            pyr_similarity = needle.getLevelSimilarity(similarity, first_level + level)
             # Populate the heatmap with ones or zeroes depending on the appropriate method
             lvl_haystack = haystack_pyramid[level]
             lvl_needle = needle_pyramid[level]
+            # Reduced levels are matched without their edges, which are offset by ``border``
+            # from the needle's position
+            lvl_core, border = needle.getLevelCore(first_level + level)
             if (lvl_needle.shape[0] > lvl_haystack.shape[0]) or (lvl_needle.shape[1] > lvl_haystack.shape[1]):
                 raise ValueError("Image to find is larger than search area")
             matches_heatmap = (
@@ -132,6 +1140,13 @@ class PyramidTemplateMatcher(object):
             # If roi_mask is set, only search the best candidates in haystack
             # for the needle:
 
+            if roi_mask is None and level == 0 and not needle.isSolidColor:
+                # Only search the parts of the image that aren't flat, if that saves much
+                roi_mask = _getFlatMask(self._haystack, lvl_haystack, lvl_needle.shape).astype(numpy.uint8)
+                if not roi_mask.any():
+                    return None
+                if cv2.countNonZero(roi_mask) > roi_mask.size // 2:
+                    roi_mask = None
             if roi_mask is None:
                 # Initialize mask to the whole image
                 rois = [(0, 0, matches_heatmap.shape[1], matches_heatmap.shape[0])]
@@ -151,46 +1166,85 @@ class PyramidTemplateMatcher(object):
                         cv2.CHAIN_APPROX_NONE)
                 # Expand contour rect by 1px on all sides with some tuple magic
                 rois = [tuple(sum(y) for y in zip(cv2.boundingRect(x), (-1, -1, 2, 2))) for x in contours]
-
+            Debug.log(3, "Pyramid level {}: {} regions of interest, similarity {:.3f}".format(
+                first_level + level,
+                len(rois),
+                pyr_similarity))
 
             for roi in rois:
                 # Trim ROI bounds to zero (if negative)
                 x, y, w, h = roi
                 x = max(x, 0)
                 y = max(y, 0)
+                # ...and to the heatmap
+                w = min(w, matches_heatmap.shape[1] - x)
+                h = min(h, matches_heatmap.shape[0] - y)
+                if w <= 0 or h <= 0:
+                    continue
+
+                # For large needles, check the key pixels at each position of the region
+                # first, and only score the positions that match them best
+                key_pixels = needle.getKeyPixels(first_level + level) if roi_mask is not None else None
+                if key_pixels is not None:
+                    key_scores = _getKeyPixelScores(
+                        lvl_haystack,
+                        key_pixels,
+                        (x+border, y+border, w, h)).ravel()
+                    # A handful of pixels is a noisier estimate, so relax the threshold further
+                    candidates = _pickKeyPixelCandidates(
+                        key_scores,
+                        w,
+                        pyr_similarity - Settings.KeyPixelMargin,
+                        lvl_core.shape)
+                    best_score = None
+                    for candidate in candidates:
+                        c_y, c_x = divmod(int(candidate), w)
+                        score = _getScoreAt(
+                            lvl_haystack,
+                            key_pixels,
+                            x+c_x+border,
+                            y+c_y+border)
+                        matches_heatmap[y+c_y, x+c_x] = score
+                        best_score = score if best_score is None else max(best_score, score)
+                    if best_score is not None and best_score >= pyr_similarity:
+                        continue
+                    # The key pixels can miss a match whose needle is noisy or partly covered
+                    # where they sit; the region came from a match at the level below, so
+                    # search it in full before giving up on it
+                    Debug.log(3, "Key pixels found no match, searching region in full")
+
+                if needle.isSolidColor:
+                    matches_heatmap[y:y+h, x:x+w] = _getSolidScores(
+                        self._haystack,
+                        solid_pyramid[level],
+                        lvl_core.shape,
+                        needle.gray[0, 0],
+                        (x+border, y+border, w, h))
+                    continue
+
                 # Add needle dimensions to roi
-                roi = (x, y, w+lvl_needle.shape[1]-1, h+lvl_needle.shape[0]-1)
+                roi = (x+border, y+border, w+lvl_core.shape[1]-1, h+lvl_core.shape[0]-1)
                 # numpy 2D slice
                 roi_slice = (slice(roi[1], roi[1]+roi[3]), slice(roi[0], roi[0]+roi[2]))
                 # numpy 2D slice
                 r_slice = (slice(y, y+h), slice(x, x+w))
 
                 # Search the region of interest for needle (and update heatmap)
-                matches_heatmap[r_slice] = cv2.matchTemplate(
+                matches_heatmap[r_slice] = matchTemplate(
                     lvl_haystack[roi_slice],
-                    lvl_needle,
+                    lvl_core,
                     method)
 
             min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(matches_heatmap)
-            # Reduce similarity to allow for scaling distortion
-            # (unless we are on the original image)
-            pyr_similarity = max(0, similarity - (0.2 if level < len(haystack_pyramid)-1 else 0))
-            position = None
-            confidence = None
             # Check for a match
             if method == cv2.TM_SQDIFF_NORMED:
-                confidence = min_val
-                if min_val <= 1-pyr_similarity:
-                    # Confidence checks out
-                    position = min_loc
+                found = min_val <= 1-pyr_similarity
             else:
-                confidence = max_val
-                if max_val >= pyr_similarity:
-                    # Confidence checks out
-                    position = max_loc
+                found = max_val >= pyr_similarity
 
-            if not position:
-                break
+            if not found:
+                Debug.log(3, "Best match: {} at {}".format(max_val, max_loc))
+                return None
 
             # Find the best regions of interest
             _, roi_mask = cv2.threshold(
@@ -204,55 +1258,4 @@ class PyramidTemplateMatcher(object):
                 (cv2.THRESH_BINARY_INV if method == cv2.TM_SQDIFF_NORMED else cv2.THRESH_BINARY))
             roi_mask = roi_mask.astype(numpy.uint8)
 
-        # Whew! Let's see if there's a match after all that.
-
-        if not position:
-            Debug.log(3, "Best match: {} at {}".format(max_val, max_loc))
-            return None
-
-        # There was a match!
-        if method == cv2.TM_SQDIFF_NORMED:
-            confidence = 1 - confidence # Invert confidence if we used the SQDIFF method
-        return (position, confidence)
-
-    def findAllMatches(self, needle, similarity):
-        """ Finds all matches above ``similarity`` using a search pyramid to improve efficiency
-
-        Pyramid implementation unashamedly stolen from https://github.com/stb-tester/stb-tester
-        """
-        positions = []
-        # Use findBestMatch to get the best match
-        while True:
-            best_match = self.findBestMatch(needle, similarity)
-            if best_match is None: # No more matches
-                break
-            # Found a match. Add it to our list
-            positions.append(best_match) # (position, confidence)
-
-            # Erase the found match from the haystack.
-            # Repeat this process until no other matches are found
-            x, y = best_match[0]
-            w = needle.shape[1]
-            h = needle.shape[0]
-            roi = (x, y, w, h)
-            # numpy 2D slice
-            roi_slice = (slice(roi[1], roi[1]+roi[3]), slice(roi[0], roi[0]+roi[2]))
-            self.haystack[roi_slice] = 0
-
-        # Whew! Let's see if there's a match after all that.
-        positions.sort(key=lambda x: (x[0][1], x[0][0]))
-        return positions
-
-    def _build_pyramid(self, image, levels):
-        """ Returns a list of reduced-size images, from smallest to original size """
-        pyramid = [image]
-        for l in range(levels-1):
-            if any(x < 20 for x in pyramid[-1].shape[:2]):
-                break
-            pyramid.append(cv2.pyrDown(pyramid[-1]))
-        return list(reversed(pyramid))
-    def _is_solid_color(self, image):
-        return image.ptp() == 0
-    
-    def _is_solid_black(self, image):
-        return image.mean() == 0
\ No newline at end of file
+        return matches_heatmap
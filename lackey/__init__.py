@@ -20,7 +20,6 @@ try:
 except ImportError:
     import _thread as thread
 import sys
-import time
 import os
 import warnings
 import requests
@@ -40,14 +39,21 @@ from ._version import __version__
 
 from . import ImportHandler
 
-VALID_PLATFORMS = ["Windows", "Darwin"]
+VALID_PLATFORMS = ["Windows", "Darwin", "Linux"]
 
 ## Define script abort hotkey (Alt+Shift+C)
 
 def _abort_script():
     thread.interrupt_main()
 
-keyboard.add_hotkey("alt+shift+c", _abort_script, suppress=True)
+if os.environ.get("LACKEY_PLATFORM") != "virtual":
+    # The virtual platform has no keyboard to listen to
+    try:
+        keyboard.add_hotkey("alt+shift+c", _abort_script, suppress=True)
+    except (ImportError, AssertionError, OSError):
+        # Listening to the keyboard requires root on Linux, and input devices (which
+        # containers and headless machines may not have)
+        pass
 
 ## Sikuli patching: Functions that map to the global Screen region
 ## Don't try this at home, kids!
@@ -78,8 +84,8 @@ def _type(obj):
 ## Sikuli Convenience Functions
 
 def sleep(seconds):
-    """ Convenience function. Pauses script for `seconds`. """
-    time.sleep(seconds)
+    """ Convenience function. Pauses script for `seconds` (by the platform's clock). """
+    PlatformManager.getClock().sleep(seconds)
 
 def exit(value):
     """ Convenience function. Exits with code `value`. """
@@ -240,10 +246,16 @@ def popFile(title="Lackey Open File"):
     return str(tkFileDialog.askopenfilename(title=title))
 
 # If this is a valid platform, set up initial Screen object. Otherwise, might be ReadTheDocs
-if platform.system() in VALID_PLATFORMS:
-    SCREEN = Screen(0)
-    for prop in dir(SCREEN):
-        if callable(getattr(SCREEN, prop, None)) and prop[0] != "_":
-            # Property is a method, and is not private. Dump it into the global namespace.
-            globals()[prop] = getattr(SCREEN, prop, None)
+if platform.system() in VALID_PLATFORMS or os.environ.get("LACKEY_PLATFORM") == "virtual":
+    try:
+        SCREEN = Screen(0)
+    except OSError as e:
+        # No display to drive (e.g. a headless Linux machine): Lackey can still be imported,
+        # but the global Screen methods aren't available
+        warnings.warn("Screen unavailable: {}".format(e), RuntimeWarning)
+    else:
+        for prop in dir(SCREEN):
+            if callable(getattr(SCREEN, prop, None)) and prop[0] != "_":
+                # Property is a method, and is not private. Dump it into the global namespace.
+                globals()[prop] = getattr(SCREEN, prop, None)
             
\ No newline at end of file
@@ -41,6 +41,7 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: Microsoft :: Windows",
         "Operating System :: MacOS :: MacOS X",
+        "Operating System :: POSIX :: Linux",
         "Topic :: Software Development :: Testing",
         "Topic :: Utilities",
         "Topic :: Desktop Environment"
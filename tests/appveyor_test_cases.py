@@ -1,11 +1,15 @@
 import inspect
 import subprocess
+import tempfile
 import unittest
 import numpy
 import time
 import sys
 import os
 import lackey
+import cv2
+
+from lackey.PlatformManagerVirtual import PlatformManagerVirtual, VirtualClock
 
 # Python 2/3 compatibility
 try:
@@ -130,6 +134,434 @@ class TestScreenMethods(unittest.TestCase):
         tpath = self.primaryScreen.capture()
         self.assertIsInstance(tpath, numpy.ndarray)
 
+class TestRegionStorage(unittest.TestCase):
+    def test_slots(self):
+        region = lackey.Region(10, 20, 30, 40)
+        match = lackey.Match(0.9, lackey.Location(0, 0), ((10, 20), (30, 40)))
+        for obj in (region, match, lackey.Location(1, 2)):
+            self.assertFalse(hasattr(obj, "__dict__"))
+            with self.assertRaises(AttributeError):
+                obj.notAnAttribute = True
+        with self.assertRaises(AttributeError):
+            region.notAnAttribute
+        self.assertEqual(match.getTuple(), (10, 20, 30, 40))
+        self.assertEqual(match.getTarget().getTuple(), (25, 40))
+
+    def test_lazy_state(self):
+        region = lackey.Region(0, 0, 100, 50)
+        # Unset state reads as its default
+        self.assertEqual(region.getFindFailedResponse(), "ABORT")
+        self.assertTrue(region.getThrowException())
+        self.assertEqual(region.getRepeatWaitTime(), 0.3)
+        region.setThrowException(False)
+        self.assertEqual(region.getFindFailedResponse(), "SKIP")
+        # The observer is only created when needed
+        self.assertIsNone(region._lazyObserver)
+        self.assertFalse(region.isObserving())
+        self.assertIsNotNone(region._lazyObserver)
+        self.assertFalse(lackey.Region(region).hasObserver())
+        # Raster
+        self.assertFalse(region.isRasterValid())
+        region.setRows(2)
+        self.assertEqual((region.getRows(), region.getCols()), (2, 1))
+        region.setCols(4)
+        self.assertEqual(region.getColW(), 25)
+        self.assertEqual(lackey.Region(0, 0, 10, 10).getRows(), 0)
+
+@unittest.skipUnless(
+    sys.platform.startswith("linux") and os.environ.get("DISPLAY") and os.environ.get("LACKEY_PLATFORM") != "virtual",
+    "Requires an X display")
+class TestPlatformManagerLinux(unittest.TestCase):
+    def test_capture(self):
+        x, y, w, h = lackey.PlatformManager.getScreenBounds(0)
+        backend = lackey.PlatformManager.getCaptureBackend()
+        bitmap = backend.capture(x, y, w, h)
+        self.assertEqual(bitmap.shape, (h, w, 3))
+        self.assertEqual(bitmap.dtype, numpy.uint8)
+        # Rects of any size read the same pixels as the whole screen
+        part = backend.capture(x+10, y+20, 31, 17)
+        self.assertEqual(part.shape, (17, 31, 3))
+        self.assertTrue((part == bitmap[20:37, 10:41]).all())
+
+    def test_screen_details(self):
+        screens = lackey.PlatformManager.getScreenDetails()
+        self.assertGreater(len(screens), 0)
+        self.assertEqual(screens[0]["rect"][:2], (0, 0))
+        self.assertTrue(lackey.PlatformManager.isPointVisible(0, 0))
+        self.assertFalse(lackey.PlatformManager.isPointVisible(-1, -1))
+
+    def getBackends(self):
+        """ Returns the (MIT-SHM, XGetImage) capture backends for the test display """
+        from lackey.PlatformManagerLinux import XShmCaptureBackend, XGetImageCaptureBackend
+        manager = lackey.PlatformManager
+        if os.environ["DISPLAY"].split(":")[0] not in ("", "unix"):
+            self.skipTest("MIT-SHM needs a local display")
+        shm_backend = manager.getCaptureBackend()
+        self.assertIsInstance(shm_backend, XShmCaptureBackend)
+        return (shm_backend, XGetImageCaptureBackend(manager._xlib, manager._display, manager._lock))
+
+    def test_capture_rate(self):
+        # Full screen captures per second through each backend, bypassing the frame cache
+        x, y, w, h = lackey.PlatformManager.getScreenBounds(0)
+        frames = []
+        for backend in self.getBackends():
+            backend.capture(x, y, w, h)
+            count = 0
+            start = time.time()
+            while count < 10 or time.time() - start < 1:
+                frame = backend.capture(x, y, w, h)
+                count += 1
+            sys.stderr.write("\n{} ({}x{}): {:.1f} captures/s ".format(
+                type(backend).__name__, w, h, count / (time.time() - start)))
+            frames.append(frame)
+        self.assertTrue((frames[0] == frames[1]).all())
+
+    def test_shm_segments(self):
+        from lackey.PlatformManagerLinux import XShmCaptureBackend
+        shm_backend, getimage_backend = self.getBackends()
+        manager = lackey.PlatformManager
+        backend = XShmCaptureBackend(
+            manager._xlib, shm_backend._xext, manager._display, manager._lock, max_segments=2)
+        # Segments are reused for each rect size, and the least recently used are detached
+        for rect in [(0, 0, 10, 10), (5, 5, 20, 10), (20, 30, 10, 10), (0, 0, 31, 17)]:
+            self.assertTrue((backend.capture(*rect) == getimage_backend.capture(*rect)).all())
+            self.assertLessEqual(len(backend._segments), 2)
+        self.assertEqual([size for size, _, _ in backend._segments], [(10, 10), (31, 17)])
+        backend.close()
+        self.assertEqual(backend._segments, [])
+        # Attaches a new segment after closing
+        self.assertEqual(backend.capture(0, 0, 10, 10).shape, (10, 10, 3))
+        backend.close()
+
+    def test_processes(self):
+        self.assertTrue(lackey.PlatformManager.isPIDValid(os.getpid()))
+        self.assertIn("python", lackey.PlatformManager.getProcessName(os.getpid()))
+        self.assertIsNone(lackey.PlatformManager.getWindowByTitle("^No such window title$"))
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "Requires Linux")
+class TestHeadlessImport(unittest.TestCase):
+    def test_import(self):
+        # Without a display, Lackey imports, and using the screen explains what's missing
+        env = dict(os.environ)
+        env.pop("DISPLAY", None)
+        env.pop("LACKEY_PLATFORM", None)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(lackey.__file__)))
+        script = "\n".join([
+            "import lackey",
+            "try:",
+            "    lackey.Screen(0)",
+            "except OSError as e:",
+            "    print(e)"])
+        output = subprocess.check_output([sys.executable, "-W", "ignore", "-c", script], env=env)
+        self.assertIn(b"LACKEY_PLATFORM=virtual", output)
+
+class TestPlatformManagerVirtual(unittest.TestCase):
+    def setUp(self):
+        self.devices = lackey.InputEmulation.getInputDevices()
+        self.manager = PlatformManagerVirtual()
+        self.manager.setScreens([(0, 0, 200, 100)])
+        self.clock = self.manager.getClock()
+
+    def tearDown(self):
+        lackey.InputEmulation.setInputDevices(*self.devices)
+
+    def test_clock(self):
+        start = time.time()
+        self.clock.sleep(3600)
+        self.assertEqual(self.clock.time(), 3600)
+        self.assertLess(time.time() - start, 1)
+        self.assertRaises(ValueError, self.clock.sleep, -1)
+
+    def test_frame_sequence(self):
+        first = numpy.zeros((100, 200, 3), dtype=numpy.uint8)
+        second = numpy.full((100, 200, 3), 255, dtype=numpy.uint8)
+        self.manager.setFrame(first)
+        self.manager.addFrame(second, 2)
+        self.assertEqual(self.manager.getBitmapFromRect(0, 0, 200, 100).max(), 0)
+        self.clock.sleep(2)
+        self.assertEqual(self.manager.getBitmapFromRect(10, 10, 5, 5).min(), 255)
+        # Parts of the rect outside the screen are clipped
+        self.assertEqual(self.manager.getBitmapFromRect(190, 90, 20, 20).shape, (10, 10, 3))
+        self.assertRaises(ValueError, self.manager.addFrame, os.path.join(tempfile.gettempdir(), "missing.png"))
+
+    def test_input_recording(self):
+        mouse = lackey.Mouse()
+        mouse.moveSpeed(lackey.Location(20, 30))
+        mouse.click()
+        lackey.Keyboard().type("a", delay=0.5)
+        events = [event[1:] for event in self.manager.getInputEvents()]
+        self.assertEqual(events, [
+            ("mouse", "move", (20, 30)),
+            ("mouse", "click", "left"),
+            ("keyboard", "press", "a"),
+            ("keyboard", "release", "a")])
+        # Timed moves and typing delays take place on the clock
+        self.assertAlmostEqual(self.clock.time(), 0.8)
+        self.manager.clearInputEvents()
+        self.assertEqual(self.manager.getInputEvents(), [])
+
+    def test_shared_frames(self):
+        self.manager.setFrame(numpy.zeros((100, 200, 3), dtype=numpy.uint8))
+        shared = self.manager.getSharedBitmapFromRect(0, 0, 10, 10)
+        self.assertFalse(shared.flags.writeable)
+        # Callers get arrays they can draw on, without changing the shared frame
+        bitmap = self.manager.getBitmapFromRect(0, 0, 10, 10)
+        bitmap[:] = 255
+        self.assertEqual(shared.max(), 0)
+        self.assertEqual(self.manager.getFrameCacheStats()["misses"], 1)
+        # Input may change the screen, so it discards the cached frames
+        lackey.Mouse().click()
+        self.manager.getSharedBitmapFromRect(0, 0, 10, 10)
+        self.assertEqual(self.manager.getFrameCacheStats()["misses"], 2)
+
+    def test_windows(self):
+        hwnd = self.manager.addWindow("Virtual Notepad", (10, 20, 100, 50), pid=1234)
+        other = self.manager.addWindow("Other", (0, 0, 10, 10), pid=1234)
+        self.assertEqual(self.manager.getForegroundWindow(), other)
+        self.assertEqual(self.manager.getWindowByTitle("notepad"), hwnd)
+        self.assertEqual(self.manager.getWindowByPID(1234, 1), hwnd)
+        self.manager.focusWindow(hwnd)
+        self.assertEqual(self.manager.getForegroundWindow(), hwnd)
+        self.assertEqual(self.manager.getWindowRect(hwnd), (10, 20, 100, 50))
+        self.assertTrue(self.manager.isPIDValid(1234))
+        self.manager.killProcess(1234)
+        self.assertFalse(self.manager.isPIDValid(1234))
+        self.assertIsNone(self.manager.getForegroundWindow())
+
+@unittest.skipUnless(os.environ.get("LACKEY_PLATFORM") == "virtual", "Requires the virtual platform")
+class TestVirtualRegionMethods(unittest.TestCase):
+    def test_wait(self):
+        manager = lackey.PlatformManager
+        clock = manager.getClock()
+        x, y, w, h = manager.getScreenBounds(0)
+        needle = numpy.random.RandomState(0).randint(0, 255, (20, 30, 3)).astype(numpy.uint8)
+        frame = numpy.full((h, w, 3), 128, dtype=numpy.uint8)
+        manager.setFrame(frame.copy())
+        frame[50:70, 40:70] = needle
+        manager.addFrame(frame, clock.time() + 2)
+        manager.clearInputEvents()
+        region = lackey.Region(x, y, w, h)
+        pattern = lackey.Pattern(needle)
+        start = clock.time()
+        self.assertIsNone(region.exists(pattern, 1))
+        match = region.wait(pattern, 5)
+        self.assertEqual((match.getX(), match.getY()), (x+40, y+50))
+        self.assertGreaterEqual(clock.time() - start, 2)
+        self.assertLess(clock.time() - start, 3)
+        region.click(match)
+        self.assertIn(("mouse", "click", "left"), [event[1:] for event in manager.getInputEvents()])
+
+    def test_set_screens(self):
+        manager = lackey.PlatformManager
+        screens = [screen["rect"] for screen in manager.getScreenDetails()]
+        self.assertEqual(lackey.Screen.getNumberScreens(), len(screens))
+        # Regions see the new layout right away
+        manager.setScreens([(0, 0, 800, 600), (800, 0, 400, 300)])
+        try:
+            self.assertEqual(lackey.Screen.getNumberScreens(), 2)
+            self.assertEqual(lackey.Screen(1).getBounds(), (800, 0, 400, 300))
+        finally:
+            manager.setScreens(screens)
+        self.assertEqual(lackey.Screen.getNumberScreens(), len(screens))
+
+class TestScreenCapture(unittest.TestCase):
+    def setUp(self):
+        self.frame = numpy.arange(40*30*3, dtype=numpy.uint8).reshape((30, 40, 3))
+        self.backend = lackey.ScreenCapture.ArrayCaptureBackend(self.frame, (-10, -5))
+        self.original_backend = lackey.PlatformManager.getCaptureBackend()
+        self.bounds = lackey.PlatformManager.getScreenBounds(0)
+        self.pattern = lackey.Pattern(os.path.join("tests", "test_pattern.png"))
+
+    def tearDown(self):
+        lackey.PlatformManager.setCaptureBackend(self.original_backend)
+
+    def showScreen(self, image=None, position=(50, 100), background=40):
+        """ Serves a screen of ``background`` from the PlatformManager, with ``image`` (if
+        any) at ``position`` relative to the primary screen """
+        x, y, w, h = self.bounds
+        frame = numpy.full((h, w, 3), background, dtype=numpy.uint8)
+        if image is not None:
+            i_x, i_y = position
+            frame[i_y:i_y+image.shape[0], i_x:i_x+image.shape[1]] = image
+        lackey.PlatformManager.setCaptureBackend(lackey.ScreenCapture.ArrayCaptureBackend(frame, (x, y)))
+
+    def test_array_backend(self):
+        bitmap = self.backend.capture(0, 0, 5, 4)
+        self.assertEqual(bitmap.shape, (4, 5, 3))
+        self.assertTrue((bitmap == self.frame[5:9, 10:15]).all())
+        # Pixels outside the served frame are black
+        bitmap = self.backend.capture(25, 20, 10, 10)
+        self.assertTrue((bitmap[:5, :5] == self.frame[25:30, 35:40]).all())
+        self.assertEqual(bitmap[5:, :].sum(), 0)
+        self.assertEqual(bitmap[:, 5:].sum(), 0)
+
+    def test_platform_manager_backend(self):
+        x, y = self.bounds[:2]
+        self.showScreen(numpy.full((10, 10, 3), 255, dtype=numpy.uint8), (10, 10), background=0)
+        bitmap = lackey.PlatformManager.getBitmapFromRect(x+5, y+5, 10, 10)
+        self.assertEqual(bitmap.shape, (10, 10, 3))
+        self.assertEqual(bitmap[5:, 5:].min(), 255)
+        self.assertEqual(bitmap[:5, :].max(), 0)
+        # Regions hand out writable captures, even when they come from the frame cache
+        region = lackey.Region(x+5, y+5, 10, 10)
+        region.getBitmap()[:] = 0
+        self.assertEqual(region.getBitmap()[5:, 5:].min(), 255)
+
+    def test_frame_cache(self):
+        cache = lackey.ScreenCapture.FrameCache(ttl=60)
+        captures = []
+        def capture(x, y, w, h):
+            captures.append((x, y, w, h))
+            return self.backend.capture(x, y, w, h)
+        full = cache.getBitmap((-10, -5, 40, 30), capture)
+        view = cache.getBitmap((0, 0, 5, 4), capture)
+        self.assertEqual(len(captures), 1)
+        self.assertTrue((view == self.frame[5:9, 10:15]).all())
+        self.assertFalse(view.flags.writeable)
+        self.assertEqual(cache.getStats()["hits"], 1)
+        self.assertEqual(cache.getStats()["misses"], 1)
+        cache.invalidate()
+        cache.getBitmap((0, 0, 5, 4), capture)
+        self.assertEqual(len(captures), 2)
+
+    def test_find_any(self):
+        x, y = self.bounds[:2]
+        self.showScreen(self.pattern.getImage())
+        region = lackey.Region(x, y, 300, 300)
+        matches = region.findAny(os.path.join("tests", "notepad.png"), self.pattern)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0].getIndex(), 1)
+        self.assertEqual((matches[0].getX(), matches[0].getY()), (x+50, y+100))
+        all_matches = region.findAllOf([self.pattern, os.path.join("tests", "notepad.png")])
+        self.assertEqual(len(all_matches[0]), 1)
+        self.assertEqual(all_matches[1], [])
+
+    def test_skip_unchanged_frames(self):
+        x, y = self.bounds[:2]
+        self.showScreen()
+        region = lackey.Region(x, y, 300, 300)
+        region.setWaitScanRate(20)
+        self.assertIsNone(region.exists(os.path.join("tests", "test_pattern.png"), 0.5))
+        # The frame never changed, so only the first capture was matched
+        self.assertGreater(region.getFramesSkipped(), 0)
+        region.resetFramesSkipped()
+        self.assertEqual(region.getFramesSkipped(), 0)
+
+    def test_scan_timing(self):
+        x, y = self.bounds[:2]
+        self.showScreen(self.pattern.getImage())
+        region = lackey.Region(x, y, 300, 300)
+        region.setWaitScanRate(0.5) # Two seconds between scans
+        # A match returns immediately, without waiting for the next scan
+        start = time.time()
+        self.assertIsNotNone(region.exists(self.pattern))
+        self.assertLess(time.time() - start, 1.0)
+        # A failed search doesn't sleep past its timeout
+        start = time.time()
+        self.assertIsNone(region.exists(os.path.join("tests", "notepad.png"), 0.5))
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_last_seen(self):
+        x, y = self.bounds[:2]
+        needle = self.pattern.getImage()
+        region = lackey.Region(x, y, 400, 400)
+        self.showScreen(needle, (50, 100))
+        self.assertIsNotNone(region.exists(self.pattern, 0))
+        match = region.exists(self.pattern, 0)
+        self.assertEqual((match.getX(), match.getY()), (x+50, y+100))
+        self.assertEqual(region.getLastFindPath(), "LASTSEEN")
+        self.showScreen(needle, (60, 110))
+        match = region.exists(self.pattern, 0)
+        self.assertEqual((match.getX(), match.getY()), (x+60, y+110))
+        self.assertEqual(region.getLastFindPath(), "NEARBY")
+        self.showScreen(needle, (300, 300))
+        match = region.exists(self.pattern, 0)
+        self.assertEqual((match.getX(), match.getY()), (x+300, y+300))
+        self.assertEqual(region.getLastFindPath(), "FULL")
+
+    def test_match_scales(self):
+        original_scales = lackey.Settings.MatchScales
+        x, y = self.bounds[:2]
+        needle = self.pattern.getImage()
+        # Needle shown at twice its size, as on a HiDPI screen
+        large = cv2.resize(needle, (needle.shape[1]*2, needle.shape[0]*2))
+        self.showScreen(large)
+        try:
+            region = lackey.Region(x, y, 400, 400)
+            lackey.Settings.MatchScales = [1.0]
+            self.assertIsNone(region.exists(self.pattern, 0))
+            lackey.Settings.MatchScales = [1.0, 2.0]
+            match = region.exists(self.pattern, 0)
+            self.assertEqual((match.getX(), match.getY()), (x+50, y+100))
+            self.assertEqual((match.getW(), match.getH()), (large.shape[1], large.shape[0]))
+            # The scale that matched is tried first next time
+            self.assertIn(2.0, self.pattern.getCompiled().preferredScales.values())
+            # Target offsets are scaled with the match
+            center = match.getCenter()
+            match = region.exists(self.pattern.targetOffset(10, -5), 0)
+            self.assertEqual(match.getTarget().getTuple(), (center.x+20, center.y-10))
+            match = list(region.findAll(self.pattern.targetOffset(10, -5)))[0]
+            self.assertEqual(match.getTarget().getTuple(), (center.x+20, center.y-10))
+            # Multi-pattern searches try the same scales
+            notepad = os.path.join("tests", "notepad.png")
+            matches = region.findAny(notepad, self.pattern.targetOffset(10, -5))
+            self.assertEqual([match.getIndex() for match in matches], [1])
+            self.assertEqual((matches[0].getW(), matches[0].getH()), (large.shape[1], large.shape[0]))
+            self.assertEqual(matches[0].getTarget().getTuple(), (center.x+20, center.y-10))
+            all_matches = region.findAllOf(self.pattern.targetOffset(10, -5), notepad)
+            self.assertEqual(all_matches[0][0].getTarget().getTuple(), (center.x+20, center.y-10))
+            self.assertEqual(all_matches[1], [])
+        finally:
+            lackey.Settings.MatchScales = original_scales
+
+class TestScreenTopology(unittest.TestCase):
+    def setUp(self):
+        class Manager(object):
+            screens = [(0, 0, 800, 600), (800, 0, 400, 300)]
+            reads = 0
+            resets = 0
+            def getScreenDetails(self):
+                self.reads += 1
+                return [{"rect": rect} for rect in self.screens]
+            def getScreenBounds(self, screenId):
+                return (0, 0, 1200, 600)
+            def resetFrameCache(self):
+                self.resets += 1
+        self.manager = Manager()
+        self.clock = VirtualClock()
+        self.topology = lackey.ScreenTopology.ScreenTopology(self.manager, self.clock)
+        self.interval = lackey.Settings.MonitorCheckInterval
+
+    def tearDown(self):
+        lackey.Settings.MonitorCheckInterval = self.interval
+
+    def test_cached_layout(self):
+        lackey.Settings.MonitorCheckInterval = 0
+        self.assertEqual(self.topology.getCount(), 2)
+        self.assertEqual(self.topology.getBounds(-1), (0, 0, 1200, 600))
+        self.assertEqual(self.topology.getBounds(1), (800, 0, 400, 300))
+        self.assertEqual(self.topology.getScreenAt(900, 10), 1)
+        self.assertIsNone(self.topology.getScreenAt(900, 400))
+        self.assertRaises(ValueError, self.topology.getBounds, 2)
+        self.assertEqual(self.manager.reads, 1)
+        self.manager.screens = [(0, 0, 800, 600)]
+        self.clock.advance(3600)
+        self.assertEqual(self.topology.getCount(), 2)
+        self.topology.invalidate()
+        self.assertEqual(self.topology.getCount(), 1)
+        self.assertEqual(self.manager.reads, 2)
+
+    def test_change_detection(self):
+        lackey.Settings.MonitorCheckInterval = 1
+        self.assertEqual(self.topology.getCount(), 2)
+        self.manager.screens = [(0, 0, 800, 600)]
+        self.clock.advance(0.5)
+        self.assertEqual(self.topology.getCount(), 2)
+        self.clock.advance(0.5)
+        self.assertEqual(self.topology.getCount(), 1)
+        # Captures of the old layout are discarded
+        self.assertEqual(self.manager.resets, 1)
+
 class TestLocationMethods(unittest.TestCase):
     def setUp(self):
         self.test_loc = lackey.Location(10, 11)
@@ -209,6 +641,392 @@ class TestPatternMethods(unittest.TestCase):
         with self.assertRaises(lackey.ImageMissing):
             lackey.Pattern("non_existent_file.png")
 
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.file_path = os.path.join("tests", "test_pattern.png")
+        self.cache = lackey.ImageCache.ImageCache()
+
+    def test_cache_hits(self):
+        first = self.cache.get(self.file_path)
+        second = self.cache.get(self.file_path)
+        self.assertIs(first, second)
+        self.assertEqual(self.cache.getStats()["hits"], 1)
+        self.assertEqual(self.cache.getStats()["misses"], 1)
+        self.assertIsNone(self.cache.get("non_existent_file.png"))
+
+    def test_variants(self):
+        cached = self.cache.get(self.file_path)
+        size = self.cache.getSize()
+        builds = []
+        def build_gray():
+            builds.append(True)
+            return cached.image[:, :, 0].copy()
+        gray = cached.getVariant("gray", build_gray)
+        self.assertIs(cached.getVariant("gray", build_gray), gray)
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(self.cache.getSize(), size + gray.nbytes)
+
+    def test_size_limit(self):
+        cache = lackey.ImageCache.ImageCache(max_bytes=1)
+        cache.get(self.file_path)
+        cache.get(os.path.join("tests", "notepad.png"))
+        # The most recently used image is always kept
+        self.assertEqual(cache.getStats()["entries"], 1)
+
+class TestHintStore(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.store = lackey.HintStore.HintStore(self.path, max_entries=3)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_hints(self):
+        self.assertIsNone(self.store.get("pattern", "0,0,800,600"))
+        self.store.put("pattern", "0,0,800,600", (50, 100), 0.95)
+        self.assertEqual(self.store.get("pattern", "0,0,800,600"), ((50, 100), 0.95))
+        # Hints are only used with the screen geometry they were recorded on
+        self.assertIsNone(self.store.get("pattern", "0,0,1920,1080"))
+        self.store.clear()
+        self.assertEqual(self.store.getSize(), 0)
+
+    def test_size_limit(self):
+        for i in range(10):
+            self.store.put("pattern{}".format(i), "0,0,800,600", (i, i), 0.9)
+        self.assertEqual(self.store.getSize(), 3)
+        self.assertIsNotNone(self.store.get("pattern9", "0,0,800,600"))
+        self.assertIsNone(self.store.get("pattern0", "0,0,800,600"))
+
+class TestFrameRecorder(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".frames")
+        os.close(handle)
+        self.screen = cv2.GaussianBlur(
+            numpy.random.RandomState(0).randint(0, 255, (300, 400, 3)).astype(numpy.uint8), (5, 5), 0)
+        self.changed = self.screen.copy()
+        self.changed[10:20, 30:50] = 0
+        recorder = lackey.FrameRecorder.FrameRecorder(self.path)
+        recorder.record((0, 0, 400, 300), self.screen, 10.0)
+        recorder.record((0, 0, 400, 300), self.screen, 10.5) # Stored as a reference
+        recorder.record((0, 0, 400, 300), self.changed, 11.0) # Stored as a patch
+        recorder.record((100, 50, 40, 30), self.changed[50:80, 100:140], 11.5)
+        recorder.close()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_archive(self):
+        archive = lackey.FrameRecorder.FrameArchive(self.path)
+        frames = list(archive)
+        self.assertEqual([frame[:2] for frame in frames], [
+            (10.0, (0, 0, 400, 300)),
+            (10.5, (0, 0, 400, 300)),
+            (11.0, (0, 0, 400, 300)),
+            (11.5, (100, 50, 40, 30))])
+        self.assertTrue((frames[1][2] == self.screen).all())
+        self.assertTrue((frames[2][2] == self.changed).all())
+        self.assertEqual(archive.getDuration(), 1.5)
+        # Captures are decoded on demand, in any order
+        archive = lackey.FrameRecorder.FrameArchive(self.path)
+        self.assertTrue((archive.getFrame(2)[2] == self.changed).all())
+        self.assertTrue((archive.getFrame(1)[2] == self.screen).all())
+        self.assertEqual(archive.getCaptures()[3], (11.5, (100, 50, 40, 30), (30, 40)))
+        # Repeated and partly changed captures take little space
+        self.assertLess(os.path.getsize(self.path), self.screen.nbytes)
+        # An archive cut short is read up to its last complete record
+        with open(self.path, "rb+") as archive_file:
+            archive_file.truncate(os.path.getsize(self.path) - 10)
+        self.assertEqual(len(lackey.FrameRecorder.FrameArchive(self.path)), 3)
+
+    def test_append(self):
+        # Recording to an existing archive continues it, after its last complete record
+        with open(self.path, "rb+") as archive_file:
+            archive_file.truncate(os.path.getsize(self.path) - 10)
+        recorder = lackey.FrameRecorder.FrameRecorder(self.path)
+        self.assertEqual(recorder.getCount(), 3)
+        recorder.record((0, 0, 400, 300), self.screen, 20.0)
+        recorder.record((0, 0, 400, 300), self.screen, 20.5)
+        recorder.close()
+        frames = list(lackey.FrameRecorder.FrameArchive(self.path))
+        self.assertEqual([frame[0] for frame in frames], [10.0, 10.5, 11.0, 20.0, 20.5])
+        self.assertTrue((frames[2][2] == self.changed).all())
+        self.assertTrue((frames[4][2] == self.screen).all())
+        # Other files aren't overwritten
+        with self.assertRaises(ValueError):
+            lackey.FrameRecorder.FrameRecorder(os.path.join("tests", "test_pattern.png"))
+
+    def test_replay(self):
+        clock = VirtualClock()
+        backend = lackey.FrameRecorder.ReplayCaptureBackend(self.path, clock)
+        self.assertTrue((backend.capture(30, 10, 20, 10) != 0).all())
+        clock.advance(1.0)
+        self.assertEqual(backend.capture(30, 10, 20, 10).max(), 0)
+        # The latest capture containing the requested rect is served
+        clock.advance(4.0)
+        self.assertTrue((backend.capture(110, 60, 10, 10) == self.changed[60:70, 110:120]).all())
+        self.assertEqual(backend.capture(30, 10, 20, 10).max(), 0)
+
+        needle = self.screen[100:130, 200:240].copy()
+        results = lackey.FrameRecorder.replayMatches(self.path, needle, 0.95)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0][2][0], (200, 100))
+        self.assertIsNone(results[3][2]) # Needle is larger than this capture
+
+    def test_replay_overlap(self):
+        path = self.path + ".overlap"
+        self.addCleanup(os.remove, path)
+        recorder = lackey.FrameRecorder.FrameRecorder(path)
+        recorder.record((100, 30, 200, 100), numpy.full((100, 200, 3), 50, dtype=numpy.uint8), 20.0)
+        recorder.record((200, 0, 100, 20), numpy.full((20, 100, 3), 200, dtype=numpy.uint8), 21.0)
+        recorder.close()
+        clock = VirtualClock()
+        backend = lackey.FrameRecorder.ReplayCaptureBackend(path, clock, start=-100)
+        # No capture contains the rect, and the latest only shares its columns, so the
+        # older capture that does overlap it is served
+        bitmap = backend.capture(250, 40, 100, 40)
+        self.assertTrue((bitmap[:, :50] == 50).all())
+        self.assertEqual(bitmap[:, 50:].max(), 0)
+
+class TestTemplateMatchers(unittest.TestCase):
+    def setUp(self):
+        self.needle = lackey.Pattern(os.path.join("tests", "test_pattern.png")).getImage()
+        self.haystack = numpy.full((300, 300, 3), 40, dtype=numpy.uint8)
+        self.haystack[100:100+self.needle.shape[0], 50:50+self.needle.shape[1]] = self.needle
+
+    def test_compiled_pattern(self):
+        compiled = lackey.TemplateMatchers.compilePattern(self.needle)
+        self.assertFalse(compiled.isSolidColor)
+        self.assertEqual(compiled.pyramid[-1].shape, self.needle.shape[:2])
+        black = lackey.TemplateMatchers.compilePattern(numpy.zeros((20, 20, 3), dtype=numpy.uint8))
+        self.assertTrue(black.isSolidColor)
+        self.assertTrue(black.isSolidBlack)
+        # Patterns compile once and reuse the result
+        pattern = lackey.Pattern(os.path.join("tests", "test_pattern.png"))
+        self.assertIs(pattern.getCompiled(), pattern.getCompiled())
+        # The original-size pyramid level is the grayscale image, and is counted once
+        self.assertIs(compiled.pyramid[-1], compiled.gray)
+        self.assertEqual(compiled.getSize(), sum(level.nbytes for level in compiled.pyramid))
+
+    def test_find_best_match(self):
+        matcher = lackey.TemplateMatchers.PyramidTemplateMatcher(self.haystack)
+        compiled = lackey.TemplateMatchers.compilePattern(self.needle)
+        position, confidence = matcher.findBestMatch(compiled, 0.9)
+        self.assertEqual(position, (50, 100))
+        self.assertGreater(confidence, 0.99)
+
+    def test_find_all_matches(self):
+        needle_h, needle_w = self.needle.shape[:2]
+        haystack = numpy.full((needle_h*8, needle_w*12, 3), 40, dtype=numpy.uint8)
+        for y in range(0, haystack.shape[0], needle_h):
+            for x in range(0, haystack.shape[1], needle_w):
+                haystack[y:y+needle_h, x:x+needle_w] = self.needle
+        matches = lackey.TemplateMatchers.NaiveTemplateMatcher(haystack).findAllMatches(self.needle, 0.9)
+        self.assertEqual(len(matches), 96)
+        self.assertEqual(matches[1][0], (needle_w, 0))
+        original = haystack.copy()
+        matches = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack).findAllMatches(self.needle, 0.9)
+        self.assertEqual(len(matches), 96)
+        self.assertEqual(matches[1][0], (needle_w, 0))
+        self.assertTrue(numpy.array_equal(haystack, original))
+
+    def test_exact_matches(self):
+        matcher = lackey.TemplateMatchers.ExactTemplateMatcher(self.haystack)
+        self.assertEqual(matcher.findBestMatch(self.needle), ((50, 100), 1.0))
+        self.assertEqual(matcher.findAllMatches(self.needle), [((50, 100), 1.0)])
+        # A single changed pixel is not an exact match
+        changed = self.needle.copy()
+        changed[5, 5, 0] ^= 1
+        self.assertIsNone(matcher.findBestMatch(changed))
+        # Solid color needles
+        solid = numpy.full((30, 40, 3), 200, dtype=numpy.uint8)
+        solid[10:15, 20:25] = 90
+        solid_matcher = lackey.TemplateMatchers.ExactTemplateMatcher(solid)
+        self.assertEqual(solid_matcher.findBestMatch(solid[10:15, 20:25].copy()), ((20, 10), 1.0))
+        self.assertIsNone(solid_matcher.findBestMatch(numpy.full((6, 5, 3), 90, dtype=numpy.uint8)))
+        self.assertEqual(solid_matcher.findBestMatch(solid[:5, :5].copy()), ((0, 0), 1.0))
+        # Similarity 1.0 searches use the exact matcher
+        pyramid = lackey.TemplateMatchers.PyramidTemplateMatcher(self.haystack)
+        self.assertEqual(pyramid.findBestMatch(self.needle, 1.0), ((50, 100), 1.0))
+
+    def test_color_verification(self):
+        def icon(color):
+            image = numpy.full((30, 30, 3), 255, dtype=numpy.uint8)
+            cv2.circle(image, (15, 15), 10, color, -1)
+            return image
+        # Red and green icons with the same brightness
+        red = icon((0, 0, 200))
+        green = icon((0, 102, 0))
+        haystack = numpy.full((300, 300, 3), 255, dtype=numpy.uint8)
+        haystack[50:80, 50:80] = green
+        haystack[200:230, 150:180] = red
+        color_verification = lackey.Settings.ColorVerification
+        try:
+            lackey.Settings.ColorVerification = False
+            matcher = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack)
+            self.assertEqual(len(matcher.findAllMatches(red, 0.9)), 2)
+            lackey.Settings.ColorVerification = True
+            self.assertEqual(matcher.findBestMatch(red, 0.9)[0], (150, 200))
+            self.assertEqual(len(matcher.findAllMatches(red, 0.9)), 1)
+        finally:
+            lackey.Settings.ColorVerification = color_verification
+
+    def test_key_pixel_prefilter(self):
+        haystack = cv2.GaussianBlur(numpy.random.RandomState(11).randint(0, 255, (600, 800, 3)).astype(numpy.uint8), (9, 9), 0)
+        needle = haystack[150:400, 200:500].copy()
+        min_area = lackey.Settings.KeyPixelMinArea
+        try:
+            lackey.Settings.KeyPixelMinArea = needle.shape[0] * needle.shape[1]
+            self.assertIsNotNone(lackey.TemplateMatchers.compilePattern(needle).getKeyPixels(0))
+            matcher = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack)
+            position, confidence = matcher.findBestMatch(needle, 0.9)
+            self.assertEqual(position, (200, 150))
+            self.assertGreater(confidence, 0.99)
+        finally:
+            lackey.Settings.KeyPixelMinArea = min_area
+
+    def test_key_pixel_fallback(self):
+        # A match whose key pixels are covered is still found by the full search
+        haystack = cv2.GaussianBlur(numpy.random.RandomState(11).randint(0, 255, (600, 800, 3)).astype(numpy.uint8), (9, 9), 0)
+        needle = haystack[150:400, 200:500].copy()
+        compiled = lackey.TemplateMatchers.compilePattern(needle)
+        ys, xs = compiled.getKeyPixels(len(compiled.pyramid)-1)[:2]
+        for y, x in zip(ys, xs):
+            haystack[148+y:153+y, 198+x:203+x] = 255 - haystack[148+y:153+y, 198+x:203+x]
+        self.assertIsNotNone(lackey.TemplateMatchers.NaiveTemplateMatcher(haystack).findBestMatch(needle, 0.8))
+        position, confidence = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack).findBestMatch(needle, 0.8)
+        self.assertEqual(position, (200, 150))
+        self.assertGreater(confidence, 0.8)
+
+    def test_key_pixel_candidates(self):
+        # Several matches in one region of interest each get their own candidates
+        needle = numpy.random.RandomState(1).randint(0, 256, (200, 250)).astype(numpy.uint8)
+        needle = cv2.normalize(cv2.GaussianBlur(needle, (15, 15), 0), None, 0, 255, cv2.NORM_MINMAX)
+        needle = cv2.cvtColor(needle, cv2.COLOR_GRAY2BGR)
+        frame = numpy.full((1080, 1920, 3), 200, dtype=numpy.uint8)
+        positions = [(20+250*i, 20+200*j) for i in range(5) for j in range(2)]
+        for x, y in positions:
+            frame[y:y+200, x:x+250] = needle
+        candidates = lackey.Settings.KeyPixelCandidates
+        try:
+            lackey.Settings.KeyPixelCandidates = 2
+            matches = lackey.TemplateMatchers.PyramidTemplateMatcher(frame).findAllMatches(needle, 0.9)
+            self.assertEqual(sorted(position for position, score in matches), sorted(positions))
+        finally:
+            lackey.Settings.KeyPixelCandidates = candidates
+
+    def test_solid_color_needles(self):
+        haystack = cv2.GaussianBlur(numpy.random.RandomState(12).randint(0, 255, (600, 800, 3)).astype(numpy.uint8), (5, 5), 0)
+        haystack[100:160, 200:300] = (90, 90, 90)
+        haystack[400:450, 500:580] = (0, 0, 0)
+        matcher = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack)
+        gray = matcher.haystack
+        for position, color, shape in (((200, 100), 90, (60, 100)), ((500, 400), 0, (50, 80))):
+            needle = numpy.full(shape + (3,), color, dtype=numpy.uint8)
+            # Integral image scores are the same as OpenCV's
+            scores = lackey.TemplateMatchers._getSolidScores(matcher.getHaystack(), gray, shape, color)
+            expected = cv2.matchTemplate(
+                255 - gray if color == 0 else gray,
+                numpy.full(shape, 255 if color == 0 else color, dtype=numpy.uint8),
+                cv2.TM_SQDIFF_NORMED)
+            self.assertTrue(numpy.allclose(scores, expected, atol=1e-4))
+            self.assertEqual(matcher.findBestMatch(needle, 0.95)[0], position)
+            self.assertEqual(matcher.findBestMatchNear(needle, 0.95, (position[0]-5, position[1]+5), 10)[0], position)
+
+    def test_pyramid_calibration(self):
+        # Smooth needles keep their detail when reduced, noisy ones don't
+        smooth = cv2.GaussianBlur(numpy.random.RandomState(13).randint(0, 255, (120, 160, 3)).astype(numpy.uint8), (31, 31), 0)
+        smooth = cv2.normalize(smooth, None, 0, 255, cv2.NORM_MINMAX)
+        noisy = numpy.random.RandomState(14).randint(0, 255, (120, 160, 3)).astype(numpy.uint8)
+        smooth_pattern = lackey.TemplateMatchers.compilePattern(smooth)
+        noisy_pattern = lackey.TemplateMatchers.compilePattern(noisy)
+        self.assertGreater(len(smooth_pattern.pyramid), len(noisy_pattern.pyramid))
+        self.assertEqual(len(smooth_pattern.similarityDrops), len(smooth_pattern.pyramid))
+        self.assertEqual(smooth_pattern.getLevelSimilarity(0.9, len(smooth_pattern.pyramid)-1), 0.9)
+        self.assertLess(smooth_pattern.getLevelSimilarity(0.9, 0), 0.9)
+        # Small haystacks are matched directly
+        self.assertEqual(smooth_pattern.getDepth((130, 170)), 1)
+        self.assertEqual(smooth_pattern.getDepth((1080, 1920)), len(smooth_pattern.pyramid))
+        haystack = numpy.full((600, 800, 3), 40, dtype=numpy.uint8)
+        haystack[300:420, 500:660] = smooth
+        matcher = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack)
+        self.assertEqual(matcher.findBestMatch(smooth_pattern, 0.9)[0], (500, 300))
+        # Needles are found at any pixel phase, on any background
+        random = numpy.random.RandomState(16)
+        needle = cv2.GaussianBlur(random.randint(0, 256, (51, 62, 3)).astype(numpy.uint8), (7, 7), 0)
+        solid = numpy.full((20, 20, 3), 40, dtype=numpy.uint8)
+        for x, y in ((658, 5), (1081, 711), (1029, 500), (101, 391)):
+            for image in (needle, solid):
+                haystack = numpy.full((1080, 1920, 3), 253, dtype=numpy.uint8)
+                haystack += random.randint(0, 2, haystack.shape).astype(numpy.uint8)
+                haystack[y:y+image.shape[0], x:x+image.shape[1]] = image
+                matcher = lackey.TemplateMatchers.PyramidTemplateMatcher(haystack)
+                self.assertEqual(matcher.findBestMatch(image, 0.9)[0], (x, y))
+
+    def test_tiled_matching(self):
+        haystack = cv2.GaussianBlur(numpy.random.RandomState(15).randint(0, 255, (600, 800)).astype(numpy.uint8), (5, 5), 0)
+        needle = haystack[300:340, 500:560].copy()
+        single_pass = lackey.TemplateMatchers.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+        workers, tile_size = lackey.Settings.MatchWorkers, lackey.Settings.MatchTileSize
+        lackey.Settings.MatchWorkers, lackey.Settings.MatchTileSize = 4, 128
+        try:
+            tiled = lackey.TemplateMatchers.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+        finally:
+            lackey.Settings.MatchWorkers, lackey.Settings.MatchTileSize = workers, tile_size
+        self.assertEqual(tiled.shape, single_pass.shape)
+        self.assertTrue(numpy.allclose(tiled, single_pass, atol=1e-4))
+        self.assertEqual(cv2.minMaxLoc(tiled)[3], (500, 300))
+
+    def test_thread_pool_resize(self):
+        borrow = lackey.TemplateMatchers.borrowThreadPool
+        with borrow("test", 2) as pool:
+            # Another caller changes the worker count while this pool is in use
+            with borrow("test", 3) as resized:
+                self.assertIsNot(resized, pool)
+            self.assertEqual(pool.map(abs, [-1, -2]), [1, 2])
+        # The replaced pool is closed once its last user is done
+        self.assertRaises((ValueError, AssertionError), pool.map, abs, [-1]) # Python 2 asserts
+        with borrow("test", 3) as current:
+            self.assertIs(current, resized)
+
+    def test_incremental_score_map(self):
+        tile_size = lackey.Settings.MatchTileSize
+        lackey.Settings.MatchTileSize = 64
+        try:
+            score_map = lackey.TemplateMatchers.IncrementalScoreMap(self.needle)
+            score_map.update(lackey.TemplateMatchers.Haystack(self.haystack))
+            changed = self.haystack.copy()
+            changed[250:260, 250:260] = 255
+            scores = score_map.update(lackey.TemplateMatchers.Haystack(changed))
+            self.assertGreater(score_map.tilesSkipped, 0)
+            # Same scores as matching the whole frame again
+            expected = lackey.TemplateMatchers.IncrementalScoreMap(self.needle).update(
+                lackey.TemplateMatchers.Haystack(changed))
+            self.assertTrue(numpy.array_equal(scores, expected))
+        finally:
+            lackey.Settings.MatchTileSize = tile_size
+
+    def test_shared_haystack(self):
+        frame = self.haystack.copy()
+        frame.setflags(write=False)
+        haystack = lackey.TemplateMatchers.Haystack.forImage(frame[:, :])
+        self.assertIs(lackey.TemplateMatchers.Haystack.forImage(frame[:, :]), haystack)
+        # Pyramids of different depths share their levels
+        deep = haystack.getPyramid(3)
+        shallow = haystack.getPyramid(2)
+        self.assertIs(deep[-2], shallow[0])
+        self.assertIs(deep[-1], haystack.gray)
+        # Older frames are dropped once the shared ones outgrow the byte limit
+        shared_bytes = lackey.TemplateMatchers.Haystack._shared_bytes
+        lackey.TemplateMatchers.Haystack._shared_bytes = haystack.getSize()
+        try:
+            other = frame.copy()
+            other.setflags(write=False)
+            lackey.TemplateMatchers.Haystack.forImage(other)
+            self.assertIsNot(lackey.TemplateMatchers.Haystack.forImage(frame[:, :]), haystack)
+        finally:
+            lackey.TemplateMatchers.Haystack._shared_bytes = shared_bytes
+
 class TestRegionMethods(unittest.TestCase):
     def setUp(self):
         self.r = lackey.Screen(0)
@@ -434,6 +1252,8 @@ class TestInterfaces(unittest.TestCase):
         self.assertHasMethod(lackey.Region, "right", 2)
         self.assertHasMethod(lackey.Region, "find", 2)
         self.assertHasMethod(lackey.Region, "findAll", 2)
+        self.assertHasMethod(lackey.Region, "findAny", 1)       # Uses *args
+        self.assertHasMethod(lackey.Region, "findAllOf", 1)     # Uses *args
         self.assertHasMethod(lackey.Region, "wait", 3)
         self.assertHasMethod(lackey.Region, "waitVanish", 3)
         self.assertHasMethod(lackey.Region, "exists", 3)
@@ -517,6 +1337,7 @@ class TestInterfaces(unittest.TestCase):
 
         ## Screen methods
         self.assertHasMethod(lackey.PlatformManager, "getBitmapFromRect", 5)
+        self.assertHasMethod(lackey.PlatformManager, "getSharedBitmapFromRect", 5)
         self.assertHasMethod(lackey.PlatformManager, "getScreenBounds", 2)
         self.assertHasMethod(lackey.PlatformManager, "getScreenDetails", 1)
         self.assertHasMethod(lackey.PlatformManager, "isPointVisible", 3)